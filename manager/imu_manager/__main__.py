@@ -2,10 +2,12 @@ import os
 import logging
 from logging.handlers import RotatingFileHandler
 
+from imu_manager.acquisition import WRITE_BUFFER
 from imu_manager.manager import Manager
 from imu_manager.client import Client
 from imu_manager.config import Config
 from imu_manager.utils import CommandThread
+from imu_manager.mpu6050.emulator import EmulatedBackend
 
 
 if __name__ == '__main__':
@@ -25,7 +27,33 @@ if __name__ == '__main__':
     config_path = os.environ.get('config_path', './config.yml')
     cfg = Config(config_path, keep_type=['sensor_settings'])
 
-    manager = Manager(cfg.device_id, cfg.i2c.buses, cfg.i2c.addresses)
+    bus_factory = None
+    if getattr(cfg.i2c, 'backend', 'smbus') == 'emulated':
+        logging.info('Using emulated sensors')
+        bus_factory = EmulatedBackend()
+        for bus in cfg.i2c.buses:
+            for address in cfg.i2c.addresses:
+                bus_factory.attach(bus, address)
+        for mux in getattr(cfg.i2c, 'muxes', []):
+            for channel in mux.channels:
+                for address in cfg.i2c.addresses:
+                    bus_factory.attach(bus=mux.bus, address=address,
+                                       mux_address=mux.address,
+                                       mux_channel=channel)
+    workers = 'thread'
+    write_buffer = WRITE_BUFFER
+    encoding = 'none'
+    if hasattr(cfg, 'acquisition'):
+        workers = getattr(cfg.acquisition, 'workers', workers)
+        write_buffer = getattr(cfg.acquisition, 'write_buffer', write_buffer)
+        encoding = getattr(cfg.acquisition, 'encoding', encoding)
+    muxes = [(mux.bus, mux.address, mux.channels)
+             for mux in getattr(cfg.i2c, 'muxes', [])]
+    profile = getattr(cfg.i2c, 'profile', False)
+    if profile:
+        logging.info('I2C transactions are profiled')
+    manager = Manager(cfg.device_id, cfg.i2c.buses, cfg.i2c.addresses,
+                      bus_factory, workers, muxes, profile, write_buffer, encoding)
     command_thread = CommandThread('ManagerThread')
     command_thread.start()
     client = Client(cfg, manager, command_thread)
@@ -0,0 +1,481 @@
+"""
+Data acquisition from sensor FIFOs.
+Sensors are split to workers, one per I2C bus, which run in parallel.
+"""
+
+import time
+import struct
+import functools
+import threading
+import multiprocessing
+import multiprocessing.forkserver
+from queue import Empty
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from imu_manager.mpu6050.mpu6050 import MPU6050
+from imu_manager.mpu6050.i2c_interface import MPU6050_FIFO_SIZE
+from imu_manager.encoding import ENCODINGS, encoder
+from imu_manager.profiler import I2CProfiler
+from imu_manager.scheduler import PollScheduler
+from imu_manager.tca9548a import MuxBus
+from imu_manager.utils import BufferPool
+from imu_manager.writer import SessionWriter
+
+
+WORKER_MODES = ['thread', 'process']
+# Timestamp index entry: monotonic read time in seconds from session start
+# and cumulative number of packages written after the read
+INDEX_FORMAT = '<dI'
+INDEX_STRUCT = struct.Struct(INDEX_FORMAT)
+# Reads of one urgent FIFO in a row before other sensors are served
+MAX_DRAINS = 4
+# Live packages of a sensor are published in batches this often
+LIVE_INTERVAL = 0.25
+# Default ring buffer size of every data and index file in bytes
+WRITE_BUFFER = 1 << 18
+# File name of a segment of data or index file
+SEGMENT_FORMAT = '{file}.{segment:04d}'
+# Workers check the end time at least this often
+STOP_INTERVAL = 0.1
+# Stopped sessions end this much later, so all workers end together
+STOP_DELAY = 0.5
+# Worker callbacks, called in parent process in process mode
+CALLBACKS = ['live', 'on_segment']
+# Parent checks worker processes are alive this often
+WORKER_POLL = 1.0
+
+
+def segment_path(path: str, segment: int) -> str:
+    return SEGMENT_FORMAT.format(file=path, segment=segment)
+
+
+class BusWorker:
+    """
+    Acquisition worker owning sensors of a single I2C bus
+    and their output files.
+    Can be run in a thread or in a worker process.
+    On buses with multiplexers reads are grouped by channel.
+    Every read is also recorded to a binary timestamp index file
+    (see INDEX_FORMAT).
+    With profiler, records of bus transactions made by the worker
+    are returned too, so they are not lost in worker processes.
+    With live, every live_decimation-th package of every sensor is
+    also passed to live(sensor_id, packages) in raw batches.
+    Files are written by a SessionWriter thread from ring buffers
+    of write_buffer bytes, so storage stalls don't delay FIFO reads.
+    With segment_duration, files are split to segments of that length
+    (see SEGMENT_FORMAT) and on_segment(bus, segment) is called once
+    all files of a segment are written. Package counts, index and gaps
+    run through segments, so segments of a file just concatenate.
+    end_time is shared wall clock time (multiprocessing.RawValue)
+    the session can be stopped at before its duration is over.
+    Data files are encoded with encoding (see encoding module)
+    by the writer thread, index files are not.
+    Worker with bus_handles (see buses.BusHandles) can be pickled to
+    another process, its sensors are opened there again with reopen.
+    """
+
+    def __init__(self, bus: int, sensors: List[MPU6050], file_paths: List[str],
+                 index_paths: List[str], mux_bus: Optional[MuxBus] = None,
+                 profiler: Optional[I2CProfiler] = None,
+                 live: Optional[Callable[[str, bytes], None]] = None,
+                 live_decimation: int = 1,
+                 write_buffer: int = WRITE_BUFFER,
+                 segment_duration: Optional[float] = None,
+                 on_segment: Optional[Callable[[int, int], None]] = None,
+                 end_time: Any = None,
+                 encoding: str = 'none',
+                 bus_handles: Any = None):
+        if live_decimation < 1:
+            raise ValueError(f'Invalid live decimation: {live_decimation}')
+        if write_buffer < MPU6050_FIFO_SIZE:
+            raise ValueError(f'Write buffer is smaller than FIFO: {write_buffer}')
+        if segment_duration is not None and segment_duration <= 0:
+            raise ValueError(f'Invalid segment duration: {segment_duration}')
+        if encoding not in ENCODINGS:
+            raise ValueError(f'Unknown encoding: {encoding}')
+        self.bus = bus
+        self.sensors = sensors
+        self.file_paths = file_paths
+        self.index_paths = index_paths
+        self.mux_bus = mux_bus
+        self.profiler = profiler
+        self.live = live
+        self.live_decimation = live_decimation
+        self.write_buffer = write_buffer
+        self.segment_duration = segment_duration
+        self.on_segment = on_segment
+        self.end_time = end_time
+        self.encoding = encoding
+        self.bus_handles = bus_handles
+
+    def __getstate__(self) -> Dict[str, Any]:
+        if self.bus_handles is None:
+            raise TypeError(f'Bus {self.bus} worker without bus handles cannot be pickled')
+        state = self.__dict__.copy()
+        # Opened handles stay in this process, sensors go by location
+        state['sensors'] = [
+            (sensor.address, sensor.mux_address, sensor.mux_channel)
+            for sensor in self.sensors
+        ]
+        state['mux_bus'] = None
+        return state
+
+    def reopen(self):
+        """
+        Open bus and sensors of unpickled worker in this process.
+        Raises OSError if some sensor doesn't answer.
+        """
+        self.bus_handles.open()
+        self.mux_bus = self.bus_handles.mux_buses.get(self.bus)
+        self.sensors = [self.bus_handles.open_sensor(self.bus, *location)
+                        for location in self.sensors]
+
+    def __files(self, segment: Optional[int]) -> Tuple[List[str], Any, List[Any]]:
+        """Paths, on_close and encoders of all files, or of their segment"""
+        # Data files are streams 0..n-1, index files n..2n-1
+        paths = self.file_paths + self.index_paths
+        on_close = None
+        if segment is not None:
+            paths = [segment_path(path, segment) for path in paths]
+            if self.on_segment is not None:
+                on_close = functools.partial(self.on_segment, self.bus, segment)
+        # Every segment starts new blocks, so segments still concatenate
+        encoders = [encoder(self.encoding, sensor.package_length)
+                    for sensor in self.sensors] + [None] * len(self.index_paths)
+        return paths, on_close, encoders
+
+    def run(self, time_start: float, duration: Optional[float]) -> Dict[str, Any]:
+        """
+        Collect data until time_start + duration, or until end_time
+        if duration is None.
+        Returns per sensor package counts, overflow gaps, poll counts
+        and write buffer usage, per channel FIFO fill levels, number
+        of channel switches and number of segments.
+        Overflowed FIFO is misaligned to packages, so its content is dropped
+        and FIFO is reset. The gap is recorded as
+        [start, end, index, missing]: time of the last good read and of
+        the reset (seconds from session start), number of packages written
+        before the gap and estimated number of lost samples.
+        """
+        if duration is None and self.end_time is None:
+            raise ValueError('Session without duration needs end time')
+        sensors = self.sensors
+        channels = [channel_name(sensor) for sensor in sensors]
+        package_length = [sensor.package_length for sensor in sensors]
+        package_count = [0] * len(sensors)
+        overflows = [[] for _ in sensors]
+        sample_rates = [sensor.sample_rate for sensor in sensors]
+        # Sampling restarts at every FIFO reset, missing samples are counted
+        # from the last reset time and packages written since then
+        sync_times = [0.0] * len(sensors)
+        sync_counts = [0] * len(sensors)
+        read_times = [0.0] * len(sensors)
+        # FIFO is read straight to preallocated buffers and written from them
+        pool = BufferPool(MPU6050_FIFO_SIZE, len(sensors))
+        buffers = [pool.acquire() for _ in sensors]
+        views = [memoryview(buffer) for buffer in buffers]
+        scheduler = PollScheduler(
+            [sensor.sample_rate * length
+             for sensor, length in zip(sensors, package_length)],
+            MPU6050_FIFO_SIZE,
+            groups=channels if self.mux_bus is not None else None
+        )
+        switches = self.mux_bus.switches if self.mux_bus is not None else 0
+        if self.profiler is not None:
+            snapshot = self.profiler.snapshot()
+        index_entry = bytearray(INDEX_STRUCT.size)
+        live, decimation = self.live, self.live_decimation
+        # Index of the next live package in the following read
+        live_phases = [0] * len(sensors)
+        live_batches = [bytearray() for _ in sensors]
+        segment_duration, end_time = self.segment_duration, self.end_time
+        segment = 0 if segment_duration is not None else None
+        paths, on_close, encoders = self.__files(segment)
+        # Segments rotate files of the same writer, its thread opens them
+        writer = SessionWriter(f'Bus{self.bus}Writer', paths,
+                               [self.write_buffer] * len(paths), on_close, encoders)
+        writer.start()
+        write = writer.write
+        n_sensors = len(sensors)
+        try:
+            clock_start = scheduler.clock() + time_start - time.time()
+            clock_end = clock_start + duration if duration is not None else float('inf')
+            segment_end = float('inf')
+            if segment_duration is not None:
+                segment_end = clock_start + segment_duration
+            for i, sensor in enumerate(sensors):
+                sensor.reset_fifo()
+                sync_times[i] = read_times[i] = scheduler.clock()
+            scheduler.start()
+            live_publish = scheduler.clock() + LIVE_INTERVAL
+            finished = False
+            while not finished:
+                if end_time is not None:
+                    clock_end = min(clock_end, clock_start + end_time.value - time_start)
+                    wake_time = min(clock_end, scheduler.clock() + STOP_INTERVAL)
+                else:
+                    wake_time = clock_end
+                # Sleep until some FIFO is worth reading
+                due = scheduler.wait(min(wake_time, segment_end))
+                if scheduler.clock() >= clock_end:
+                    # Drain all sensors one last time
+                    finished = True
+                    due = [i for i in range(len(sensors)) if package_length[i] > 0]
+                for i in due:
+                    # Urgent FIFO is drained until it is safe again, reads stop
+                    # short before FIFOs which overflowed overflow again
+                    for _ in range(MAX_DRAINS):
+                        t = scheduler.clock()
+                        limit = MPU6050_FIFO_SIZE if finished \
+                            else max(scheduler.read_limit(i, t), package_length[i])
+                        fifo_count, length = sensors[i].drain_fifo_into(buffers[i], limit)
+                        t_read = scheduler.clock()
+                        scheduler.update(i, t, fifo_count, length, t_read - t)
+                        if fifo_count >= MPU6050_FIFO_SIZE:
+                            sensors[i].reset_fifo()
+                            t_reset = scheduler.clock()
+                            scheduler.restart(i, t_reset)
+                            expected = round((t_reset - sync_times[i]) * sample_rates[i])
+                            missing = max(expected - package_count[i] + sync_counts[i], 0)
+                            overflows[i].append([
+                                round(read_times[i] - clock_start, 3),
+                                round(t_reset - clock_start, 3),
+                                package_count[i], missing
+                            ])
+                            sync_times[i] = read_times[i] = t_reset
+                            sync_counts[i] = package_count[i]
+                            break
+                        read_times[i] = t
+                        if length:
+                            write(i, views[i][:length])
+                            package_count[i] += length // package_length[i]
+                            INDEX_STRUCT.pack_into(index_entry, 0, t - clock_start,
+                                                   package_count[i])
+                            write(n_sensors + i, index_entry)
+                            if live is not None:
+                                n = length // package_length[i]
+                                k = live_phases[i]
+                                while k < n:
+                                    start = k * package_length[i]
+                                    live_batches[i] += views[i][start:start + package_length[i]]
+                                    k += decimation
+                                live_phases[i] = k - n
+                        if finished or fifo_count - length >= limit \
+                                or not scheduler.is_urgent(i, t_read):
+                            break
+                if live is not None and (finished or scheduler.clock() >= live_publish):
+                    for i, batch in enumerate(live_batches):
+                        if batch:
+                            live(sensors[i].id, bytes(batch))
+                            batch.clear()
+                    live_publish = scheduler.clock() + LIVE_INTERVAL
+                if not finished and scheduler.clock() >= segment_end:
+                    # Reads are written whole, so segments split between packages
+                    segment += 1
+                    segment_end += segment_duration
+                    writer.rotate(*self.__files(segment))
+        finally:
+            try:
+                writer.close()
+            finally:
+                for view, buffer in zip(views, buffers):
+                    view.release()
+                    pool.release(buffer)
+        if self.mux_bus is not None:
+            switches = self.mux_bus.switches - switches
+        channel_info = {}
+        for i, channel in enumerate(channels):
+            info = channel_info.setdefault(
+                channel, {'sensors': [], 'mean_fill': 0.0, 'max_fill': 0.0}
+            )
+            info['sensors'].append(sensors[i].id)
+            if scheduler.polls[i]:
+                mean_fill = scheduler.fill_sums[i] / scheduler.polls[i]
+                info['mean_fill'] += mean_fill / MPU6050_FIFO_SIZE
+            info['max_fill'] = max(info['max_fill'],
+                                   scheduler.max_fills[i] / MPU6050_FIFO_SIZE)
+        for info in channel_info.values():
+            info['mean_fill'] = round(info['mean_fill'] / len(info['sensors']), 3)
+            info['max_fill'] = round(info['max_fill'], 3)
+        sensor_ids = [sensor.id for sensor in sensors]
+        buffers_info = writer.info()
+        write_buffers = {
+            sensor_id: {'data': buffers_info[i],
+                        'index': buffers_info[n_sensors + i]}
+            for i, sensor_id in enumerate(sensor_ids)
+        }
+        result = {
+            'n_packages': dict(zip(sensor_ids, package_count)),
+            'overflows': dict(zip(sensor_ids, overflows)),
+            'polls': dict(zip(sensor_ids, scheduler.polls)),
+            'empty_polls': dict(zip(sensor_ids, scheduler.empty_polls)),
+            'write_buffers': write_buffers,
+            'channels': channel_info,
+            'mux_switches': switches,
+            'segments': segment + 1 if segment is not None else 0
+        }
+        if self.profiler is not None:
+            result['i2c_profile'] = self.profiler.since(snapshot, self.bus)
+        return result
+
+
+def channel_name(sensor: MPU6050) -> str:
+    """Name of bus segment the sensor is connected to, e.g. B0M112C3"""
+    if sensor.mux_address is None:
+        return f'B{sensor.bus}'
+    return f'B{sensor.bus}M{sensor.mux_address}C{sensor.mux_channel}'
+
+
+def _run_in_thread(worker: BusWorker, time_start: float, duration: Optional[float],
+                   results: list, index: int):
+    try:
+        results[index] = worker.run(time_start, duration)
+    except Exception as e:
+        results[index] = e
+
+
+def _run_in_process(worker: BusWorker, start: Any, time_start: Any,
+                    duration: Optional[float], queue: multiprocessing.Queue,
+                    index: int):
+    try:
+        worker.reopen()
+        # Ready, wait for time_start
+        queue.put((index, None))
+        start.wait()
+        queue.put((index, worker.run(time_start.value, duration)))
+    except Exception as e:
+        queue.put((index, e))
+
+
+def _put_callback(queue: multiprocessing.Queue, index: int, name: str, *args):
+    queue.put((index, name, args))
+
+
+def _forward_callbacks(queue: multiprocessing.Queue,
+                       callbacks: List[Dict[str, Callable]]):
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        index, name, args = item
+        callbacks[index][name](*args)
+
+
+def start_forkserver():
+    """
+    Start forkserver of worker processes with acquisition modules loaded,
+    so sessions don't wait for it. Best called before other threads start.
+    """
+    multiprocessing.set_forkserver_preload(['__main__', __name__, 'imu_manager.buses'])
+    multiprocessing.forkserver.ensure_running()
+
+
+def run_workers(workers: List[BusWorker], duration: Optional[float],
+                mode: str = 'thread') -> Tuple[float, List[Dict[str, Any]]]:
+    """
+    Run workers in parallel threads or processes and
+    return session start time and their results. Error of any
+    worker is raised after all of them are finished.
+    I2C transactions release GIL, so threads are enough to keep
+    buses busy in parallel, processes also spread Python work
+    across cores. Callbacks of worker processes (see CALLBACKS)
+    are called in the parent process.
+    Worker processes are started by forkserver, since forking
+    the hub could copy locks held by its other threads, so
+    workers must be picklable (see BusWorker.reopen). Session
+    starts once all of them opened their sensors.
+    """
+    if mode not in WORKER_MODES:
+        raise ValueError(f'Unknown worker mode: {mode}')
+    results = [None] * len(workers)
+    if mode == 'thread':
+        time_start = time.time()
+        threads = [
+            threading.Thread(
+                target=_run_in_thread,
+                name=f'Bus{worker.bus}Worker',
+                args=(worker, time_start, duration, results, i)
+            )
+            for i, worker in enumerate(workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        context = multiprocessing.get_context('forkserver')
+        queue = context.Queue()
+        start = context.Event()
+        shared_time_start = context.RawValue('d', 0.0)
+        time_start = None
+        callbacks = [
+            {name: getattr(worker, name) for name in CALLBACKS}
+            for worker in workers
+        ]
+        callback_queue = context.Queue()
+        forwarder = threading.Thread(target=_forward_callbacks,
+                                     name='CallbackForwarder',
+                                     args=(callback_queue, callbacks))
+        forwarder.start()
+        for i, worker in enumerate(workers):
+            for name in CALLBACKS:
+                if getattr(worker, name) is not None:
+                    setattr(worker, name, functools.partial(
+                        _put_callback, callback_queue, i, name))
+        try:
+            processes = [
+                context.Process(
+                    target=_run_in_process,
+                    name=f'Bus{worker.bus}Worker',
+                    args=(worker, start, shared_time_start, duration, queue, i)
+                )
+                for i, worker in enumerate(workers)
+            ]
+            for process in processes:
+                process.start()
+            pending = set(range(len(processes)))
+            starting = set(pending)
+            while pending:
+                if not starting and time_start is None:
+                    time_start = time.time()
+                    shared_time_start.value = time_start
+                    start.set()
+                try:
+                    index, result = queue.get(timeout=WORKER_POLL)
+                except Empty:
+                    dead = [i for i in pending if not processes[i].is_alive()]
+                    if not dead:
+                        continue
+                    try:
+                        # Results are flushed before a process exits
+                        index, result = queue.get(timeout=WORKER_POLL)
+                    except Empty:
+                        # Killed, e.g. out of memory, before putting a result
+                        for i in dead:
+                            results[i] = RuntimeError(
+                                f'Bus {workers[i].bus} worker process died '
+                                f'with exit code {processes[i].exitcode}'
+                            )
+                            pending.discard(i)
+                            starting.discard(i)
+                        continue
+                starting.discard(index)
+                if result is not None:
+                    results[index] = result
+                    pending.discard(index)
+            for process in processes:
+                process.join()
+        finally:
+            # Workers still waiting for start must not be left behind
+            start.set()
+            for worker, worker_callbacks in zip(workers, callbacks):
+                for name, callback in worker_callbacks.items():
+                    setattr(worker, name, callback)
+            # Workers flushed their callback queue before exiting
+            callback_queue.put(None)
+            forwarder.join()
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return time_start, results
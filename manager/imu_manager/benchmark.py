@@ -0,0 +1,363 @@
+"""
+Acquisition throughput benchmark.
+Runs data collection sessions on emulated sensors with realistic bus timings
+and finds the highest aggregate sample rate the hub can sustain
+without FIFO overflows. Used to size hubs before deploying them.
+
+Example:
+    python -m imu_manager.benchmark --buses 0 1 --addresses 104 105
+"""
+
+import gc
+import os
+import time
+import logging
+import argparse
+import tempfile
+import tracemalloc
+from typing import Any, Dict, List
+
+import yaml
+
+from imu_manager.manager import Manager
+from imu_manager.acquisition import WORKER_MODES
+from imu_manager.encoding import ENCODINGS
+from imu_manager.tca9548a import TCA9548A_DEFAULT_ADDRESS
+from imu_manager.mpu6050 import i2c_interface
+from imu_manager.mpu6050.emulator import EmulatedBackend
+from imu_manager.upload import available_codecs, compressor, session_files
+from imu_manager.utils import BufferPool
+
+
+DEFAULT_DIVIDERS = [0, 1, 2, 3, 4, 7, 9, 19, 39, 99]
+
+
+class GCMonitor:
+    """Context manager counting garbage collections and time spent in them"""
+
+    def __init__(self):
+        self.collections = 0
+        self.pause = 0.0
+        self.__start = 0.0
+
+    def __callback(self, phase: str, info: dict):
+        if phase == 'start':
+            self.__start = time.perf_counter()
+        else:
+            self.collections += 1
+            self.pause += time.perf_counter() - self.__start
+
+    def __enter__(self):
+        gc.callbacks.append(self.__callback)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        gc.callbacks.remove(self.__callback)
+
+
+def _cpu_time() -> float:
+    # Includes finished process workers
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def run_session(manager: Manager, backend: EmulatedBackend,
+                duration: float) -> Dict[str, Any]:
+    """
+    Run single session on emulated sensors.
+    CPU time includes emulation overhead, which is small compared to
+    the manager itself, since emulated bus time is spent sleeping.
+    Process workers read their own copies of emulated sensors,
+    so lost packages are counted in thread mode only and
+    CPU time of workers is included via children times.
+    """
+    for sensor in manager.sensors.values():
+        sensor.reset_fifo()
+    for sensor in backend.sensors():
+        sensor.reset_statistics()
+    cpu_start = _cpu_time()
+    wall_start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp_dir, GCMonitor() as gc_monitor:
+        session_path = os.path.join(tmp_dir, 'benchmark')
+        session_info = manager.start_session(session_path, 'benchmark', duration)
+    wall_time = time.perf_counter() - wall_start
+    cpu_time = _cpu_time() - cpu_start
+    sample_rate = sum(
+        sensor_info['sample_rate']
+        for sensor_info in session_info['sensors'].values()
+    )
+    packages = sum(session_info['n_packages'].values())
+    overflows = sum(map(len, session_info['overflows'].values()))
+    polls = sum(session_info['polls'].values())
+    empty_polls = sum(session_info['empty_polls'].values())
+    mux_switches = sum(info['switches']
+                       for info in session_info['mux_switches'].values())
+    lost_packages = None
+    if manager.workers == 'thread':
+        lost_packages = int(sum(s.lost_packages for s in backend.sensors()))
+    return {
+        'sample_rate': sample_rate,
+        'throughput': packages / duration,
+        'packages': packages,
+        'overflows': overflows,
+        'lost_packages': lost_packages,
+        'polls': polls,
+        'empty_polls': empty_polls,
+        'mux_switches': mux_switches,
+        'cpu_time': cpu_time,
+        'cpu_load': cpu_time / wall_time,
+        'gc_collections': gc_monitor.collections,
+        'gc_pause': gc_monitor.pause,
+        'sustainable': overflows == 0 and not lost_packages
+    }
+
+
+def benchmark(buses: List[int], addresses: List[int], duration: float,
+              dividers: List[int] = DEFAULT_DIVIDERS,
+              dlpf_mode: int = i2c_interface.MPU6050_DLPF_BW_188,
+              accel_fifo_enabled: bool = True, gyro_axes: str = 'xyz',
+              latency: float = 0.0001, bus_frequency: int = 100000,
+              stop_at_sustainable: bool = True,
+              workers: str = 'thread',
+              mux_channels: int = 0,
+              encoding: str = 'none') -> Dict[str, Any]:
+    """
+    Sweep sample rate dividers from the highest sample rate to the lowest
+    and measure each of them with a separate session.
+    With mux_channels sensors are connected to that many channels
+    of a TCA9548A multiplexer on every bus instead of the buses directly.
+    Manager is a singleton, so benchmark can be run once per process.
+    """
+    # Every byte on wire takes 8 data bits and ACK bit
+    backend = EmulatedBackend(latency=latency, byte_time=9 / bus_frequency)
+    muxes = []
+    for bus in buses:
+        if mux_channels:
+            muxes.append((bus, TCA9548A_DEFAULT_ADDRESS, range(mux_channels)))
+        for address in addresses:
+            if not mux_channels:
+                backend.attach(bus, address)
+            for channel in range(mux_channels):
+                backend.attach(bus, address, mux_address=TCA9548A_DEFAULT_ADDRESS,
+                               mux_channel=channel)
+    manager = Manager('benchmark', buses, addresses, backend, workers, muxes,
+                      encoding=encoding)
+    if manager.bus_factory is not backend:
+        raise RuntimeError('Manager was already created in this process')
+    results = []
+    for rate in sorted(dividers):
+        manager.configure_sensors(
+            clock_source=i2c_interface.MPU6050_CLOCK_PLL_XGYRO,
+            dlpf_mode=dlpf_mode,
+            rate=rate,
+            full_scale_accel_range=i2c_interface.MPU6050_ACCEL_FS_2,
+            full_scale_gyro_range=i2c_interface.MPU6050_GYRO_FS_250,
+            accel_fifo_enabled=accel_fifo_enabled,
+            x_gyro_fifo_enabled='x' in gyro_axes,
+            y_gyro_fifo_enabled='y' in gyro_axes,
+            z_gyro_fifo_enabled='z' in gyro_axes
+        )
+        result = run_session(manager, backend, duration)
+        result['rate'] = rate
+        results.append(result)
+        print(format_result(result), flush=True)
+        if result['sustainable'] and stop_at_sustainable:
+            break
+    sustainable = [r['sample_rate'] for r in results if r['sustainable']]
+    return {
+        'sensors': len(manager.sensors),
+        'buses': buses,
+        'duration': duration,
+        'latency': latency,
+        'bus_frequency': bus_frequency,
+        'workers': workers,
+        'mux_channels': mux_channels,
+        'encoding': encoding,
+        'max_sustainable_sample_rate': max(sustainable, default=0),
+        'results': results
+    }
+
+
+def allocation_benchmark(reads: int, length: int = 24, bus: int = 0,
+                         address: int = i2c_interface.MPU6050_DEFAULT_ADDRESS,
+                         hardware: bool = False) -> Dict[str, Any]:
+    """
+    Compare FIFO read paths from bus to file on a single sensor:
+    SMBus block read to list copied to bytes (legacy), I2C_RDWR burst
+    to new bytes and I2C_RDWR burst into pooled buffer.
+    Emulated I2C_RDWR is much more expensive than real ioctl,
+    run with hardware=True on the hub to get representative CPU times.
+    """
+    bus_factory = None
+    if not hardware:
+        bus_factory = EmulatedBackend()
+        bus_factory.attach(bus, address)
+    mpu6050 = i2c_interface.MPU6050_I2C(bus, address, bus_factory)
+    pool = BufferPool(i2c_interface.MPU6050_FIFO_SIZE, 1)
+    buffer = pool.acquire()
+    view = memoryview(buffer)
+
+    def smbus_list(f):
+        f.write(bytes(mpu6050.get_fifo_bytes(length)))
+
+    def rdwr_bytes(f):
+        f.write(mpu6050.read_fifo(length))
+
+    def pooled_buffer(f):
+        mpu6050.read_fifo_into(buffer, length)
+        f.write(view[:length])
+
+    results = {}
+    with open(os.devnull, 'wb') as f:
+        for name, read in [('smbus_list', smbus_list),
+                           ('rdwr_bytes', rdwr_bytes),
+                           ('pooled_buffer', pooled_buffer)]:
+            read(f)
+            with GCMonitor() as gc_monitor:
+                # Reads run in this process, children times don't belong here
+                cpu_start = time.process_time()
+                for _ in range(reads):
+                    read(f)
+                cpu_time = time.process_time() - cpu_start
+            # Tracing slows reads down, so memory is measured separately
+            tracemalloc.start()
+            for _ in range(min(reads, 1000)):
+                read(f)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[name] = {
+                'cpu_time_per_read': cpu_time / reads,
+                'gc_collections': gc_monitor.collections,
+                'gc_pause': gc_monitor.pause,
+                'peak_memory': peak
+            }
+    view.release()
+    pool.release(buffer)
+    return results
+
+
+def codec_benchmark(path: str, chunk_size: int = 1 << 16) -> Dict[str, Any]:
+    """
+    Compress all files under path (e.g. a recorded session)
+    with every available upload codec. Real sensor data compresses
+    much better than emulated noise, run it on recorded sessions.
+    """
+    results = {}
+    for codec in available_codecs():
+        codec_compressor = compressor(codec)
+        raw_bytes, packed_bytes = 0, 0
+        cpu_start = time.process_time()
+        for file_path, _ in session_files(path):
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    raw_bytes += len(chunk)
+                    packed_bytes += len(codec_compressor.compress(chunk))
+        packed_bytes += len(codec_compressor.flush())
+        cpu_time = time.process_time() - cpu_start
+        results[codec] = {
+            'raw_bytes': raw_bytes,
+            'packed_bytes': packed_bytes,
+            'ratio': raw_bytes / packed_bytes if packed_bytes else 0.0,
+            'cpu_time': cpu_time,
+            'throughput': raw_bytes / cpu_time if cpu_time else float('inf')
+        }
+    return results
+
+
+def format_result(result: Dict[str, Any]) -> str:
+    return (
+        'divider {rate:>3}: {sample_rate:>8.1f} Hz total, '
+        '{throughput:>8.1f} packages/s read, '
+        '{overflows:>5} overflows, {lost_packages!s:>7} lost packages, '
+        '{polls:>6} polls ({empty_polls} empty), '
+        '{mux_switches} mux switches, '
+        'CPU {cpu_time:.2f} s ({cpu_load:.0%}), '
+        '{gc_collections} GC runs ({gc_pause:.3f} s)'
+    ).format(**result)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m imu_manager.benchmark',
+        description='Acquisition throughput benchmark on emulated sensors'
+    )
+    parser.add_argument('--buses', type=int, nargs='+', default=[0, 1])
+    parser.add_argument('--addresses', type=int, nargs='+', default=[104, 105])
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help='duration of each session in seconds')
+    parser.add_argument('--dividers', type=int, nargs='+',
+                        default=DEFAULT_DIVIDERS,
+                        help='sample rate dividers to try')
+    parser.add_argument('--dlpf-mode', type=int,
+                        default=i2c_interface.MPU6050_DLPF_BW_188)
+    parser.add_argument('--accel', action=argparse.BooleanOptionalAction,
+                        default=True, help='write accelerometer to FIFO')
+    parser.add_argument('--gyro-axes', default='xyz',
+                        help='gyroscope axes written to FIFO')
+    parser.add_argument('--latency', type=float, default=0.0001,
+                        help='fixed cost of a bus transaction in seconds')
+    parser.add_argument('--bus-frequency', type=int, default=100000,
+                        help='I2C clock frequency in Hz')
+    parser.add_argument('--workers', choices=WORKER_MODES, default='thread',
+                        help='run bus workers in threads or processes')
+    parser.add_argument('--encoding', choices=list(ENCODINGS), default='none',
+                        help='encoding of session data files')
+    parser.add_argument('--mux-channels', type=int, default=0,
+                        help=('connect sensors to this many channels of '
+                              'a TCA9548A multiplexer on every bus'))
+    parser.add_argument('--all', action='store_true',
+                        help='do not stop at the first sustainable divider')
+    parser.add_argument('--allocations', type=int, metavar='READS',
+                        help='compare allocations of FIFO read paths instead')
+    parser.add_argument('--hardware', action='store_true',
+                        help=('compare allocations on the real sensor at '
+                              'the first of --buses and --addresses'))
+    parser.add_argument('--codecs', metavar='PATH',
+                        help=('compare upload codecs on files under PATH, '
+                              'e.g. a recorded session, instead'))
+    parser.add_argument('--output', help='save results to yaml file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.codecs:
+        report = codec_benchmark(args.codecs)
+        for codec, result in report.items():
+            print((
+                '{codec:>7}: {raw_bytes} B packed to {packed_bytes} B '
+                '(ratio {ratio:.2f}), {mb_per_s:.1f} MB/s CPU'
+            ).format(codec=codec, mb_per_s=result['throughput'] / 1e6, **result))
+        if args.output:
+            with open(args.output, 'w') as f:
+                yaml.dump(report, f, sort_keys=False)
+        return
+    if args.allocations:
+        report = allocation_benchmark(
+            args.allocations, bus=args.buses[0], address=args.addresses[0],
+            hardware=args.hardware
+        )
+        for name, result in report.items():
+            print((
+                '{name:>13}: {cpu:.1f} us CPU per read, '
+                '{gc_collections} GC runs ({gc_pause:.3f} s), '
+                'peak traced memory {peak_memory} B'
+            ).format(name=name, cpu=result['cpu_time_per_read'] * 1e6, **result))
+        if args.output:
+            with open(args.output, 'w') as f:
+                yaml.dump(report, f, sort_keys=False)
+        return
+    report = benchmark(
+        args.buses, args.addresses, args.duration, args.dividers,
+        args.dlpf_mode, args.accel, args.gyro_axes,
+        args.latency, args.bus_frequency, not args.all, args.workers,
+        args.mux_channels, args.encoding
+    )
+    print('Sensors: {}, max sustainable sample rate: {:.1f} Hz'.format(
+        report['sensors'], report['max_sustainable_sample_rate']
+    ))
+    if args.output:
+        with open(args.output, 'w') as f:
+            yaml.dump(report, f, sort_keys=False)
+
+
+if __name__ == '__main__':
+    main()
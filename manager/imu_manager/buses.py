@@ -0,0 +1,111 @@
+"""
+Shared handles of I2C buses.
+All sensors of a bus share one SMBus handle, sensors behind multiplexers
+select their channel of the bus with MuxChannel handles.
+"""
+
+import smbus2 as smbus
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from imu_manager.mpu6050.mpu6050 import MPU6050
+from imu_manager.profiler import I2CProfiler, ProfiledBus
+from imu_manager.tca9548a import MuxBus, MuxChannel
+
+
+class BusHandles:
+    """
+    Opens SMBus handles of buses with bus_factory (smbus2.SMBus by default)
+    and sensors on them.
+    Buses with TCA9548A multiplexers, given as (bus, mux address, channels)
+    triples, are wrapped in MuxBus. With profiler all transactions are
+    recorded to it under names of sensors of device_id.
+    Pickled without opened handles, so worker processes can open
+    the buses again with open. bus_factory must be picklable then.
+    """
+
+    def __init__(self, device_id: str,
+                 bus_factory: Callable[[int], Any] = None,
+                 muxes: List[Tuple[int, int, List[int]]] = (),
+                 profiler: Optional[I2CProfiler] = None):
+        self.device_id = device_id
+        self.bus_factory = bus_factory
+        self.muxes = [(bus, mux_address, list(channels))
+                      for bus, mux_address, channels in muxes]
+        self.profiler = profiler
+        self.open()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {
+            'device_id': self.device_id,
+            'bus_factory': self.bus_factory,
+            'muxes': self.muxes,
+            'profiler': self.profiler
+        }
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__dict__.update(state)
+        self.mux_buses = {}
+        self.__handles = {}
+        self.__channels = {}
+
+    def open(self):
+        """Forget opened handles and open buses with multiplexers"""
+        self.mux_buses = {}
+        self.__handles = {}
+        self.__channels = {}
+        for bus, mux_address, _ in self.muxes:
+            if bus not in self.mux_buses:
+                mux_addresses = [m for b, m, _ in self.muxes if b == bus]
+                self.mux_buses[bus] = MuxBus(self.handle(bus), mux_addresses)
+
+    def handle(self, bus: int) -> Any:
+        """SMBus handle shared by all sensors of the bus"""
+        if bus not in self.__handles:
+            factory = self.bus_factory if self.bus_factory is not None else smbus.SMBus
+            handle = factory(bus)
+            if self.profiler is not None:
+                handle = ProfiledBus(
+                    handle, self.profiler, bus,
+                    lambda address: self.__profiled_device(bus, address)
+                )
+            self.__handles[bus] = handle
+        return self.__handles[bus]
+
+    def sensor_handle(self, bus: int, mux_address: int = None,
+                      mux_channel: int = None) -> Any:
+        """Handle of sensor location, sensors of buses with muxes must select their channel"""
+        if bus not in self.mux_buses:
+            return self.handle(bus)
+        key = (bus, mux_address, mux_channel)
+        if key not in self.__channels:
+            self.__channels[key] = MuxChannel(self.mux_buses[bus],
+                                              mux_address, mux_channel)
+        return self.__channels[key]
+
+    def sensor_id(self, bus: int, address: int,
+                  mux_address: int = None, mux_channel: int = None) -> str:
+        if mux_address is None:
+            return f'{self.device_id}_B{bus}A{address}'
+        return f'{self.device_id}_B{bus}M{mux_address}C{mux_channel}A{address}'
+
+    def open_sensor(self, bus: int, address: int,
+                    mux_address: int = None, mux_channel: int = None) -> MPU6050:
+        """
+        Initialize sensor at location, its configuration is read from device.
+        Raises OSError if sensor doesn't answer.
+        """
+        handle = self.sensor_handle(bus, mux_address, mux_channel)
+        return MPU6050(self.sensor_id(bus, address, mux_address, mux_channel),
+                       bus, address, lambda _, h=handle: h,
+                       mux_address, mux_channel)
+
+    def __profiled_device(self, bus: int, address: int) -> str:
+        """Name of device at address, sensors behind muxes by selected channel"""
+        mux_bus = self.mux_buses.get(bus)
+        if mux_bus is None:
+            return self.sensor_id(bus, address)
+        if address in mux_bus.mux_addresses:
+            return f'{self.device_id}_B{bus}M{address}'
+        if mux_bus.selected is None:
+            return self.sensor_id(bus, address)
+        return self.sensor_id(bus, address, *mux_bus.selected)
@@ -1,16 +1,19 @@
+import os
+import time
 import yaml
-import shutil
-import requests
+import queue
+import threading
 import logging
 import traceback
 from enum import IntEnum
-from typing import Any, Callable, Dict, List
+from typing import Any, Callable, Dict, List, Tuple
 
 from paho.mqtt.client import Client as MQTTClient
 from paho.mqtt.client import MQTTMessage
 
 from imu_manager.manager import Manager
 from imu_manager.config import Config
+from imu_manager.upload import UPLOAD_RETRIES, StreamUpload, available_codecs, session_files
 from imu_manager.utils import Singleton, TempDir, CommandThread
 
 
@@ -23,6 +26,12 @@ class MessageType(IntEnum):
     DATA = 4
 
 
+# Commands run right in MQTT thread, so they work while a session is running
+IMMEDIATE_COMMANDS = ['stop_session']
+# Segment length of sessions without duration, if not configured
+SEGMENT_DURATION = 60
+
+
 class Client(metaclass=Singleton):
     """MQTT client for sensor manager"""
 
@@ -31,6 +40,18 @@ class Client(metaclass=Singleton):
         self.cfg = cfg
         self.manager = manager
         self.command_thread = command_thread
+        self.discovery_interval = getattr(cfg.i2c, 'discovery_interval', 5)
+        self.segment_duration = SEGMENT_DURATION
+        if hasattr(cfg, 'acquisition'):
+            self.segment_duration = getattr(cfg.acquisition, 'segment_duration',
+                                            SEGMENT_DURATION)
+        self.codec = getattr(cfg.server.file_server, 'codec', 'deflate')
+        if self.codec not in available_codecs():
+            logging.warning(f'Codec "{self.codec}" is not available, using deflate')
+            self.codec = 'deflate'
+        self.codec_level = getattr(cfg.server.file_server, 'level', None)
+        self.upload_retries = getattr(cfg.server.file_server, 'retries', UPLOAD_RETRIES)
+        self.request_timeout = getattr(cfg, 'request_timeout', 10)
         self.__client = MQTTClient(cfg.device_id)
         self.__client.on_connect = self.__on_connect
         self.__client.on_message = self.__on_message
@@ -95,7 +116,10 @@ class Client(metaclass=Singleton):
                 command = self.__getattribute__(command_name)
                 args = payload['args'] if 'args' in payload else {}
                 logging.info(f'Executing command: {payload["command"]}')
-                self.__run_manager_command(command, args)
+                if payload['command'] in IMMEDIATE_COMMANDS:
+                    self.__command_wrapper(command, args)
+                else:
+                    self.__run_manager_command(command, args)
             except AttributeError:
                 error = f'Invalid command: {payload["command"]}'
             except KeyError as e:
@@ -110,20 +134,10 @@ class Client(metaclass=Singleton):
     def __command_wrapper(self, command: Callable[[Dict], None], args: Dict):
         """
         Manager command wrapper.
-        Handles errors, actualizes list of connected sensors.
-        If new sensors are connected, loads their configurations.
+        Handles errors, forgets sensors the connection was lost with.
         """
         error, tb = None, None
         try:
-            previous_sensor_ids = self.manager.sensors.keys()
-            self.manager.update_sensors()
-            sensor_ids = self.manager.sensors.keys()
-            new_sensor_ids = set(sensor_ids) - set(previous_sensor_ids)
-            if new_sensor_ids:
-                self.__cmd_load_sensors_configurations(args={
-                    'sensor_ids': list(new_sensor_ids)
-                })
-                self.__cmd_get_connected_sensors(args={})
             command(args)
         except OSError as e:
             if e.errno == 6:
@@ -135,6 +149,8 @@ class Client(metaclass=Singleton):
                     error = 'Connection with sensors {} lost'.format(
                         ', '.join(map(lambda x: f'"{x}"', faulty_sensors))
                     )
+                    self.manager.remove_sensors(faulty_sensors)
+                    self.__cmd_get_connected_sensors(args={})
                 else:
                     error = 'Connection with sensors lost'
             else:
@@ -161,6 +177,40 @@ class Client(metaclass=Singleton):
         else:
             self.__publish(MessageType.ERROR, 'Manager is busy')
 
+    def __discover_sensors(self):
+        """
+        Look for newly connected or power-cycled sensors and
+        load their configurations.
+        Runs in discovery thread while no manager command is running.
+        """
+        try:
+            new_sensor_ids = self.manager.update_sensors()
+            if new_sensor_ids:
+                logging.info('Sensors connected or power-cycled: {}'.format(
+                    ', '.join(new_sensor_ids)
+                ))
+                self.__cmd_load_sensors_configurations(args={
+                    'sensor_ids': new_sensor_ids
+                })
+                self.__cmd_get_connected_sensors(args={})
+        except Exception as e:
+            logging.error(f'Error while discovering sensors: {e}')
+            logging.error(traceback.format_exc())
+
+    def __discovery_loop(self):
+        while True:
+            time.sleep(self.discovery_interval)
+            try:
+                # Blocks new commands only while probing
+                self.command_thread.run_command(
+                    command=self.__discover_sensors,
+                    args=(),
+                    sync=True
+                )
+            except RuntimeError:
+                # Manager is busy, try next time
+                pass
+
     def __filter_sensor_ids(self, sensor_ids: List[str]) -> List[str]:
         """Filter sensor ids to get only existing sensors"""
         if sensor_ids is None:
@@ -172,8 +222,30 @@ class Client(metaclass=Singleton):
             ))
             return sensor_ids
 
+    def __save_calibrations(self, sensor_ids: List[str],
+                            residuals: Dict[str, List[float]]):
+        """Save sensors offsets to config, so they are restored on boot"""
+        for sensor_id in sensor_ids:
+            settings = self.cfg.sensor_settings.setdefault(sensor_id, {})
+            settings['calibration'] = {
+                'offsets': self.manager.get_offsets(sensor_id),
+                'temperature': round(self.manager.get_temperature(sensor_id), 2),
+                'time': round(time.time(), 3)
+            }
+            if residuals.get(sensor_id) is not None:
+                settings['calibration']['residuals'] = [
+                    round(r, 3) for r in residuals[sensor_id]
+                ]
+        self.cfg.save()
+
     def run(self, async_: bool = False):
         """Run MQTT client"""
+        discovery_thread = threading.Thread(
+            target=self.__discovery_loop,
+            name='DiscoveryThread',
+            daemon=True
+        )
+        discovery_thread.start()
         if async_:
             self.__client.loop_start()
         else:
@@ -190,6 +262,8 @@ class Client(metaclass=Singleton):
                     'id': sensor.id,
                     'bus': sensor.bus,
                     'address': sensor.address,
+                    'mux_address': sensor.mux_address,
+                    'mux_channel': sensor.mux_channel
                 }
                 for sensor in self.manager.sensors.values()
             ]
@@ -204,7 +278,12 @@ class Client(metaclass=Singleton):
         sensor_ids = self.__filter_sensor_ids(args['sensor_ids'])
         for sensor_id, settings in self.cfg.sensor_settings.items():
             if sensor_id in self.manager.sensors and sensor_id in sensor_ids:
-                self.manager.configure_sensor(sensor_id, **settings)
+                settings = settings.copy()
+                calibration = settings.pop('calibration', None)
+                if settings:
+                    self.manager.configure_sensor(sensor_id, **settings)
+                if calibration is not None:
+                    self.manager.set_offsets(sensor_id, calibration['offsets'])
         self.__publish(MessageType.SUCCESS, 'Sensor configurations loaded')
 
     def __cmd_reset_sensors(self, args: Dict):
@@ -221,47 +300,227 @@ class Client(metaclass=Singleton):
         del args['sensor_ids']
         for sensor_id in sensor_ids:
             self.manager.configure_sensor(sensor_id, **args)
+            # Offset registers do not depend on configuration
+            settings = self.cfg.sensor_settings.get(sensor_id, {})
+            calibration = settings.get('calibration')
             self.cfg.sensor_settings[sensor_id] = args.copy()
+            if calibration is not None:
+                self.cfg.sensor_settings[sensor_id]['calibration'] = calibration
         self.cfg.save()
         self.__publish(MessageType.SUCCESS, 'Sensors configured')
 
     def __cmd_calibrate_sensors(self, args: Dict):
         sensor_ids = self.__filter_sensor_ids(args['sensor_ids'])
         del args['sensor_ids']
-        for sensor_id in sensor_ids:
-            self.manager.calibrate_sensor(sensor_id, **args)
+        reported = {}
+
+        def publish_progress(sensor_id: str, fraction: float):
+            # Progress is published in 10% steps
+            percent = int(fraction * 10) * 10
+            if reported.get(sensor_id) == percent:
+                return
+            reported[sensor_id] = percent
+            msg = {
+                'type': 'calibration_progress',
+                'data': {
+                    'device_id': self.cfg.device_id,
+                    'sensor_id': sensor_id,
+                    'progress': percent
+                }
+            }
+            self.__publish(MessageType.DATA, msg)
+
+        residuals = self.manager.calibrate_sensors(
+            **args, sensor_ids=sensor_ids, progress=publish_progress
+        )
+        self.__save_calibrations(sensor_ids, residuals)
+        for sensor_id, sensor_residuals in residuals.items():
+            if sensor_residuals is not None:
+                self.__publish(MessageType.INFO, 'Residuals of "{}": {}'.format(
+                    sensor_id, ', '.join(f'{r:.2f}' for r in sensor_residuals)
+                ))
         self.__publish(MessageType.SUCCESS, 'Sensors calibrated')
 
+    def __cmd_check_calibration(self, args: Dict):
+        """
+        Recalibrate only sensors which drifted from saved calibration
+        by more than threshold offset units on any axis.
+        The rest of args are passed to calibrate_sensors.
+        """
+        sensor_ids = self.__filter_sensor_ids(args['sensor_ids'])
+        threshold = args.pop('threshold')
+        drifted = []
+        for sensor_id in sensor_ids:
+            residuals = self.manager.get_calibration_residuals(
+                sensor_id, args['buffer_size']
+            )
+            if max(map(abs, residuals)) > threshold:
+                drifted.append(sensor_id)
+        if not drifted:
+            self.__publish(MessageType.SUCCESS, 'Sensor calibrations are valid')
+            return
+        self.__publish(MessageType.INFO, 'Recalibrating sensors {}'.format(
+            ', '.join(map(lambda x: f'"{x}"', drifted))
+        ))
+        args['sensor_ids'] = drifted
+        self.__cmd_calibrate_sensors(args)
+
+    def __cmd_get_i2c_profile(self, args: Dict):
+        msg = {
+            'type': 'i2c_profile',
+            'data': {
+                'device_id': self.cfg.device_id,
+                'profile': self.manager.get_i2c_profile(args.get('reset', False))
+            }
+        }
+        self.__publish(MessageType.DATA, msg)
+
+    def __cmd_plan_session(self, args: Dict) -> Dict:
+        """Publish predicted bus utilization and FIFO headroom"""
+        plan = self.manager.plan_session()
+        msg = {
+            'type': 'session_plan',
+            'data': {
+                'device_id': self.cfg.device_id,
+                'plan': plan
+            }
+        }
+        self.__publish(MessageType.DATA, msg)
+        return plan
+
+    def __start_live(self, session_name: str,
+                     decimation: int) -> Callable[[str, bytes], None]:
+        """
+        Publish metadata of live session, return callback publishing
+        raw packages of a sensor to its live topic.
+        """
+        topic = getattr(self.cfg.server.mqtt.topic, 'live', '/general/live')
+        msg = {
+            'type': 'live_session',
+            'data': {
+                'device_id': self.cfg.device_id,
+                'session_name': session_name,
+                'decimation': decimation,
+                'sensors': {
+                    sensor_id: self.manager.get_sensor_info(sensor_id)
+                    for sensor_id in self.manager.sensors
+                }
+            }
+        }
+        self.__publish(MessageType.DATA, msg)
+
+        def live(sensor_id: str, packages: bytes):
+            self.__client.publish(f'{topic}/{sensor_id}', packages)
+        return live
+
+    def __upload(self, session_name: str, part_name: str,
+                 files: List[Tuple[str, str]]) -> bool:
+        """
+        Stream files (path, name in archive) to file server as one
+        session part and announce it.
+        """
+        upload = StreamUpload(
+            url='http://{}:{}'.format(
+                self.cfg.server.ip,
+                self.cfg.server.file_server.port
+            ),
+            name=part_name, files=files,
+            codec=self.codec, level=self.codec_level,
+            retries=self.upload_retries
+        )
+        try:
+            response = upload.upload(timeout=self.request_timeout)
+        except Exception as e:
+            self.__publish(MessageType.ERROR, f'Error while uploading session: {e}')
+            return False
+        stats = upload.stats
+        logging.info('Uploaded {}: {} B packed to {} B ({}), {} B sent, {} retries, {} s'.format(
+            upload.file_name, stats['raw_bytes'], stats['packed_bytes'], stats['codec'],
+            stats['sent_bytes'], stats['retries'], stats['time']
+        ))
+        msg = {
+            'type': 'session_part',
+            'data': {
+                'session_name': session_name,
+                'file_name': response['filename'],
+                'url': response['url']
+            }
+        }
+        self.__publish(MessageType.DATA, msg)
+        return True
+
+    def __upload_segments(self, session_name: str, segments: queue.Queue):
+        """
+        Upload finished segments of running session until None is received.
+        Uploaded segments are removed from the hub.
+        """
+        while True:
+            item = segments.get()
+            if item is None:
+                break
+            segment, paths = item
+            part_name = f'{session_name}_{self.cfg.device_id}_{segment:04d}'
+            files = [(path, os.path.join('raw_data', os.path.basename(path)))
+                     for path in paths]
+            try:
+                if self.__upload(session_name, part_name, files):
+                    for path in paths:
+                        os.remove(path)
+            except Exception as e:
+                error = f'Error while uploading segment {segment}: {e}'
+                self.__publish(MessageType.ERROR, error, traceback.format_exc())
+
+    def __cmd_stop_session(self, args: Dict):
+        self.manager.stop_session()
+        self.__publish(MessageType.INFO, 'Stopping session')
+
     def __cmd_start_session(self, args: Dict):
         session_name = args['session_name']
         duration = args['duration']
+        # Sessions predicted to overflow are refused unless forced
+        plan = self.__cmd_plan_session(args={})
+        if plan['verdict'] == 'error' and not args.get('force', False):
+            error = 'Session "{}" refused: {}'.format(
+                session_name, '; '.join(plan['messages'])
+            )
+            self.__publish(MessageType.ERROR, error)
+            return
+        if plan['verdict'] != 'ok':
+            self.__publish(MessageType.WARNING, '; '.join(plan['messages']))
+        # Every live_decimation-th package is streamed, 0 disables it
+        live_decimation = int(args.get('live_decimation', 0))
+        live = None
+        if live_decimation > 0:
+            live = self.__start_live(session_name, live_decimation)
+        segment_duration = args.get('segment_duration')
+        if duration is None and segment_duration is None:
+            # Sessions without duration are segmented to bound disk use
+            segment_duration = self.segment_duration
         session_path = session_name
-        archive_name = f'{session_name}_{self.cfg.device_id}'
-        archive_path = f'{archive_name}.zip'
-        with TempDir([session_path, archive_path]):
-            session_info = self.manager.start_session(session_path, session_name, duration)
-            shutil.make_archive(archive_name, 'zip', session_name)
-            with open(f'{archive_name}.zip', 'rb') as f:
-                response = requests.post(
-                    url='http://{}:{}/upload'.format(
-                        self.cfg.server.ip,
-                        self.cfg.server.file_server.port
-                    ),
-                    files={'file': f}
+        with TempDir(session_path):
+            segments, on_segment = None, None
+            if segment_duration is not None:
+                segments = queue.Queue()
+                uploader = threading.Thread(
+                    target=self.__upload_segments,
+                    name='SegmentUploader',
+                    args=(session_name, segments)
                 )
-                if response.status_code != 200:
-                    error = f'Error while uploading session: {response.status_code}'
-                    self.__publish(MessageType.ERROR, error)
-                else:
-                    msg = {
-                        'type': 'session_part',
-                        'data': {
-                            'session_name': session_name,
-                            'file_name': response.json()['filename'],
-                            'url': response.json()['url']
-                        }
-                    }
-                    self.__publish(MessageType.DATA, msg)
+                uploader.start()
+                on_segment = lambda segment, paths: segments.put((segment, paths))
+            try:
+                session_info = self.manager.start_session(
+                    session_path, session_name, duration,
+                    live, max(live_decimation, 1),
+                    segment_duration, on_segment
+                )
+            finally:
+                if segments is not None:
+                    segments.put(None)
+                    uploader.join()
+            # Segments which failed to upload are sent with metadata
+            self.__upload(session_name, f'{session_name}_{self.cfg.device_id}',
+                          session_files(session_path))
             overflow_encountered = False
             for overflows in session_info['overflows'].values():
                 if overflows:
@@ -0,0 +1,178 @@
+"""
+Self-describing binary session container.
+One file holds a session part of a sensor hub (or a merged session):
+a fixed header, device and sensor tables, and 8-byte aligned blocks of
+overflow gaps, timestamp index and raw FIFO packages of every sensor,
+followed by a JSON block with the remaining session info.
+All numbers are little-endian, packages keep FIFO byte order (big-endian
+int16), so blocks can be memory-mapped and used as they are.
+
+Layout:
+    HEADER   magic, version, number of devices and sensors, flags,
+             number of segments, duration, offset and length of info block
+    DEVICE   per device: ID, session start time (unix time)
+    SENSOR   per sensor: ID, device number, package length, FIFO content
+             flags, data encoding (see encoding module), sample rate,
+             accel and gyro factors, number of packages, crop,
+             offset and size of gaps, index and data blocks
+    blocks   GAP records, INDEX_FORMAT records and packages of every sensor
+    info     UTF-8 JSON object
+
+Segmented session parts have empty index and data blocks, their data is in
+raw_data segment files (see segments in info and INDEX_SUFFIX).
+"""
+
+import os
+import json
+import shutil
+import struct
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from imu_manager.acquisition import INDEX_STRUCT
+from imu_manager.encoding import ENCODINGS
+
+
+# Format constants are repeated in container module of the user client,
+# which doesn't depend on the sensor manager: change both together
+# (tests/test_container_format.py compares them)
+MAGIC = b'IMUSESS\x00'
+VERSION = 1
+# Directory of containers in session directory and their extension
+CONTAINER_DIR = 'containers'
+CONTAINER_EXT = '.imu'
+# Index file of a sensor is named by its ID with this suffix
+INDEX_SUFFIX = '.idx'
+ALIGNMENT = 8
+ID_LENGTH = 64
+HEADER = struct.Struct('<8sHHHHIdQQ4x')
+DEVICE = struct.Struct(f'<{ID_LENGTH}sd')
+SENSOR = struct.Struct(f'<{ID_LENGTH}sHHBB2xdddQqqQQQQQQ')
+# Overflow gap: start, end (seconds from session start), index, missing
+GAP = struct.Struct('<ddqq')
+# Header flags
+FLAG_MERGED = 1
+# FIFO content flags of sensors
+FIFO_ACCEL = 1
+FIFO_GYRO_X = 2
+FIFO_GYRO_Y = 4
+FIFO_GYRO_Z = 8
+
+# Block content: file paths (concatenated) or bytes-like objects
+Sources = Sequence[Union[str, bytes, memoryview]]
+
+
+def fifo_flags(sensor_info: Dict[str, Any]) -> int:
+    """FIFO content flags of sensor info"""
+    return (FIFO_ACCEL * bool(sensor_info['accel_fifo_enabled'])
+            | FIFO_GYRO_X * bool(sensor_info['x_gyro_fifo_enabled'])
+            | FIFO_GYRO_Y * bool(sensor_info['y_gyro_fifo_enabled'])
+            | FIFO_GYRO_Z * bool(sensor_info['z_gyro_fifo_enabled']))
+
+
+def _encode_id(id_: str) -> bytes:
+    encoded = id_.encode()
+    if len(encoded) > ID_LENGTH:
+        raise ValueError(f'ID is longer than {ID_LENGTH} bytes: {id_}')
+    return encoded
+
+
+def _align(f):
+    padding = -f.tell() % ALIGNMENT
+    if padding:
+        f.write(bytes(padding))
+
+
+def _write_block(f, sources: Sources) -> Tuple[int, int]:
+    """Write aligned block of sources, return its offset and size"""
+    _align(f)
+    offset = f.tell()
+    for source in sources:
+        if isinstance(source, str):
+            with open(source, 'rb') as source_file:
+                shutil.copyfileobj(source_file, f, 1 << 20)
+        else:
+            f.write(source)
+    return offset, f.tell() - offset
+
+
+def write_container(path: str, devices: List[Tuple[str, float]],
+                    sensors: List[Dict[str, Any]], info: Dict[str, Any],
+                    duration: float, segments: int = 0, flags: int = 0):
+    """
+    Write container to path, replacing it only once it is complete.
+    devices are (device ID, start time) pairs. sensors are dicts with
+    id, device (number in devices), package_length, fifo (flags),
+    encoding (number, 0 by default), sample_rate, accel_factor,
+    gyro_factor, n_packages, crop ([start, end] or None),
+    gaps ([start, end, index, missing] lists) and index and data sources.
+    """
+    tmp_path = f'{path}.part'
+    with open(tmp_path, 'wb') as f:
+        # Tables are written once offsets of blocks are known
+        f.seek(HEADER.size + DEVICE.size * len(devices) + SENSOR.size * len(sensors))
+        records = []
+        for sensor in sensors:
+            gaps_offset, _ = _write_block(f, [
+                GAP.pack(*gap) for gap in sensor['gaps']
+            ])
+            index_offset, index_size = _write_block(f, sensor['index'])
+            data_offset, data_size = _write_block(f, sensor['data'])
+            crop = sensor['crop'] or (-1, -1)
+            records.append(SENSOR.pack(
+                _encode_id(sensor['id']), sensor['device'],
+                sensor['package_length'], sensor['fifo'], sensor.get('encoding', 0),
+                sensor['sample_rate'], sensor['accel_factor'], sensor['gyro_factor'],
+                sensor['n_packages'], crop[0], crop[1],
+                gaps_offset, len(sensor['gaps']),
+                index_offset, index_size // INDEX_STRUCT.size,
+                data_offset, data_size
+            ))
+        info_offset, info_size = _write_block(f, [json.dumps(info).encode()])
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, len(devices), len(sensors), flags,
+                            segments, duration, info_offset, info_size))
+        for device_id, start in devices:
+            f.write(DEVICE.pack(_encode_id(device_id), start))
+        for record in records:
+            f.write(record)
+    os.replace(tmp_path, path)
+
+
+def container_path(session_path: str, name: str) -> str:
+    return os.path.join(session_path, CONTAINER_DIR, name + CONTAINER_EXT)
+
+
+def write_session_part(session_path: str, session_info: Dict[str, Any],
+                       data_paths: Optional[Dict[str, str]],
+                       index_paths: Optional[Dict[str, str]]) -> str:
+    """
+    Write session part of a sensor hub from its session info and raw
+    data and index files (None for segmented sessions), return its path.
+    """
+    sensors = []
+    encoding = ENCODINGS[session_info.get('encoding', 'none')]
+    for sensor_id, sensor_info in session_info['sensors'].items():
+        sensors.append({
+            'id': sensor_id,
+            'device': 0,
+            'package_length': sensor_info['package_length'],
+            'fifo': fifo_flags(sensor_info),
+            'encoding': encoding,
+            'sample_rate': sensor_info['sample_rate'],
+            'accel_factor': sensor_info['accel_factor'],
+            'gyro_factor': sensor_info['gyro_factor'],
+            'n_packages': session_info['n_packages'][sensor_id],
+            'crop': None,
+            'gaps': session_info['overflows'][sensor_id],
+            'index': [index_paths[sensor_id]] if index_paths else [],
+            'data': [data_paths[sensor_id]] if data_paths else []
+        })
+    # Everything else is diagnostics, tables above hold what decoding needs
+    info = {key: value for key, value in session_info.items()
+            if key not in ('time', 'files', 'index', 'n_packages', 'overflows', 'encoding')}
+    path = container_path(session_path, session_info['device_id'])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    segments = session_info.get('segments', {}).get('count', 0)
+    write_container(path, [(session_info['device_id'], session_info['time']['start'])],
+                    sensors, info, session_info['time']['duration'], segments)
+    return path
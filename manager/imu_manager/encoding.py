@@ -0,0 +1,108 @@
+"""
+Lossless compression of FIFO packages.
+Readings of every channel are delta-encoded in blocks of packages and
+the deltas are bit-packed with the smallest width fitting the block.
+Consecutive IMU readings are close, so most deltas take a few bits.
+Loops run in C-implemented builtins, so encoding is cheap enough for
+the writer thread of the hub, which has no numpy.
+
+Block:
+    BLOCK_HEADER    number of packages n
+    CHANNEL_HEADER  per channel: first reading, smallest delta, width in bits
+    per channel: n - 1 deltas minus the smallest one, in groups of 8
+    packed to width bytes, least significant bits first
+Blocks are independent, so encoded files concatenate like raw ones.
+"""
+
+import sys
+import array
+import struct
+import operator
+from itertools import repeat
+from typing import Any, List, Optional
+
+
+# Constants below are repeated in encoding module of the user client
+# and compared by tests/test_container_format.py
+# Package encodings, numbers are stored in session containers
+ENCODINGS = {'none': 0, 'delta': 1}
+# Packages in one block
+ENCODE_BLOCK = 256
+BLOCK_HEADER = struct.Struct('<I')
+CHANNEL_HEADER = struct.Struct('<hiB')
+
+
+def pack_bits(values: List[int], width: int) -> bytes:
+    """Pack non-negative values below 2 ** width, every 8 of them to width bytes"""
+    if width == 0:
+        return b''
+    values = values + [0] * (-len(values) % 8)
+    words = values[0::8]
+    for j in range(1, 8):
+        words = map(operator.or_, words,
+                    map(operator.lshift, values[j::8], repeat(j * width)))
+    return b''.join(map(int.to_bytes, words, repeat(width), repeat('little')))
+
+
+class DeltaEncoder:
+    """
+    Streaming encoder of packages of package_length bytes,
+    compress and flush work like those of zlib compressors.
+    """
+
+    def __init__(self, package_length: int, block: int = ENCODE_BLOCK):
+        if package_length <= 0 or package_length % 2:
+            raise ValueError(f'Invalid package length: {package_length}')
+        self.package_length = package_length
+        self.channels = package_length // 2
+        self.block_size = block * package_length
+        self.__buffer = bytearray()
+
+    def __encode(self, data: bytes) -> bytes:
+        readings = array.array('h', data)
+        if sys.byteorder == 'little':
+            # FIFO readings are big-endian
+            readings.byteswap()
+        n = len(readings) // self.channels
+        headers, bodies = [BLOCK_HEADER.pack(n)], []
+        for channel in range(self.channels):
+            values = readings[channel::self.channels]
+            deltas = list(map(operator.sub, values[1:], values[:-1]))
+            low = min(deltas, default=0)
+            width = (max(deltas, default=0) - low).bit_length()
+            headers.append(CHANNEL_HEADER.pack(values[0], low, width))
+            if low:
+                deltas = list(map(operator.sub, deltas, repeat(low)))
+            bodies.append(pack_bits(deltas, width))
+        return b''.join(headers + bodies)
+
+    def compress(self, data: Any) -> bytes:
+        """Encode every full block of buffered packages"""
+        self.__buffer += data
+        n_blocks = len(self.__buffer) // self.block_size
+        if n_blocks == 0:
+            return b''
+        size = n_blocks * self.block_size
+        blocks = bytes(self.__buffer[:size])
+        del self.__buffer[:size]
+        return b''.join(
+            self.__encode(blocks[start:start + self.block_size])
+            for start in range(0, size, self.block_size)
+        )
+
+    def flush(self) -> bytes:
+        """Encode the last, shorter block"""
+        if len(self.__buffer) % self.package_length:
+            raise ValueError('Encoded data ends within a package')
+        data = bytes(self.__buffer)
+        self.__buffer.clear()
+        return self.__encode(data) if data else b''
+
+
+def encoder(encoding: str, package_length: int) -> Optional[DeltaEncoder]:
+    """Encoder of data files, None if they are written as they are"""
+    if encoding not in ENCODINGS:
+        raise ValueError(f'Unknown encoding: {encoding}')
+    if encoding == 'none' or package_length == 0:
+        return None
+    return DeltaEncoder(package_length)
@@ -1,10 +1,18 @@
 import os
 import time
-import yaml
-from contextlib import ExitStack
-from typing import List
+import shutil
+import threading
+import multiprocessing
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from imu_manager.mpu6050.mpu6050 import MPU6050
+from imu_manager.mpu6050.i2c_interface import MPU6050_I2C
+from imu_manager.acquisition import BusWorker, run_workers, segment_path, start_forkserver, \
+    WORKER_MODES, INDEX_FORMAT, WRITE_BUFFER, SEGMENT_FORMAT, STOP_DELAY
+from imu_manager.container import INDEX_SUFFIX, write_session_part
+from imu_manager.encoding import ENCODINGS
+from imu_manager.buses import BusHandles
+from imu_manager.profiler import I2CProfiler
+from imu_manager.planner import measure_bus_cost, plan_bus, plan_verdict
 from imu_manager.utils import Singleton
 
 
@@ -12,28 +20,89 @@ class Manager(metaclass=Singleton):
     """
     Class that handles connections to sensors and provides high-level methods
     for working with them.
+    Sensors are connected directly to I2C buses or to channels of TCA9548A
+    multiplexers given as (bus, mux address, channels) triples.
+    With profile all bus transactions are recorded to profiler.
+    Session data is encoded with encoding (see encoding module).
     """
 
     def __init__(self, device_id: str,
-                 i2c_buses: List[int], i2c_addresses: List[int]):
+                 i2c_buses: List[int], i2c_addresses: List[int],
+                 bus_factory: Callable[[int], Any] = None,
+                 workers: str = 'thread',
+                 muxes: List[Tuple[int, int, List[int]]] = (),
+                 profile: bool = False,
+                 write_buffer: int = WRITE_BUFFER,
+                 encoding: str = 'none'):
+        if workers not in WORKER_MODES:
+            raise ValueError(f'Unknown worker mode: {workers}')
+        if encoding not in ENCODINGS:
+            raise ValueError(f'Unknown encoding: {encoding}')
+        if workers == 'process':
+            start_forkserver()
         self.device_id = device_id
         self.buses = i2c_buses
         self.addresses = i2c_addresses
+        self.bus_factory = bus_factory
+        self.workers = workers
+        self.muxes = [(bus, mux_address, list(channels))
+                      for bus, mux_address, channels in muxes]
+        self.profiler = I2CProfiler() if profile else None
+        self.write_buffer = write_buffer
+        self.encoding = encoding
+        # Shared end time of the running session
+        self.__end_time = None
+        self.bus_handles = BusHandles(device_id, bus_factory, self.muxes,
+                                      self.profiler)
+        self.mux_buses = self.bus_handles.mux_buses
         self.sensors = {}
         self.update_sensors()
 
-    def update_sensors(self):
-        """Update list of connected sensors"""
-        self.sensors = {}
-        for bus in self.buses:
-            for address in self.addresses:
+    def update_sensors(self) -> List[str]:
+        """
+        Look for newly connected sensors.
+        Unknown locations are probed with a single WHO_AM_I read.
+        Known sensors are kept unless they were power-cycled (see
+        MPU6050.was_reset), those are initialized again.
+        Returns IDs of new and initialized again sensors,
+        which need their configurations loaded.
+        """
+        locations = [(bus, address, None, None)
+                     for bus in self.buses for address in self.addresses]
+        for bus, mux_address, channels in self.muxes:
+            for channel in channels:
+                for address in self.addresses:
+                    locations.append((bus, address, mux_address, channel))
+        new_sensor_ids = []
+        for bus, address, mux_address, mux_channel in locations:
+            id_ = self.bus_handles.sensor_id(bus, address, mux_address, mux_channel)
+            if id_ in self.sensors:
                 try:
-                    id_ = f'{self.device_id}_B{bus}A{address}'
-                    sensor = MPU6050(id_, bus, address)
-                    if sensor.is_connected:
-                        self.sensors[sensor.id] = sensor
+                    if not self.sensors[id_].was_reset:
+                        continue
                 except OSError:
-                    pass
+                    # Disconnected, forgotten once a command fails on it
+                    continue
+            try:
+                handle = self.bus_handles.sensor_handle(bus, mux_address, mux_channel)
+            except OSError:
+                # Bus is not available
+                continue
+            if not MPU6050_I2C.probe(handle, address):
+                continue
+            try:
+                sensor = self.bus_handles.open_sensor(bus, address,
+                                                      mux_address, mux_channel)
+            except OSError:
+                continue
+            self.sensors[id_] = sensor
+            new_sensor_ids.append(id_)
+        return new_sensor_ids
+
+    def remove_sensors(self, sensor_ids: List[str]):
+        """Forget sensors, e.g. after connection with them was lost"""
+        for sensor_id in sensor_ids:
+            self.sensors.pop(sensor_id, None)
 
     def reset_sensor(self, sensor_id: str):
         """Reset sensor settings to minimal functional state"""
@@ -52,17 +121,16 @@ class Manager(metaclass=Singleton):
                            x_gyro_fifo_enabled: bool,
                            y_gyro_fifo_enabled: bool,
                            z_gyro_fifo_enabled: bool):
-        """Configure sensor"""
-        sensor = self.sensors[sensor_id]
-        sensor.clock_source = clock_source
-        sensor.dlpf_mode = dlpf_mode
-        sensor.rate = rate
-        sensor.full_scale_accel_range = full_scale_accel_range
-        sensor.full_scale_gyro_range = full_scale_gyro_range
-        sensor.accel_fifo_enabled = accel_fifo_enabled
-        sensor.x_gyro_fifo_enabled = x_gyro_fifo_enabled
-        sensor.y_gyro_fifo_enabled = y_gyro_fifo_enabled
-        sensor.z_gyro_fifo_enabled = z_gyro_fifo_enabled
+        """
+        Configure sensor.
+        Configuration is written with block writes and verified.
+        """
+        self.sensors[sensor_id].configure(
+            clock_source, dlpf_mode, rate,
+            full_scale_accel_range, full_scale_gyro_range,
+            accel_fifo_enabled,
+            x_gyro_fifo_enabled, y_gyro_fifo_enabled, z_gyro_fifo_enabled
+        )
 
     def configure_sensors(self, clock_source: int, dlpf_mode: int, rate: int,
                             full_scale_accel_range: int,
@@ -87,35 +155,170 @@ class Manager(metaclass=Singleton):
     def calibrate_sensor(self, sensor_id: str,
                          max_iters: int, rough_iters: int, buffer_size: int,
                          epsilon: float = 0.1, mu: float = 0.5,
-                         v_threshold: float = 0.05):
+                         v_threshold: float = 0.05,
+                         mode: str = 'sequential') -> Optional[List[float]]:
         """
         Calibrate sensor to make all measurements zero-centered.
         With one exception: accelerometer Z axis is calibrated to 1g.
+        Returns residuals in offset register units
+        if calibration mode measures them.
         """
-        self.sensors[sensor_id].calibrate(
+        sensor = self.sensors[sensor_id]
+        sensor.calibrate(
             max_iters, rough_iters, buffer_size,
-            epsilon, mu, v_threshold
+            epsilon, mu, v_threshold, mode
         )
+        return sensor.calibration_residuals
 
     def calibrate_sensors(self, max_iters: int, rough_iters: int,
                           buffer_size: int, epsilon: float = 0.1,
-                          mu: float = 0.5, v_threshold: float = 0.05):
-        """Calibrate all sensors"""
-        for sensor_id in self.sensors:
-            self.calibrate_sensor(
-                sensor_id, max_iters, rough_iters, buffer_size,
-                epsilon, mu, v_threshold
+                          mu: float = 0.5, v_threshold: float = 0.05,
+                          mode: str = 'sequential', sensor_ids: List[str] = None,
+                          progress: Callable[[str, float], None] = None
+                          ) -> Dict[str, Optional[List[float]]]:
+        """
+        Calibrate sensors (all by default) at the same time.
+        Every bus is calibrated in its own thread, calibrations of sensors
+        on the same bus are interleaved buffer by buffer.
+        progress(sensor_id, fraction) is called after every buffer.
+        Error on any bus is raised after all buses are finished.
+        Returns residuals of sensors, see calibrate_sensor.
+        """
+        if sensor_ids is None:
+            sensor_ids = list(self.sensors)
+        buses = {}
+        for sensor_id in sensor_ids:
+            sensor = self.sensors[sensor_id]
+            calibration = sensor.calibration(
+                max_iters, rough_iters, buffer_size,
+                epsilon, mu, v_threshold, mode
             )
+            buses.setdefault(sensor.bus, {})[sensor_id] = calibration
+        errors = []
+
+        def calibrate_bus(calibrations):
+            try:
+                while calibrations:
+                    for sensor_id, calibration in list(calibrations.items()):
+                        fraction = next(calibration, None)
+                        if fraction is None:
+                            del calibrations[sensor_id]
+                        elif progress is not None:
+                            progress(sensor_id, fraction)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=calibrate_bus, args=(calibrations,),
+                             name=f'Bus{bus}Calibration')
+            for bus, calibrations in buses.items()
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return {
+            sensor_id: self.sensors[sensor_id].calibration_residuals
+            for sensor_id in sensor_ids
+        }
+
+    def get_offsets(self, sensor_id: str) -> List[int]:
+        """Get sensor accelerometer and gyroscope x, y, z offsets"""
+        return self.sensors[sensor_id].get_offsets()
+
+    def set_offsets(self, sensor_id: str, offsets: List[int]):
+        """Restore offsets saved with get_offsets"""
+        self.sensors[sensor_id].set_offsets(offsets)
+
+    def get_calibration_residuals(self, sensor_id: str,
+                                  buffer_size: int) -> List[float]:
+        """
+        Measure how far sensor at rest drifted from calibration,
+        in offset register units per axis.
+        """
+        return self.sensors[sensor_id].get_calibration_residuals(buffer_size)
+
+    def plan_session(self) -> Dict[str, Any]:
+        """
+        Predict whether configured sensors can be read without overflows.
+        Transaction cost is measured on the first sensor of every bus.
+        Returns verdict ('ok', 'warning' or 'error'), explaining messages
+        and plan of every bus (see planner.plan_bus).
+        """
+        buses = {}
+        for sensor in self.sensors.values():
+            buses.setdefault(sensor.bus, []).append(sensor)
+        plans = {}
+        for bus, sensors in buses.items():
+            cost = measure_bus_cost(sensors[0])
+            plans[bus] = plan_bus(sensors, cost, bus in self.mux_buses)
+        plan = plan_verdict(plans)
+        plan['buses'] = plans
+        return plan
+
+    def get_i2c_profile(self, reset: bool = False) -> Dict[str, Any]:
+        """
+        Bus transactions recorded since start or last reset,
+        see profiler.I2CProfiler.export.
+        """
+        if self.profiler is None:
+            raise RuntimeError('I2C profiling is disabled')
+        profile = self.profiler.export()
+        if reset:
+            self.profiler.reset()
+        return profile
+
+    def get_sensor_info(self, sensor_id: str) -> Dict[str, Any]:
+        """Sensor configuration needed to decode its data"""
+        sensor = self.sensors[sensor_id]
+        return {
+            'clock_source': sensor.clock_source,
+            'dlpf_mode': sensor.dlpf_mode,
+            'rate': sensor.rate,
+            'sample_rate': sensor.sample_rate,
+            'full_scale_accel_range': sensor.full_scale_accel_range,
+            'full_scale_gyro_range': sensor.full_scale_gyro_range,
+            'accel_factor': sensor.accel_factor,
+            'gyro_factor': sensor.gyro_factor,
+            'accel_fifo_enabled': sensor.accel_fifo_enabled,
+            'x_gyro_fifo_enabled': sensor.x_gyro_fifo_enabled,
+            'y_gyro_fifo_enabled': sensor.y_gyro_fifo_enabled,
+            'z_gyro_fifo_enabled': sensor.z_gyro_fifo_enabled,
+            'package_length':  sensor.package_length,
+            'mux_address': sensor.mux_address,
+            'mux_channel': sensor.mux_channel
+        }
+
+    def stop_session(self):
+        """Stop running session, called from another thread"""
+        if self.__end_time is None:
+            raise RuntimeError('No session is running')
+        self.__end_time.value = min(self.__end_time.value, time.time() + STOP_DELAY)
 
     def start_session(self, session_path: str, session_name: str,
-                      duration: float) -> dict:
-        """Start data collection session"""
-        metadata_path = os.path.join(session_path, 'metadata')
+                      duration: Optional[float],
+                      live: Callable[[str, bytes], None] = None,
+                      live_decimation: int = 1,
+                      segment_duration: Optional[float] = None,
+                      on_segment: Callable[[int, List[str]], None] = None) -> dict:
+        """
+        Start data collection session.
+        Raw files are packed to a session container (see container module)
+        once the session is over.
+        Session without duration runs until stop_session is called.
+        With live, every live_decimation-th package of every sensor
+        is passed to live(sensor_id, packages) during the session.
+        With segment_duration, raw files are split to segments and
+        on_segment(segment, paths) is called with paths of all files
+        of a segment once they are written, while the session goes on.
+        Container of a segmented session holds no data, segments
+        which are left are sent with it.
+        """
         raw_data_path = os.path.join(session_path, 'raw_data')
         if not os.path.isdir(session_path):
             os.mkdir(session_path)
-        if not os.path.isdir(metadata_path):
-            os.mkdir(metadata_path)
         if not os.path.isdir(raw_data_path):
             os.mkdir(raw_data_path)
 
@@ -127,63 +330,108 @@ class Manager(metaclass=Singleton):
             'duration': duration
         }
         session_info['sensors'] = {}
-        session_info['overflows'] = {}
+        session_info['encoding'] = self.encoding
         session_info['files'] = {}
-        for sensor_id, sensor in self.sensors.items():
-            session_info['sensors'][sensor_id] = {
-                'clock_source': sensor.clock_source,
-                'dlpf_mode': sensor.dlpf_mode,
-                'rate': sensor.rate,
-                'sample_rate': sensor.sample_rate,
-                'full_scale_accel_range': sensor.full_scale_accel_range,
-                'full_scale_gyro_range': sensor.full_scale_gyro_range,
-                'accel_factor': sensor.accel_factor,
-                'gyro_factor': sensor.gyro_factor,
-                'accel_fifo_enabled': sensor.accel_fifo_enabled,
-                'x_gyro_fifo_enabled': sensor.x_gyro_fifo_enabled,
-                'y_gyro_fifo_enabled': sensor.y_gyro_fifo_enabled,
-                'z_gyro_fifo_enabled': sensor.z_gyro_fifo_enabled,
-                'package_length':  sensor.package_length
-            }
-            session_info['overflows'][sensor_id] = []
+        session_info['index'] = {'format': INDEX_FORMAT, 'files': {}}
+        for sensor_id in self.sensors:
+            session_info['sensors'][sensor_id] = self.get_sensor_info(sensor_id)
             session_info['files'][sensor_id] = f'{sensor_id}'
+            session_info['index']['files'][sensor_id] = f'{sensor_id}{INDEX_SUFFIX}'
 
-        package_length = []
-        packages_per_read = []
-        package_count = []
-        for sensor in self.sensors.values():
-            package_length.append(sensor.package_length)
-            if sensor.package_length != 0:
-                packages_per_read.append(32 // sensor.package_length)
-            else:
-                packages_per_read.append(0)
-            package_count.append(0)
-
-        with ExitStack() as stack:
-            files = []
-            for fname in session_info['files'].values():
-                fpath = os.path.join(raw_data_path, fname)
-                files.append(stack.enter_context(open(fpath, 'wb')))
-            time_start = time.time()
-            for sensor in self.sensors.values():
-                sensor.reset_fifo()
-            while time.time() - time_start < duration:
-                for i, sensor in enumerate(self.sensors.values()):
-                    if package_length[i] > 0:
-                        fifo_count = sensor.get_fifo_count()
-                        if fifo_count == 1024:
-                            session_info['overflows'][sensor.id].append(time.time() - time_start)
-                        if fifo_count > package_length[i] * packages_per_read[i]:
-                            package = sensor.get_fifo_bytes(package_length[i] * packages_per_read[i])
-                            files[i].write(bytes(package))
-                            package_count[i] += packages_per_read[i]
+        # Segment is done once writers of all buses closed its files
+        bus_paths = {}
+        done_buses = {}
+        segment_lock = threading.Lock()
+
+        def on_bus_segment(bus: int, segment: int):
+            with segment_lock:
+                buses = done_buses.setdefault(segment, set())
+                buses.add(bus)
+                if len(buses) < len(bus_paths):
+                    return
+                del done_buses[segment]
+            if on_segment is not None:
+                on_segment(segment, [segment_path(path, segment)
+                                     for bus in sorted(bus_paths)
+                                     for path in bus_paths[bus]])
+
+        # Shared with worker processes, so stop_session reaches them
+        end_time = multiprocessing.RawValue('d', float('inf'))
+        self.__end_time = end_time
+        # Every bus is served by its own worker, so buses are read in parallel
+        workers = []
+        for bus in sorted({sensor.bus for sensor in self.sensors.values()}):
+            sensors = [s for s in self.sensors.values() if s.bus == bus]
+            file_paths = [
+                os.path.join(raw_data_path, session_info['files'][sensor.id])
+                for sensor in sensors
+            ]
+            index_paths = [
+                os.path.join(raw_data_path, session_info['index']['files'][sensor.id])
+                for sensor in sensors
+            ]
+            bus_paths[bus] = file_paths + index_paths
+            workers.append(BusWorker(bus, sensors, file_paths, index_paths,
+                                     self.mux_buses.get(bus), self.profiler,
+                                     live, live_decimation, self.write_buffer,
+                                     segment_duration, on_bus_segment,
+                                     end_time, self.encoding, self.bus_handles))
+        try:
+            time_start, results = run_workers(workers, duration, self.workers)
+        finally:
+            self.__end_time = None
+            # Channels might have been switched by worker processes
+            for mux_bus in self.mux_buses.values():
+                mux_bus.invalidate()
 
         session_info['time']['start'] = time_start
-        session_info['n_packages'] = dict(zip(list(self.sensors.keys()), package_count))
-        session_info_path = os.path.join(
-            metadata_path,
-            f'{self.device_id}_session_info.yml'
-        )
-        with open(session_info_path, 'w') as f:
-            yaml.dump(session_info, f, sort_keys=False)
+        if duration is None or end_time.value - time_start < duration:
+            # Stopped session
+            duration = round(end_time.value - time_start, 3)
+            session_info['time']['duration'] = duration
+        if segment_duration is not None:
+            session_info['segments'] = {
+                'format': SEGMENT_FORMAT,
+                'duration': segment_duration,
+                'count': max(result['segments'] for result in results)
+            }
+        for key in ['n_packages', 'overflows', 'polls', 'empty_polls',
+                    'write_buffers']:
+            merged = {}
+            for result in results:
+                merged.update(result[key])
+            session_info[key] = {
+                sensor_id: merged[sensor_id] for sensor_id in self.sensors
+            }
+        session_info['channels'] = {}
+        session_info['mux_switches'] = {}
+        for worker, result in zip(workers, results):
+            session_info['channels'].update(result['channels'])
+            if worker.mux_bus is not None:
+                session_info['mux_switches'][worker.bus] = {
+                    'switches': result['mux_switches'],
+                    # Session stopped right away has no measurable duration
+                    'switch_rate': round(result['mux_switches'] / duration, 1)
+                    if duration else 0.0
+                }
+        if self.profiler is not None:
+            session_records = {}
+            for result in results:
+                session_records.update(result['i2c_profile'])
+            if self.workers == 'process':
+                self.profiler.merge(session_records)
+            session_info['i2c_profile'] = self.profiler.export(session_records)
+        data_paths, index_paths = None, None
+        if segment_duration is None:
+            data_paths = {
+                sensor_id: os.path.join(raw_data_path, file_name)
+                for sensor_id, file_name in session_info['files'].items()
+            }
+            index_paths = {
+                sensor_id: os.path.join(raw_data_path, file_name)
+                for sensor_id, file_name in session_info['index']['files'].items()
+            }
+        write_session_part(session_path, session_info, data_paths, index_paths)
+        if segment_duration is None:
+            shutil.rmtree(raw_data_path)
         return session_info
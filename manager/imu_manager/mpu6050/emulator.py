@@ -0,0 +1,499 @@
+"""
+Emulated MPU-6050 sensors and SMBus backend.
+Allows to run and benchmark sensor manager without real hardware.
+"""
+
+import ctypes
+import errno
+import os
+import random
+import struct
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+from imu_manager.mpu6050 import i2c_interface as mpu
+
+
+FIFO_SIZE = 1024
+SMBUS_BLOCK_MAX = 32
+I2C_M_RD = 0x0001
+PATTERN_SAMPLES = 1024
+
+# Registers which change the way FIFO is filled
+_SAMPLING_REGISTERS = {
+    mpu.MPU6050_RA_SMPLRT_DIV,
+    mpu.MPU6050_RA_CONFIG,
+    mpu.MPU6050_RA_GYRO_CONFIG,
+    mpu.MPU6050_RA_ACCEL_CONFIG,
+    mpu.MPU6050_RA_FIFO_EN,
+    mpu.MPU6050_RA_USER_CTRL,
+    mpu.MPU6050_RA_PWR_MGMT_1,
+    mpu.MPU6050_RA_XA_OFFS_H,
+    mpu.MPU6050_RA_XA_OFFS_L_TC,
+    mpu.MPU6050_RA_YA_OFFS_H,
+    mpu.MPU6050_RA_YA_OFFS_L_TC,
+    mpu.MPU6050_RA_ZA_OFFS_H,
+    mpu.MPU6050_RA_ZA_OFFS_L_TC,
+    mpu.MPU6050_RA_XG_OFFS_USRH,
+    mpu.MPU6050_RA_XG_OFFS_USRL,
+    mpu.MPU6050_RA_YG_OFFS_USRH,
+    mpu.MPU6050_RA_YG_OFFS_USRL,
+    mpu.MPU6050_RA_ZG_OFFS_USRH,
+    mpu.MPU6050_RA_ZG_OFFS_USRL,
+}
+
+
+class EmulatedMPU6050:
+    """
+    Register level model of MPU-6050.
+    Models register file, 1024-byte FIFO filling at configured sample rate,
+    FIFO_COUNT registers, FIFO overflow and offset registers.
+    Sensor is assumed to lie still on a flat surface.
+    """
+
+    def __init__(self, seed: Optional[int] = None,
+                 accel_bias: float = 0.05, gyro_bias: float = 2.0,
+                 accel_noise: float = 0.004, gyro_noise: float = 0.05,
+                 clock: Callable[[], float] = time.perf_counter):
+        self._random = random.Random(seed)
+        self._clock = clock
+        self.accel_noise = accel_noise
+        self.gyro_noise = gyro_noise
+        # Physical bias of the sensor in g and deg/s
+        self.accel_bias = [self._random.uniform(-accel_bias, accel_bias)
+                           for _ in range(3)]
+        self.gyro_bias = [self._random.uniform(-gyro_bias, gyro_bias)
+                          for _ in range(3)]
+        self.temperature = 25.0
+        self.overflows = 0
+        self.lost_packages = 0
+        self.samples_generated = 0
+        self._overflowed = False
+        self._registers = bytearray(128)
+        self._fifo = bytearray()
+        self._pattern = b''
+        self._pattern_pos = 0
+        self._package_length = 0
+        self._sample_period = 0.0
+        self._next_sample_time = 0.0
+        self._sampling = False
+        self.power_on_reset()
+
+    def reset_statistics(self):
+        """Reset overflow and generated samples counters"""
+        self.advance()
+        self.overflows = 0
+        self.lost_packages = 0
+        self.samples_generated = 0
+
+    def power_on_reset(self):
+        """Restore power on register values and clear FIFO"""
+        self._registers[:] = bytes(len(self._registers))
+        self._registers[mpu.MPU6050_RA_PWR_MGMT_1] = 0x40
+        self._registers[mpu.MPU6050_RA_WHO_AM_I] = 0x68
+        self._fifo.clear()
+        self._overflowed = False
+        self._update_sampling()
+
+    @property
+    def sample_rate(self) -> float:
+        dlpf = self._registers[mpu.MPU6050_RA_CONFIG] & 0x07
+        if dlpf in (mpu.MPU6050_DLPF_BW_256, 7):
+            gyro_output_rate = mpu.MPU6050_DEFAULT_GYRO_OUTPUT_RATE
+        else:
+            gyro_output_rate = mpu.MPU6050_DLPF_GYRO_OUTPUT_RATE
+        return gyro_output_rate / (1 + self._registers[mpu.MPU6050_RA_SMPLRT_DIV])
+
+    @property
+    def package_length(self) -> int:
+        fifo_en = self._registers[mpu.MPU6050_RA_FIFO_EN]
+        length = 0
+        if fifo_en & (1 << mpu.MPU6050_ACCEL_FIFO_EN_BIT):
+            length += 6
+        for bit in (mpu.MPU6050_TEMP_FIFO_EN_BIT, mpu.MPU6050_XG_FIFO_EN_BIT,
+                    mpu.MPU6050_YG_FIFO_EN_BIT, mpu.MPU6050_ZG_FIFO_EN_BIT):
+            if fifo_en & (1 << bit):
+                length += 2
+        return length
+
+    @property
+    def fifo_count(self) -> int:
+        self.advance()
+        return len(self._fifo)
+
+    def _signed_word(self, reg: int) -> int:
+        return struct.unpack_from('>h', self._registers, reg)[0]
+
+    def _measurement(self, noise: bool = True) -> List[int]:
+        """Raw accel x, y, z, temperature, gyro x, y, z readings"""
+        accel_range = (self._registers[mpu.MPU6050_RA_ACCEL_CONFIG] >> 3) & 0x03
+        gyro_range = (self._registers[mpu.MPU6050_RA_GYRO_CONFIG] >> 3) & 0x03
+        accel_lsb = 32768.0 / (2 << accel_range)
+        gyro_lsb = 32768.0 / (250 << gyro_range)
+        accel_offset_regs = (mpu.MPU6050_RA_XA_OFFS_H,
+                             mpu.MPU6050_RA_YA_OFFS_H,
+                             mpu.MPU6050_RA_ZA_OFFS_H)
+        gyro_offset_regs = (mpu.MPU6050_RA_XG_OFFS_USRH,
+                            mpu.MPU6050_RA_YG_OFFS_USRH,
+                            mpu.MPU6050_RA_ZG_OFFS_USRH)
+        values = []
+        for axis, reg in enumerate(accel_offset_regs):
+            g = self.accel_bias[axis] + (1.0 if axis == 2 else 0.0)
+            # Offset registers are range independent, one unit equals
+            # MPU6050_ACCEL_OFFSET_FACTOR LSB at +-2g range
+            g += self._signed_word(reg) * mpu.MPU6050_ACCEL_OFFSET_FACTOR / 16384.0
+            if noise:
+                g += self._random.gauss(0, self.accel_noise)
+            values.append(g * accel_lsb)
+        values.append((self.temperature - mpu.MPU6050_TEMP_OFFSET)
+                      / mpu.MPU6050_TEMP_FACTOR)
+        for axis, reg in enumerate(gyro_offset_regs):
+            dps = self.gyro_bias[axis]
+            # One unit equals MPU6050_GYRO_OFFSET_FACTOR LSB at +-250 deg/s
+            dps += self._signed_word(reg) * mpu.MPU6050_GYRO_OFFSET_FACTOR / 131.072
+            if noise:
+                dps += self._random.gauss(0, self.gyro_noise)
+            values.append(dps * gyro_lsb)
+        return [max(-32768, min(32767, int(round(x)))) for x in values]
+
+    def _pack(self, values: List[int]) -> bytes:
+        """Pack measurement to FIFO package according to FIFO_EN register"""
+        fifo_en = self._registers[mpu.MPU6050_RA_FIFO_EN]
+        fields = []
+        if fifo_en & (1 << mpu.MPU6050_ACCEL_FIFO_EN_BIT):
+            fields += values[0:3]
+        if fifo_en & (1 << mpu.MPU6050_TEMP_FIFO_EN_BIT):
+            fields.append(values[3])
+        if fifo_en & (1 << mpu.MPU6050_XG_FIFO_EN_BIT):
+            fields.append(values[4])
+        if fifo_en & (1 << mpu.MPU6050_YG_FIFO_EN_BIT):
+            fields.append(values[5])
+        if fifo_en & (1 << mpu.MPU6050_ZG_FIFO_EN_BIT):
+            fields.append(values[6])
+        return struct.pack(f'>{len(fields)}h', *fields)
+
+    def _update_sampling(self):
+        """Recompute FIFO filling parameters after configuration change"""
+        pwr_mgmt_1 = self._registers[mpu.MPU6050_RA_PWR_MGMT_1]
+        user_ctrl = self._registers[mpu.MPU6050_RA_USER_CTRL]
+        self._package_length = self.package_length
+        self._sample_period = 1.0 / self.sample_rate
+        self._sampling = (
+            not pwr_mgmt_1 & (1 << mpu.MPU6050_PWR1_SLEEP_BIT)
+            and bool(user_ctrl & (1 << mpu.MPU6050_USERCTRL_FIFO_EN_BIT))
+            and self._package_length > 0
+        )
+        self._next_sample_time = self._clock() + self._sample_period
+        if self._package_length:
+            # Pre-generated samples are cycled to keep emulation cheap
+            pattern = b''.join(self._pack(self._measurement())
+                               for _ in range(PATTERN_SAMPLES))
+            self._pattern = pattern * 2
+        else:
+            self._pattern = b''
+        self._pattern_pos = 0
+
+    def advance(self):
+        """Push all samples produced since last call to FIFO"""
+        if not self._sampling:
+            return
+        now = self._clock()
+        if now < self._next_sample_time:
+            return
+        n = int((now - self._next_sample_time) / self._sample_period) + 1
+        self._next_sample_time += n * self._sample_period
+        self.samples_generated += n
+        length = self._package_length
+        # Only the newest samples can remain in FIFO
+        keep = min(n, FIFO_SIZE // length + 1)
+        start = (self._pattern_pos + n - keep) % PATTERN_SAMPLES
+        self._pattern_pos = (self._pattern_pos + n) % PATTERN_SAMPLES
+        self._fifo += self._pattern[start * length:(start + keep) * length]
+        lost_bytes = (n - keep) * length
+        excess = len(self._fifo) - FIFO_SIZE
+        if excess > 0:
+            # Oldest data is overwritten, FIFO may become misaligned
+            del self._fifo[:excess]
+            lost_bytes += excess
+        if lost_bytes:
+            self.lost_packages += lost_bytes / length
+            self._registers[mpu.MPU6050_RA_INT_STATUS] |= \
+                1 << mpu.MPU6050_INTERRUPT_FIFO_OFLOW_BIT
+            if not self._overflowed:
+                self.overflows += 1
+                self._overflowed = True
+
+    def read(self, reg: int, length: int) -> bytes:
+        """Read register block as the device does over I2C"""
+        self.advance()
+        if reg == mpu.MPU6050_RA_FIFO_R_W:
+            data = bytes(self._fifo[:length])
+            del self._fifo[:length]
+            if len(self._fifo) < FIFO_SIZE:
+                self._overflowed = False
+            # Empty FIFO returns zeros
+            return data + bytes(length - len(data))
+        data = bytearray()
+        raw = None
+        for r in range(reg, reg + length):
+            r %= len(self._registers)
+            if mpu.MPU6050_RA_ACCEL_XOUT_H <= r <= mpu.MPU6050_RA_GYRO_ZOUT_L:
+                if raw is None:
+                    raw = struct.pack('>7h', *self._measurement())
+                data.append(raw[r - mpu.MPU6050_RA_ACCEL_XOUT_H])
+            elif r == mpu.MPU6050_RA_FIFO_COUNTH:
+                data.append(len(self._fifo) >> 8)
+            elif r == mpu.MPU6050_RA_FIFO_COUNTL:
+                data.append(len(self._fifo) & 0xFF)
+            elif r == mpu.MPU6050_RA_INT_STATUS:
+                data.append(self._registers[r])
+                self._registers[r] = 0
+            else:
+                data.append(self._registers[r])
+        return bytes(data)
+
+    def write(self, reg: int, values: Iterable[int]):
+        """Write register block as the device does over I2C"""
+        self.advance()
+        update_sampling = False
+        for value in values:
+            value &= 0xFF
+            if reg == mpu.MPU6050_RA_FIFO_R_W:
+                self._fifo.append(value)
+                continue
+            if reg == mpu.MPU6050_RA_PWR_MGMT_1 \
+                    and value & (1 << mpu.MPU6050_PWR1_DEVICE_RESET_BIT):
+                self.power_on_reset()
+                reg += 1
+                continue
+            if reg == mpu.MPU6050_RA_USER_CTRL:
+                if value & (1 << mpu.MPU6050_USERCTRL_FIFO_RESET_BIT):
+                    # Sampling restarts, pattern is kept
+                    self._fifo.clear()
+                    self._overflowed = False
+                    self._next_sample_time = self._clock() + self._sample_period
+                # Reset bits are cleared automatically
+                value &= ~((1 << mpu.MPU6050_USERCTRL_FIFO_RESET_BIT)
+                           | (1 << mpu.MPU6050_USERCTRL_SIG_COND_RESET_BIT)
+                           | (1 << mpu.MPU6050_USERCTRL_I2C_MST_RESET_BIT)
+                           | (1 << mpu.MPU6050_USERCTRL_DMP_RESET_BIT))
+            if reg != mpu.MPU6050_RA_WHO_AM_I:
+                if reg in _SAMPLING_REGISTERS and self._registers[reg] != value:
+                    update_sampling = True
+                self._registers[reg] = value
+            reg += 1
+        if update_sampling:
+            self._update_sampling()
+
+
+class EmulatedTCA9548A:
+    """
+    Emulated TCA9548A I2C multiplexer.
+    Control register bits connect channels (dicts of address: sensor) to bus.
+    """
+
+    def __init__(self, n_channels: int = 8):
+        self.channels = [{} for _ in range(n_channels)]
+        self.control = 0
+
+    def connected(self, address: int) -> List[EmulatedMPU6050]:
+        """Sensors with address on connected channels"""
+        return [channel[address] for i, channel in enumerate(self.channels)
+                if self.control >> i & 1 and address in channel]
+
+
+class EmulatedSMBus:
+    """
+    Drop-in replacement for smbus2.SMBus talking to emulated sensors.
+    Every transaction holds the bus and takes
+    latency + (bytes on wire) * byte_time seconds.
+    Devices are accessed at the start of transaction, like FIFO which
+    is drained while new samples are written to it.
+    """
+
+    def __init__(self, bus_id: int, devices: Dict[int, EmulatedMPU6050],
+                 lock: threading.Lock, latency: float = 0.0,
+                 byte_time: float = 0.0):
+        self.bus_id = bus_id
+        self.devices = devices
+        self.latency = latency
+        self.byte_time = byte_time
+        self.transactions = 0
+        self._lock = lock
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    def _device(self, address: int) -> EmulatedMPU6050:
+        devices = [self.devices[address]] if address in self.devices else []
+        for mux in self.devices.values():
+            if isinstance(mux, EmulatedTCA9548A):
+                devices.extend(mux.connected(address))
+        if not devices:
+            raise OSError(errno.ENXIO, os.strerror(errno.ENXIO))
+        if len(devices) > 1:
+            # Several devices answer to the same address
+            raise OSError(errno.EIO, os.strerror(errno.EIO))
+        return devices[0]
+
+    def _mux(self, address: int) -> EmulatedTCA9548A:
+        device = self._device(address)
+        if not isinstance(device, EmulatedTCA9548A):
+            raise OSError(errno.EIO, os.strerror(errno.EIO))
+        return device
+
+    def _transfer_time(self, n_bytes: int):
+        # Address byte and register byte are always on wire
+        duration = self.latency + (n_bytes + 2) * self.byte_time
+        if duration > 0:
+            time.sleep(duration)
+        self.transactions += 1
+
+    def read_byte(self, i2c_addr: int, force: bool = None) -> int:
+        with self._lock:
+            try:
+                return self._mux(i2c_addr).control
+            finally:
+                # Only address byte and data byte are on wire
+                self._transfer_time(0)
+
+    def write_byte(self, i2c_addr: int, value: int, force: bool = None):
+        with self._lock:
+            try:
+                self._mux(i2c_addr).control = value
+            finally:
+                self._transfer_time(0)
+
+    def read_byte_data(self, i2c_addr: int, register: int,
+                       force: bool = None) -> int:
+        with self._lock:
+            try:
+                return self._device(i2c_addr).read(register, 1)[0]
+            finally:
+                self._transfer_time(1)
+
+    def write_byte_data(self, i2c_addr: int, register: int, value: int,
+                        force: bool = None):
+        with self._lock:
+            try:
+                self._device(i2c_addr).write(register, [value])
+            finally:
+                self._transfer_time(1)
+
+    def read_i2c_block_data(self, i2c_addr: int, register: int, length: int,
+                            force: bool = None) -> List[int]:
+        if length > SMBUS_BLOCK_MAX:
+            raise ValueError('Desired block length over %d bytes' % SMBUS_BLOCK_MAX)
+        with self._lock:
+            try:
+                return list(self._device(i2c_addr).read(register, length))
+            finally:
+                self._transfer_time(length)
+
+    def write_i2c_block_data(self, i2c_addr: int, register: int,
+                             data: List[int], force: bool = None):
+        if len(data) > SMBUS_BLOCK_MAX:
+            raise ValueError('Data length cannot exceed %d bytes' % SMBUS_BLOCK_MAX)
+        with self._lock:
+            try:
+                self._device(i2c_addr).write(register, data)
+            finally:
+                self._transfer_time(len(data))
+
+    def i2c_rdwr(self, *i2c_msgs):
+        """
+        Combined transaction of smbus2.i2c_msg messages.
+        Write message sets register pointer and writes the rest of its bytes,
+        read message reads from the register pointer.
+        """
+        with self._lock:
+            try:
+                register = None
+                for msg in i2c_msgs:
+                    device = self._device(msg.addr)
+                    if msg.flags & I2C_M_RD:
+                        data = device.read(register, msg.len)
+                        ctypes.memmove(msg.buf, data, msg.len)
+                    else:
+                        data = bytes(msg)
+                        register = data[0]
+                        if len(data) > 1:
+                            device.write(register, data[1:])
+            finally:
+                self._transfer_time(sum(msg.len for msg in i2c_msgs))
+
+
+class EmulatedBackend:
+    """
+    Factory of emulated SMBus handles.
+    Can be passed to Manager as bus_factory.
+    Sensors are attached to (bus, address) pairs or behind multiplexers
+    to (bus, mux address, channel, address), handles opened for the same
+    bus share sensors and bus lock.
+    Pickled backend, e.g. of a worker process, emulates copies of sensors.
+    """
+
+    def __init__(self, latency: float = 0.0, byte_time: float = 0.0,
+                 seed: Optional[int] = None):
+        self.latency = latency
+        self.byte_time = byte_time
+        self.devices = {}
+        self._locks = {}
+        self._random = random.Random(seed)
+
+    def __getstate__(self) -> Dict:
+        # Bus locks can't leave this process
+        state = self.__dict__.copy()
+        state['_locks'] = {}
+        return state
+
+    def attach(self, bus: int, address: int,
+               sensor: Optional[EmulatedMPU6050] = None,
+               mux_address: Optional[int] = None,
+               mux_channel: Optional[int] = None) -> EmulatedMPU6050:
+        """Connect emulated sensor to bus or to channel of multiplexer"""
+        if sensor is None:
+            sensor = EmulatedMPU6050(seed=self._random.random())
+        self._devices(bus, mux_address, mux_channel)[address] = sensor
+        return sensor
+
+    def detach(self, bus: int, address: int,
+               mux_address: Optional[int] = None,
+               mux_channel: Optional[int] = None):
+        """Disconnect emulated sensor from bus"""
+        del self._devices(bus, mux_address, mux_channel)[address]
+
+    def _devices(self, bus: int, mux_address: Optional[int],
+                 mux_channel: Optional[int]) -> Dict[int, EmulatedMPU6050]:
+        devices = self.devices.setdefault(bus, {})
+        if mux_address is None:
+            return devices
+        if mux_address not in devices:
+            devices[mux_address] = EmulatedTCA9548A()
+        return devices[mux_address].channels[mux_channel]
+
+    def sensors(self) -> List[EmulatedMPU6050]:
+        sensors = []
+        for devices in self.devices.values():
+            for device in devices.values():
+                if isinstance(device, EmulatedTCA9548A):
+                    for channel in device.channels:
+                        sensors.extend(channel.values())
+                else:
+                    sensors.append(device)
+        return sensors
+
+    def __call__(self, bus_id: int) -> EmulatedSMBus:
+        if bus_id not in self._locks:
+            self._locks[bus_id] = threading.Lock()
+        return EmulatedSMBus(
+            bus_id, self.devices.setdefault(bus_id, {}),
+            self._locks[bus_id], self.latency, self.byte_time
+        )
@@ -1,6 +1,9 @@
-from typing import Literal, List
+from ctypes import c_char, create_string_buffer
+from fcntl import ioctl
+from typing import Dict, Iterable, Literal, List, Optional, Tuple
 
-from smbus2 import SMBus
+from smbus2 import SMBus, i2c_msg
+from smbus2.smbus2 import I2C_M_RD, I2C_RDWR, i2c_rdwr_ioctl_data
 
 
 def write_bit(bus: SMBus, address: int, reg: int, bit: int,
@@ -19,6 +22,13 @@ def write_bit(bus: SMBus, address: int, reg: int, bit: int,
 
 def write_bits(bus: SMBus, address: int, reg: int, bit: int,
                length: int, value: int):
+    byte = bus.read_byte_data(address, reg)
+    byte = set_bits(byte, bit, length, value)
+    bus.write_byte_data(address, reg, byte)
+
+
+def set_bits(byte: int, bit: int, length: int, value: int) -> int:
+    """Return byte with bit sequence replaced by value"""
     if bit > 7 or bit < 0:
         raise IndexError('"bit" index is out of range')
     if length > bit + 1:
@@ -28,10 +38,9 @@ def write_bits(bus: SMBus, address: int, reg: int, bit: int,
     if value < 0:
         raise ValueError('"value" must be greater or equal to 0')
     clear_mask = (2**(bit + 1) - 1) ^ (2**(bit - length + 1) - 1)
-    byte = bus.read_byte_data(address, reg)
     byte = byte ^ (byte & clear_mask)
     byte |= value << (bit - length + 1)
-    bus.write_byte_data(address, reg, byte)
+    return byte
 
 
 def write_byte(bus: SMBus, address: int, reg: int, value: int):
@@ -98,3 +107,183 @@ def write_bytes(bus: SMBus, address: int, reg: int, values: List[int]):
 def read_bytes(bus: SMBus, address: int, reg: int, length: int) -> List[int]:
     result = bus.read_i2c_block_data(address, reg, length)
     return result
+
+
+def read_bytes_rdwr(bus: SMBus, address: int, reg: int, length: int) -> bytes:
+    """
+    Read register block with combined I2C_RDWR transaction.
+    Unlike SMBus block read it is not limited to 32 bytes.
+    """
+    write = i2c_msg.write(address, [reg])
+    read = i2c_msg.read(address, length)
+    bus.i2c_rdwr(write, read)
+    return bytes(read)
+
+
+class BlockReader:
+    """
+    Reusable I2C_RDWR transaction reading register block into caller's buffer.
+    Messages are built for the last used buffer and ioctl is called directly
+    on real SMBus handles, so steady state reads into the same buffer don't
+    create Python objects. Reading into another buffer rebuilds them.
+    """
+
+    def __init__(self, address: int, reg: int):
+        self.address = address
+        self._reg = create_string_buffer(bytes([reg]), 1)
+        # Messages, ioctl data and the buffer they point to
+        self._transaction_cache = None
+
+    def _transaction(self, buffer: bytearray) -> tuple:
+        cached = self._transaction_cache
+        # Cache holds the buffer, so it can't be replaced by another one
+        # with the same id
+        if cached is None or cached[3] is not buffer:
+            data = (c_char * len(buffer)).from_buffer(buffer)
+            msgs = (i2c_msg * 2)(
+                i2c_msg(addr=self.address, flags=0, len=1, buf=self._reg),
+                i2c_msg(addr=self.address, flags=I2C_M_RD,
+                        len=len(buffer), buf=data)
+            )
+            ioctl_data = i2c_rdwr_ioctl_data(msgs=msgs, nmsgs=2)
+            cached = self._transaction_cache = (msgs[0], msgs[1], ioctl_data,
+                                                buffer, data, msgs)
+        return cached
+
+    def read_into(self, bus: SMBus, buffer: bytearray, length: int):
+        """Read length bytes of register block to the start of buffer"""
+        write, read, ioctl_data = self._transaction(buffer)[:3]
+        read.len = length
+        fd = getattr(bus, 'fd', None)
+        if fd is not None:
+            ioctl(fd, I2C_RDWR, ioctl_data)
+        else:
+            bus.i2c_rdwr(write, read)
+
+
+def register_runs(registers: Iterable[int], max_length: int = 32,
+                  max_gap: int = 0,
+                  fillable: Iterable[int] = ()) -> List[Tuple[int, int]]:
+    """
+    Group registers to contiguous runs (start, length)
+    which can be transferred with a single block transaction.
+    Runs are merged over gaps of up to max_gap fillable registers.
+    """
+    fillable = set(fillable)
+    runs = []
+    for reg in sorted(set(registers)):
+        if runs:
+            start, length = runs[-1]
+            end = start + length
+            gap = range(end, reg)
+            if len(gap) <= max_gap and reg - start < max_length \
+                    and all(r in fillable for r in gap):
+                runs[-1] = (start, reg - start + 1)
+                continue
+        runs.append((reg, 1))
+    return runs
+
+
+class RegisterShadow:
+    """
+    SMBus wrapper keeping a shadow copy of a device's register file.
+    Shadowed registers are filled with burst reads on first access,
+    updated on every write and served from memory afterwards,
+    so read-modify-write helpers above need no bus reads at all.
+    Volatile registers and other devices are passed through to the bus.
+    """
+
+    def __init__(self, bus: SMBus, address: int,
+                 blocks: Iterable[Tuple[int, int]],
+                 volatile: Iterable[int] = (),
+                 self_clearing: Optional[Dict[int, int]] = None):
+        self.bus = bus
+        self.address = address
+        self.blocks = list(blocks)
+        self.self_clearing = dict(self_clearing or {})
+        self.registers = set()
+        for start, length in self.blocks:
+            self.registers.update(range(start, start + length))
+        self.registers.difference_update(volatile)
+        self._shadow = {}
+        self._valid = False
+
+    def __getattr__(self, name):
+        if name == 'bus':
+            raise AttributeError(name)
+        return getattr(self.bus, name)
+
+    def fill(self):
+        """Read all shadowed registers from device"""
+        shadow = {}
+        for start, length in self.blocks:
+            values = self.bus.read_i2c_block_data(self.address, start, length)
+            for reg, value in enumerate(values, start):
+                if reg in self.registers:
+                    shadow[reg] = value
+        self._shadow = shadow
+        self._valid = True
+
+    def invalidate(self):
+        """Forget shadowed values, e.g. after device reset"""
+        self._shadow = {}
+        self._valid = False
+
+    def get(self, reg: int) -> int:
+        """Shadowed value of register"""
+        if not self._valid:
+            self.fill()
+        return self._shadow[reg]
+
+    def verify(self, reg: int, length: int) -> List[int]:
+        """
+        Read register block directly from device and compare it with shadow.
+        Returns list of mismatched registers.
+        """
+        values = self.bus.read_i2c_block_data(self.address, reg, length)
+        mismatched = []
+        for r, value in enumerate(values, reg):
+            value &= ~self.self_clearing.get(r, 0)
+            if r in self._shadow and self._shadow[r] != value:
+                mismatched.append(r)
+        return mismatched
+
+    def _is_shadowed(self, address: int, reg: int, length: int) -> bool:
+        if address != self.address:
+            return False
+        for r in range(reg, reg + length):
+            if r not in self.registers:
+                return False
+        if not self._valid:
+            self.fill()
+        return True
+
+    def _update(self, address: int, reg: int, values: Iterable[int]):
+        if address != self.address:
+            return
+        for r, value in enumerate(values, reg):
+            if r in self.registers:
+                # Bits cleared by the device itself are never stored
+                self._shadow[r] = value & ~self.self_clearing.get(r, 0)
+
+    def read_byte_data(self, i2c_addr: int, register: int,
+                       force: bool = None) -> int:
+        if self._is_shadowed(i2c_addr, register, 1):
+            return self._shadow[register]
+        return self.bus.read_byte_data(i2c_addr, register, force)
+
+    def write_byte_data(self, i2c_addr: int, register: int, value: int,
+                        force: bool = None):
+        self.bus.write_byte_data(i2c_addr, register, value, force)
+        self._update(i2c_addr, register, [value])
+
+    def read_i2c_block_data(self, i2c_addr: int, register: int, length: int,
+                            force: bool = None) -> List[int]:
+        if self._is_shadowed(i2c_addr, register, length):
+            return [self._shadow[r] for r in range(register, register + length)]
+        return self.bus.read_i2c_block_data(i2c_addr, register, length, force)
+
+    def write_i2c_block_data(self, i2c_addr: int, register: int,
+                             data: List[int], force: bool = None):
+        self.bus.write_i2c_block_data(i2c_addr, register, data, force)
+        self._update(i2c_addr, register, data)
@@ -1,4 +1,6 @@
+import errno
 import struct
+import logging
 import smbus2 as smbus
 
 from imu_manager.mpu6050 import i2c
@@ -387,6 +389,9 @@ MPU6050_DMP_MEMORY_BANKS = 8
 MPU6050_DMP_MEMORY_BANK_SIZE = 256
 MPU6050_DMP_MEMORY_CHUNK_SIZE = 16
 
+MPU6050_FIFO_SIZE = 1024
+SMBUS_BLOCK_MAX = 32
+
 MPU6050_DEFAULT_GYRO_OUTPUT_RATE = 8000
 MPU6050_DLPF_GYRO_OUTPUT_RATE = 1000
 
@@ -431,10 +436,65 @@ class MPU6050_I2C:
         MPU6050_RA_SIGNAL_PATH_RESET,
         MPU6050_RA_MOT_DETECT_CTRL]
 
-    def __init__(self, bus_id, address=MPU6050_DEFAULT_ADDRESS):
+    # Register blocks kept in register shadow, (start, length).
+    # Each block fits into a single SMBus block read.
+    SHADOW_BLOCKS = [
+        (MPU6050_RA_XG_OFFS_TC, 25),  # offsets and trims
+        (MPU6050_RA_SMPLRT_DIV, 32),  # configuration, FIFO_EN, interrupts
+        (MPU6050_RA_I2C_MST_DELAY_CTRL, 6)]  # USER_CTRL, PWR_MGMT_1/2
+    # Registers inside shadow blocks which are changed by the device itself
+    VOLATILE_REGISTERS = [
+        MPU6050_RA_I2C_SLV4_DI,
+        MPU6050_RA_I2C_MST_STATUS]
+    # Bits which are cleared by the device after being written
+    SELF_CLEARING_BITS = {
+        MPU6050_RA_SIGNAL_PATH_RESET: 0x07,
+        MPU6050_RA_USER_CTRL: 0x0F,
+        MPU6050_RA_PWR_MGMT_1: 0x80}
+
+    # Configuration fields, name: (register, bit, length).
+    # Used by both single field setters and set_configuration.
+    CONFIG_FIELDS = {
+        'rate': (MPU6050_RA_SMPLRT_DIV, 7, 8),
+        'dlpf_mode': (MPU6050_RA_CONFIG, MPU6050_CFG_DLPF_CFG_BIT,
+                      MPU6050_CFG_DLPF_CFG_LENGTH),
+        'full_scale_gyro_range': (MPU6050_RA_GYRO_CONFIG, MPU6050_GCONFIG_FS_SEL_BIT,
+                                  MPU6050_GCONFIG_FS_SEL_LENGTH),
+        'full_scale_accel_range': (MPU6050_RA_ACCEL_CONFIG, MPU6050_ACONFIG_AFS_SEL_BIT,
+                                   MPU6050_ACONFIG_AFS_SEL_LENGTH),
+        'clock_source': (MPU6050_RA_PWR_MGMT_1, MPU6050_PWR1_CLKSEL_BIT,
+                         MPU6050_PWR1_CLKSEL_LENGTH),
+        'accel_fifo_enabled': (MPU6050_RA_FIFO_EN, MPU6050_ACCEL_FIFO_EN_BIT, 1),
+        'x_gyro_fifo_enabled': (MPU6050_RA_FIFO_EN, MPU6050_XG_FIFO_EN_BIT, 1),
+        'y_gyro_fifo_enabled': (MPU6050_RA_FIFO_EN, MPU6050_YG_FIFO_EN_BIT, 1),
+        'z_gyro_fifo_enabled': (MPU6050_RA_FIFO_EN, MPU6050_ZG_FIFO_EN_BIT, 1)}
+
+    def __init__(self, bus_id, address=MPU6050_DEFAULT_ADDRESS,
+                 bus_factory=None):
         self.bus_id = bus_id
         self.address = address
-        self._bus = smbus.SMBus(self.bus_id)
+        if bus_factory is None:
+            bus_factory = smbus.SMBus
+        self._bus = i2c.RegisterShadow(
+            bus_factory(self.bus_id), self.address, self.SHADOW_BLOCKS,
+            self.VOLATILE_REGISTERS, self.SELF_CLEARING_BITS
+        )
+        # Prime shadow, so configuration starts without bus reads
+        self._bus.fill()
+        # FIFO is drained with I2C_RDWR bursts unless the bus handle has
+        # no I2C_RDWR or the adapter doesn't support it (see _disable_rdwr)
+        self.fifo_rdwr_enabled = callable(getattr(self._bus, 'i2c_rdwr', None))
+        self._fifo_count_reader = i2c.BlockReader(address, MPU6050_RA_FIFO_COUNTH)
+        self._fifo_reader = i2c.BlockReader(address, MPU6050_RA_FIFO_R_W)
+        self._fifo_count_buffer = bytearray(2)
+
+    @staticmethod
+    def probe(bus, address=MPU6050_DEFAULT_ADDRESS):
+        """Check if MPU-6050 answers at address with a single WHO_AM_I read"""
+        try:
+            return i2c.read_bits(bus, address, MPU6050_RA_WHO_AM_I, MPU6050_WHO_AM_I_BIT, MPU6050_WHO_AM_I_LENGTH) == 0x34
+        except OSError:
+            return False
 
     def test_connection(self):
         try:
@@ -442,6 +502,14 @@ class MPU6050_I2C:
         except OSError:
             return False
 
+    def was_reset(self):
+        """
+        Check with a direct PWR_MGMT_1 read if device has lost the state
+        in its register shadow, e.g. it was power-cycled and sleeps again.
+        Raises OSError if device doesn't answer.
+        """
+        return bool(self._bus.verify(MPU6050_RA_PWR_MGMT_1, 1))
+
     def get_device_id(self):
         return i2c.read_bits(self._bus, self.address, MPU6050_RA_WHO_AM_I, MPU6050_WHO_AM_I_BIT, MPU6050_WHO_AM_I_LENGTH)
 
@@ -449,28 +517,85 @@ class MPU6050_I2C:
         return i2c.read_byte(self._bus, self.address, MPU6050_RA_SMPLRT_DIV)
 
     def set_rate(self, rate):
-        i2c.write_byte(self._bus, self.address, MPU6050_RA_SMPLRT_DIV, rate)
+        self._write_fields(rate=rate)
 
     def get_clock_source(self):
         return i2c.read_bits(self._bus, self.address, MPU6050_RA_PWR_MGMT_1, MPU6050_PWR1_CLKSEL_BIT, MPU6050_PWR1_CLKSEL_LENGTH)
 
     def set_clock_source(self, source):
-        i2c.write_bits(self._bus, self.address, MPU6050_RA_PWR_MGMT_1,
-                       MPU6050_PWR1_CLKSEL_BIT, MPU6050_PWR1_CLKSEL_LENGTH, source)
+        self._write_fields(clock_source=source)
 
     def get_full_scale_gyro_range(self):
         return i2c.read_bits(self._bus, self.address, MPU6050_RA_GYRO_CONFIG, MPU6050_GCONFIG_FS_SEL_BIT, MPU6050_GCONFIG_FS_SEL_LENGTH)
 
     def set_full_scale_gyro_range(self, range):
-        i2c.write_bits(self._bus, self.address, MPU6050_RA_GYRO_CONFIG,
-                       MPU6050_GCONFIG_FS_SEL_BIT, MPU6050_GCONFIG_FS_SEL_LENGTH, range)
+        self._write_fields(full_scale_gyro_range=range)
 
     def get_full_scale_accel_range(self):
         return i2c.read_bits(self._bus, self.address, MPU6050_RA_ACCEL_CONFIG, MPU6050_ACONFIG_AFS_SEL_BIT, MPU6050_ACONFIG_AFS_SEL_LENGTH)
 
     def set_full_scale_accel_range(self, range):
-        i2c.write_bits(self._bus, self.address, MPU6050_RA_ACCEL_CONFIG,
-                       MPU6050_ACONFIG_AFS_SEL_BIT, MPU6050_ACONFIG_AFS_SEL_LENGTH, range)
+        self._write_fields(full_scale_accel_range=range)
+
+    def set_configuration(self, clock_source, dlpf_mode, rate,
+                          full_scale_accel_range, full_scale_gyro_range,
+                          accel_fifo_enabled, x_gyro_fifo_enabled,
+                          y_gyro_fifo_enabled, z_gyro_fifo_enabled):
+        """
+        Apply configuration profile.
+        Final register image is written with one block write per contiguous
+        run of registers and verified with block readback.
+        """
+        self.write_registers(self._register_image(
+            clock_source=clock_source, dlpf_mode=dlpf_mode, rate=rate,
+            full_scale_accel_range=full_scale_accel_range,
+            full_scale_gyro_range=full_scale_gyro_range,
+            accel_fifo_enabled=accel_fifo_enabled,
+            x_gyro_fifo_enabled=x_gyro_fifo_enabled,
+            y_gyro_fifo_enabled=y_gyro_fifo_enabled,
+            z_gyro_fifo_enabled=z_gyro_fifo_enabled
+        ))
+
+    def _register_image(self, **fields):
+        """
+        Register image {register: value} with configuration fields
+        replaced in their shadowed register values
+        """
+        image = {}
+        for field, value in fields.items():
+            reg, bit, length = self.CONFIG_FIELDS[field]
+            byte = image[reg] if reg in image else self._bus.get(reg)
+            image[reg] = i2c.set_bits(byte, bit, length, int(value))
+        return image
+
+    def _write_fields(self, **fields):
+        for reg, value in self._register_image(**fields).items():
+            i2c.write_byte(self._bus, self.address, reg, value)
+
+    def write_registers(self, image):
+        """
+        Write register image {register: value} with block writes and
+        verify it with block readback. Gaps between registers are filled
+        with shadowed values.
+        Raises OSError if device registers don't match written image.
+        """
+        shadow = self._bus
+        runs = i2c.register_runs(image.keys(), max_gap=8,
+                                 fillable=shadow.registers)
+        for start, length in runs:
+            values = [
+                image[reg] if reg in image else shadow.get(reg)
+                for reg in range(start, start + length)
+            ]
+            i2c.write_bytes(shadow, self.address, start, values)
+        mismatched = []
+        for start, length in runs:
+            mismatched += shadow.verify(start, length)
+        if mismatched:
+            shadow.invalidate()
+            raise OSError(errno.EIO, 'Registers {} of sensor {}:{} were not configured'.format(
+                ', '.join(map(hex, mismatched)), self.bus_id, hex(self.address)
+            ))
 
     def get_sleep_enabled(self):
         return i2c.read_bit(self._bus, self.address, MPU6050_RA_PWR_MGMT_1, MPU6050_PWR1_SLEEP_BIT)
@@ -483,8 +608,7 @@ class MPU6050_I2C:
         return i2c.read_bits(self._bus, self.address, MPU6050_RA_CONFIG, MPU6050_CFG_DLPF_CFG_BIT, MPU6050_CFG_DLPF_CFG_LENGTH)
 
     def set_dlpf_mode(self, mode):
-        i2c.write_bits(self._bus, self.address, MPU6050_RA_CONFIG,
-                       MPU6050_CFG_DLPF_CFG_BIT, MPU6050_CFG_DLPF_CFG_LENGTH, mode)
+        self._write_fields(dlpf_mode=mode)
 
     def get_temp_sensor_enabled(self):
         # 1 is actually disabled here
@@ -506,29 +630,25 @@ class MPU6050_I2C:
         return i2c.read_bit(self._bus, self.address, MPU6050_RA_FIFO_EN, MPU6050_XG_FIFO_EN_BIT)
 
     def set_x_gyro_fifo_enabled(self, enabled):
-        i2c.write_bit(self._bus, self.address, MPU6050_RA_FIFO_EN,
-                      MPU6050_XG_FIFO_EN_BIT, enabled)
+        self._write_fields(x_gyro_fifo_enabled=enabled)
 
     def get_y_gyro_fifo_enabled(self):
         return i2c.read_bit(self._bus, self.address, MPU6050_RA_FIFO_EN, MPU6050_YG_FIFO_EN_BIT)
 
     def set_y_gyro_fifo_enabled(self, enabled):
-        i2c.write_bit(self._bus, self.address, MPU6050_RA_FIFO_EN,
-                      MPU6050_YG_FIFO_EN_BIT, enabled)
+        self._write_fields(y_gyro_fifo_enabled=enabled)
 
     def get_z_gyro_fifo_enabled(self):
         return i2c.read_bit(self._bus, self.address, MPU6050_RA_FIFO_EN, MPU6050_ZG_FIFO_EN_BIT)
 
     def set_z_gyro_fifo_enabled(self, enabled):
-        i2c.write_bit(self._bus, self.address, MPU6050_RA_FIFO_EN,
-                      MPU6050_ZG_FIFO_EN_BIT, enabled)
+        self._write_fields(z_gyro_fifo_enabled=enabled)
 
     def get_accel_fifo_enabled(self):
         return i2c.read_bit(self._bus, self.address, MPU6050_RA_FIFO_EN, MPU6050_ACCEL_FIFO_EN_BIT)
 
     def set_accel_fifo_enabled(self, enabled):
-        i2c.write_bit(self._bus, self.address, MPU6050_RA_FIFO_EN,
-                      MPU6050_ACCEL_FIFO_EN_BIT, enabled)
+        self._write_fields(accel_fifo_enabled=enabled)
 
     def get_motion_6(self):
         buffer = i2c.read_bytes(self._bus, self.address,
@@ -590,6 +710,7 @@ class MPU6050_I2C:
     def reset(self):
         i2c.write_bit(self._bus, self.address, MPU6050_RA_PWR_MGMT_1,
                       MPU6050_PWR1_DEVICE_RESET_BIT, True)
+        self._bus.invalidate()
         for reg in self.ZERO_REGISTER:
             i2c.write_byte(self._bus, self.address, reg, 0)
 
@@ -604,6 +725,95 @@ class MPU6050_I2C:
     def get_fifo_bytes(self, length):
         return i2c.read_bytes(self._bus, self.address, MPU6050_RA_FIFO_R_W, length)
 
+    def _disable_rdwr(self, e: OSError):
+        """
+        Switch FIFO reads to SMBus block reads if adapter doesn't support
+        I2C_RDWR. Other errors are raised.
+        """
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+            raise e
+        logging.warning('I2C_RDWR is not supported on bus {}, '
+                        'falling back to SMBus block reads'.format(self.bus_id))
+        self.fifo_rdwr_enabled = False
+
+    def read_fifo(self, length):
+        """
+        Read FIFO bytes with a single I2C_RDWR burst of any length.
+        Falls back to 32-byte SMBus block reads if adapter lacks I2C_RDWR.
+        """
+        if self.fifo_rdwr_enabled:
+            try:
+                return i2c.read_bytes_rdwr(self._bus, self.address,
+                                           MPU6050_RA_FIFO_R_W, length)
+            except OSError as e:
+                self._disable_rdwr(e)
+        buffer = bytearray(length)
+        self._read_fifo_smbus(buffer, length)
+        return bytes(buffer)
+
+    def _read_fifo_smbus(self, buffer, length):
+        pos = 0
+        while pos < length:
+            n = min(SMBUS_BLOCK_MAX, length - pos)
+            buffer[pos:pos + n] = self.get_fifo_bytes(n)
+            pos += n
+
+    def drain_fifo_into(self, buffer, package_length, limit=None):
+        """
+        Read FIFO count and then all complete packages fitting into buffer
+        (and into limit bytes) directly into it. Read transactions are
+        cached for the last buffer, so reads into the same one don't allocate.
+        Full FIFO has overflowed and is not aligned to packages,
+        nothing is read then.
+        Returns FIFO count and number of read bytes.
+        """
+        if self.fifo_rdwr_enabled:
+            try:
+                count_buffer = self._fifo_count_buffer
+                self._fifo_count_reader.read_into(self._bus, count_buffer, 2)
+                count = (count_buffer[0] << 8) | count_buffer[1]
+            except OSError as e:
+                self._disable_rdwr(e)
+        if not self.fifo_rdwr_enabled:
+            count = self.get_fifo_count()
+        if count >= MPU6050_FIFO_SIZE:
+            return count, 0
+        length = min(count, len(buffer))
+        if limit is not None:
+            length = min(length, limit)
+        length -= length % package_length
+        if length:
+            self.read_fifo_into(buffer, length)
+        return count, length
+
+    def read_fifo_into(self, buffer, length):
+        """
+        Read FIFO bytes to the start of buffer without allocations.
+        Read transactions are cached for the last buffer.
+        """
+        if self.fifo_rdwr_enabled:
+            try:
+                self._fifo_reader.read_into(self._bus, buffer, length)
+                return
+            except OSError as e:
+                self._disable_rdwr(e)
+        self._read_fifo_smbus(buffer, length)
+
+    def get_offsets(self):
+        """
+        Accelerometer and gyroscope x, y, z offsets.
+        Offsets of each sensor are adjacent registers read with one block read.
+        """
+        accel = i2c.read_bytes(self._bus, self.address, MPU6050_RA_XA_OFFS_H, 6)
+        gyro = i2c.read_bytes(self._bus, self.address, MPU6050_RA_XG_OFFS_USRH, 6)
+        return struct.unpack('>hhhhhh', bytes(accel + gyro))
+
+    def set_offsets(self, offsets):
+        """Write offsets in get_offsets order with two block writes"""
+        buffer = struct.pack('>hhhhhh', *offsets)
+        i2c.write_bytes(self._bus, self.address, MPU6050_RA_XA_OFFS_H, list(buffer[:6]))
+        i2c.write_bytes(self._bus, self.address, MPU6050_RA_XG_OFFS_USRH, list(buffer[6:]))
+
     def get_accel_offset_x(self):
         return i2c.read_signed_word(self._bus, self.address, MPU6050_RA_XA_OFFS_H)
 
@@ -1,13 +1,24 @@
 from imu_manager.mpu6050 import i2c_interface
 
 
+# Raw measurement units of one offset register unit, in get_offsets order
+OFFSET_FACTORS = [i2c_interface.MPU6050_ACCEL_OFFSET_FACTOR] * 3 \
+    + [i2c_interface.MPU6050_GYRO_OFFSET_FACTOR] * 3
+CALIBRATION_MODES = ['sequential', 'batched', 'closed_form']
+# Closed-form calibration measures at most this many buffers
+CLOSED_FORM_PASSES = 3
+
 class MPU6050:
     def __init__(self, sensor_id, bus,
-                 address=i2c_interface.MPU6050_DEFAULT_ADDRESS):
+                 address=i2c_interface.MPU6050_DEFAULT_ADDRESS,
+                 bus_factory=None, mux_address=None, mux_channel=None):
         self.id = sensor_id
         self.bus = bus
         self.address = address
-        self._mpu6050 = i2c_interface.MPU6050_I2C(bus, address)
+        self.mux_address = mux_address
+        self.mux_channel = mux_channel
+        self._mpu6050 = i2c_interface.MPU6050_I2C(bus, address, bus_factory)
+        self.calibration_residuals = None
         self._mpu6050.set_sleep_enabled(False)
         self._mpu6050.set_fifo_enabled(True)
         self._accel_fifo_enabled = self._mpu6050.get_accel_fifo_enabled()
@@ -19,15 +30,17 @@ class MPU6050:
         self._full_scale_gyro_range = self._mpu6050.get_full_scale_gyro_range()
         self._clock_source = self._mpu6050.get_clock_source()
         self._rate = self._mpu6050.get_rate()
-        if self._dlpf_mode == i2c_interface.MPU6050_DLPF_BW_256:
-            self._gyro_output_rate = i2c_interface.MPU6050_DEFAULT_GYRO_OUTPUT_RATE
-        else:
-            self._gyro_output_rate = i2c_interface.MPU6050_DLPF_GYRO_OUTPUT_RATE
+        self._gyro_output_rate = MPU6050.dlpf_mode_to_gyro_output_rate(self._dlpf_mode)
 
     @property
     def is_connected(self):
         return self._mpu6050.test_connection()
 
+    @property
+    def was_reset(self):
+        """Device is back in power-on state, raises OSError if it doesn't answer"""
+        return self._mpu6050.was_reset()
+
     def reset(self):
         self._mpu6050.reset()
         self._mpu6050.set_sleep_enabled(False)
@@ -65,6 +78,12 @@ class MPU6050:
         elif range_ == i2c_interface.MPU6050_GYRO_FS_2000:
             return 2000 / 32768.0
 
+    @staticmethod
+    def dlpf_mode_to_gyro_output_rate(mode):
+        if mode == i2c_interface.MPU6050_DLPF_BW_256:
+            return i2c_interface.MPU6050_DEFAULT_GYRO_OUTPUT_RATE
+        return i2c_interface.MPU6050_DLPF_GYRO_OUTPUT_RATE
+
     @property
     def rate(self):
         return self._mpu6050.get_rate()
@@ -121,10 +140,28 @@ class MPU6050:
     def dlpf_mode(self, mode):
         self._dlpf_mode = mode
         self._mpu6050.set_dlpf_mode(mode)
-        if mode == i2c_interface.MPU6050_DLPF_BW_256:
-            self._gyro_output_rate = i2c_interface.MPU6050_DEFAULT_GYRO_OUTPUT_RATE
-        else:
-            self._gyro_output_rate = i2c_interface.MPU6050_DLPF_GYRO_OUTPUT_RATE
+        self._gyro_output_rate = MPU6050.dlpf_mode_to_gyro_output_rate(mode)
+
+    def configure(self, clock_source, dlpf_mode, rate,
+                  full_scale_accel_range, full_scale_gyro_range,
+                  accel_fifo_enabled, x_gyro_fifo_enabled,
+                  y_gyro_fifo_enabled, z_gyro_fifo_enabled):
+        self._mpu6050.set_configuration(
+            clock_source, dlpf_mode, rate,
+            full_scale_accel_range, full_scale_gyro_range,
+            accel_fifo_enabled, x_gyro_fifo_enabled,
+            y_gyro_fifo_enabled, z_gyro_fifo_enabled
+        )
+        self._clock_source = clock_source
+        self._rate = rate
+        self._full_scale_accel_range = full_scale_accel_range
+        self._full_scale_gyro_range = full_scale_gyro_range
+        self._accel_fifo_enabled = accel_fifo_enabled
+        self._x_gyro_fifo_enabled = x_gyro_fifo_enabled
+        self._y_gyro_fifo_enabled = y_gyro_fifo_enabled
+        self._z_gyro_fifo_enabled = z_gyro_fifo_enabled
+        self._dlpf_mode = dlpf_mode
+        self._gyro_output_rate = MPU6050.dlpf_mode_to_gyro_output_rate(dlpf_mode)
 
     def get_temperature(self):
         t = self._mpu6050.get_temperature()
@@ -135,6 +172,7 @@ class MPU6050:
     def _calibrate_axis(self, get_x, set_offset, offset_factor, max_iters,
                         rough_iters, buffer_size, epsilon, mu, v_threshold,
                         target=0):
+        """Yields number of finished iterations until offset converges"""
         v = 0
         offset = 0
         set_offset(0)
@@ -150,40 +188,181 @@ class MPU6050:
             if abs(delta) < offset_factor and abs(v) < v_threshold:
                 break
             set_offset(int(offset / offset_factor))
+            yield i + 1
+
+    def _calibrate_axes(self, set_offsets, offset_factors, targets,
+                        max_iters, rough_iters, buffer_size,
+                        epsilon, mu, v_threshold):
+        """
+        Same search as _calibrate_axis for all six axes at once.
+        Every sample of all axes comes from one get_motion_6 burst.
+        """
+        n_axes = len(set_offsets)
+        v = [0] * n_axes
+        offset = [0] * n_axes
+        done = [False] * n_axes
+        for set_offset in set_offsets:
+            set_offset(0)
+        for i in range(max_iters):
+            sums = [0] * n_axes
+            for _ in range(buffer_size):
+                motion = self._mpu6050.get_motion_6()
+                for axis in range(n_axes):
+                    sums[axis] += motion[axis]
+            for axis in range(n_axes):
+                if done[axis]:
+                    continue
+                delta = sums[axis] / buffer_size - targets[axis]
+                if i < rough_iters:
+                    offset[axis] += mu * v[axis] - delta
+                else:
+                    offset[axis] += mu * v[axis] - delta * epsilon
+                v[axis] = mu * v[axis] - delta * epsilon
+                if abs(delta) < offset_factors[axis] and abs(v[axis]) < v_threshold:
+                    done[axis] = True
+                    continue
+                set_offsets[axis](int(offset[axis] / offset_factors[axis]))
+            if all(done):
+                break
+            yield i + 1
+
+    def _offset_slopes(self):
+        """Change of raw readings per offset register unit at configured ranges"""
+        accel = OFFSET_FACTORS[0] / (1 << self._full_scale_accel_range)
+        gyro = OFFSET_FACTORS[3] / (1 << self._full_scale_gyro_range)
+        return [accel] * 3 + [gyro] * 3
+
+    def _mean_motion(self, buffer_size):
+        sums = [0] * len(OFFSET_FACTORS)
+        for _ in range(buffer_size):
+            motion = self._mpu6050.get_motion_6()
+            for axis in range(len(sums)):
+                sums[axis] += motion[axis]
+        return [x / buffer_size for x in sums]
+
+    def _calibrate_closed_form(self, buffer_size):
+        """
+        Offsets shift readings linearly, so they are solved directly
+        from averaged readings at current offsets and verified with
+        a check pass. Axes still off by an offset unit are solved again
+        with slope measured between the two passes.
+        Yields progress after every pass, sets calibration_residuals.
+        """
+        slopes = self._offset_slopes()
+        targets = self._calibration_targets()
+        offsets = self.get_offsets()
+        means = self._mean_motion(buffer_size)
+        for i in range(1, CLOSED_FORM_PASSES):
+            new_offsets = [
+                max(-32768, min(32767, offset - round((mean - target) / slope)))
+                for offset, mean, target, slope
+                in zip(offsets, means, targets, slopes)
+            ]
+            self.set_offsets(new_offsets)
+            yield i / CLOSED_FORM_PASSES
+            new_means = self._mean_motion(buffer_size)
+            residuals = [(mean - target) / slope
+                         for mean, target, slope in zip(new_means, targets, slopes)]
+            self.calibration_residuals = residuals
+            if all(abs(r) < 1 for r in residuals):
+                break
+            for axis in range(len(slopes)):
+                # Noise dominates slope measured over a few units
+                if abs(new_offsets[axis] - offsets[axis]) >= 16:
+                    slope = (new_means[axis] - means[axis]) \
+                        / (new_offsets[axis] - offsets[axis])
+                    if slope > 0:
+                        slopes[axis] = slope
+            offsets, means = new_offsets, new_means
+        yield 1.0
+
+    def _calibration_targets(self):
+        """Raw readings of calibrated sensor at rest, Z axis measures 1g"""
+        return [0, 0, 1 / self.accel_factor, 0, 0, 0]
+
+    def calibration(self, max_iters, rough_iters, buffer_size,
+                    epsilon=0.1, mu=0.5, v_threshold=0.05, mode='sequential'):
+        """
+        Step-wise calibration, see calibrate.
+        Returns generator which reads one buffer per step and yields
+        progress from 0 to 1, so calibrations of several sensors
+        can be interleaved.
+        """
+        if mode not in CALIBRATION_MODES:
+            raise ValueError(f'Unknown calibration mode: {mode}')
+        return self._calibration_steps(max_iters, rough_iters, buffer_size,
+                                       epsilon, mu, v_threshold, mode)
+
+    def _calibration_steps(self, max_iters, rough_iters, buffer_size,
+                           epsilon, mu, v_threshold, mode):
+        self.calibration_residuals = None
+        if mode == 'closed_form':
+            yield from self._calibrate_closed_form(buffer_size)
+            return
+        set_offsets = [self._mpu6050.set_accel_offset_x,
+                       self._mpu6050.set_accel_offset_y,
+                       self._mpu6050.set_accel_offset_z,
+                       self._mpu6050.set_gyro_offset_x,
+                       self._mpu6050.set_gyro_offset_y,
+                       self._mpu6050.set_gyro_offset_z]
+        targets = self._calibration_targets()
+        if mode == 'batched':
+            for i in self._calibrate_axes(
+                set_offsets, OFFSET_FACTORS, targets,
+                max_iters, rough_iters, buffer_size,
+                epsilon, mu, v_threshold
+            ):
+                yield i / max_iters
+        else:
+            getters = [self._mpu6050.get_acceleration_x,
+                       self._mpu6050.get_acceleration_y,
+                       self._mpu6050.get_acceleration_z,
+                       self._mpu6050.get_rotation_x,
+                       self._mpu6050.get_rotation_y,
+                       self._mpu6050.get_rotation_z]
+            for axis in range(len(getters)):
+                for i in self._calibrate_axis(
+                    getters[axis], set_offsets[axis], OFFSET_FACTORS[axis],
+                    max_iters, rough_iters, buffer_size,
+                    epsilon, mu, v_threshold, targets[axis]
+                ):
+                    yield (axis + i / max_iters) / len(getters)
+        yield 1.0
 
     def calibrate(self, max_iters, rough_iters, buffer_size,
-                  epsilon=0.1, mu=0.5, v_threshold=0.05): 
-        self._calibrate_axis(self._mpu6050.get_acceleration_x,
-                             self._mpu6050.set_accel_offset_x,
-                             i2c_interface.MPU6050_ACCEL_OFFSET_FACTOR,
-                             max_iters, rough_iters, buffer_size,
-                             epsilon, mu, v_threshold)
-        self._calibrate_axis(self._mpu6050.get_acceleration_y,
-                             self._mpu6050.set_accel_offset_y,
-                             i2c_interface.MPU6050_ACCEL_OFFSET_FACTOR,
-                             max_iters, rough_iters, buffer_size,
-                             epsilon, mu, v_threshold)
-        self._calibrate_axis(self._mpu6050.get_acceleration_z,
-                             self._mpu6050.set_accel_offset_z,
-                             i2c_interface.MPU6050_ACCEL_OFFSET_FACTOR,
-                             max_iters, rough_iters, buffer_size,
-                             epsilon, mu, v_threshold,
-                             target=(1 / self.accel_factor))
-        self._calibrate_axis(self._mpu6050.get_rotation_x,
-                             self._mpu6050.set_gyro_offset_x,
-                             i2c_interface.MPU6050_GYRO_OFFSET_FACTOR,
-                             max_iters, rough_iters, buffer_size,
-                             epsilon, mu, v_threshold)
-        self._calibrate_axis(self._mpu6050.get_rotation_y,
-                             self._mpu6050.set_gyro_offset_y,
-                             i2c_interface.MPU6050_GYRO_OFFSET_FACTOR,
-                             max_iters, rough_iters, buffer_size,
-                             epsilon, mu, v_threshold)
-        self._calibrate_axis(self._mpu6050.get_rotation_z,
-                             self._mpu6050.set_gyro_offset_z,
-                             i2c_interface.MPU6050_GYRO_OFFSET_FACTOR,
-                             max_iters, rough_iters, buffer_size,
-                             epsilon, mu, v_threshold)
+                  epsilon=0.1, mu=0.5, v_threshold=0.05, mode='sequential'):
+        """
+        Calibrate offsets, so that all measurements are zero-centered
+        and accelerometer Z axis measures 1g.
+        Mode 'batched' calibrates all axes from the same motion bursts,
+        'sequential' calibrates axes one by one with single axis reads,
+        both search offsets iteratively.
+        Mode 'closed_form' solves offsets from at most CLOSED_FORM_PASSES
+        buffers and stores final residuals to calibration_residuals,
+        iteration parameters are ignored.
+        """
+        for _ in self.calibration(max_iters, rough_iters, buffer_size,
+                                  epsilon, mu, v_threshold, mode):
+            pass
+
+    def get_offsets(self):
+        """Accelerometer and gyroscope x, y, z offsets"""
+        return list(self._mpu6050.get_offsets())
+
+    def set_offsets(self, offsets):
+        self._mpu6050.set_offsets(offsets)
+
+    def get_calibration_residuals(self, buffer_size):
+        """
+        Mean deviation of every axis from its calibrated value
+        over buffer_size readings, in offset register units.
+        Sensor has to be at rest, as during calibration.
+        """
+        means = self._mean_motion(buffer_size)
+        return [
+            (mean - target) / slope for mean, target, slope
+            in zip(means, self._calibration_targets(), self._offset_slopes())
+        ]
 
     @property
     def x_gyro_fifo_enabled(self):
@@ -234,6 +413,10 @@ class MPU6050:
             package_byte_length += 2
         return package_byte_length
 
+    def get_motion_6(self):
+        """Raw accelerometer and gyroscope x, y, z readings"""
+        return self._mpu6050.get_motion_6()
+
     def get_fifo_count(self):
         return self._mpu6050.get_fifo_count()
 
@@ -243,5 +426,8 @@ class MPU6050:
     def get_fifo_bytes(self, length):
         return self._mpu6050.get_fifo_bytes(length)
 
+    def drain_fifo_into(self, buffer, limit=None):
+        return self._mpu6050.drain_fifo_into(buffer, self.package_length, limit)
+
     def reset_fifo(self):
         self._mpu6050.reset_fifo()
@@ -0,0 +1,114 @@
+"""
+Session preflight throughput planner.
+Predicts bus utilization and FIFO headroom of the configured sensors
+from measured bus transaction costs, before a session is started.
+"""
+
+import time
+import statistics
+from typing import Any, Dict, List
+
+from imu_manager.mpu6050.mpu6050 import MPU6050
+from imu_manager.mpu6050.i2c_interface import MPU6050_FIFO_SIZE
+
+
+# Fill level FIFOs are read at, see PollScheduler
+TARGET_FILL = 0.25
+# Bus is predicted to keep up, but with little reserve above
+UTILIZATION_WARNING = 0.7
+# Smallest unused part of FIFO at the moment of read, as fraction of FIFO
+HEADROOM_WARNING = 0.25
+PLAN_VERDICTS = ['ok', 'warning', 'error']
+
+
+def measure_bus_cost(sensor: MPU6050, n: int = 16) -> Dict[str, float]:
+    """
+    Measure cost of a transaction on sensor bus as fixed latency,
+    including Python and driver overhead, and time per transferred byte.
+    Timed are n FIFO count reads (2 bytes) and n motion reads (14 bytes).
+    """
+    times = {2: [], 14: []}
+    for _ in range(n):
+        start = time.perf_counter()
+        sensor.get_fifo_count()
+        times[2].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        sensor.get_motion_6()
+        times[14].append(time.perf_counter() - start)
+    short = statistics.median(times[2])
+    long = statistics.median(times[14])
+    # Address and register bytes are on wire in every transaction
+    byte_time = max((long - short) / 12, 0.0)
+    latency = max(short - 4 * byte_time, 0.0)
+    return {'latency': latency, 'byte_time': byte_time}
+
+
+def plan_bus(sensors: List[MPU6050], cost: Dict[str, float],
+             mux: bool = False) -> Dict[str, Any]:
+    """
+    Predict load of one bus.
+    Every FIFO is read when it is TARGET_FILL full, with one transaction
+    for FIFO count and one for data, plus channel switch on mux buses.
+    Headroom of a FIFO is what is left of it if the bus serves
+    all other sensors once before reading it.
+    max_byte_rate is total FIFO data rate the bus would sustain
+    at UTILIZATION_WARNING.
+    """
+    latency, byte_time = cost['latency'], cost['byte_time']
+    transactions = 3 if mux else 2
+    poll_bytes = TARGET_FILL * MPU6050_FIFO_SIZE
+    # Bus time of one poll of a sensor and per byte of FIFO data
+    poll_time = transactions * latency + (poll_bytes + 2 + 2 * transactions) * byte_time
+    cost_per_byte = poll_time / poll_bytes
+    byte_rates = {
+        sensor.id: sensor.sample_rate * sensor.package_length
+        for sensor in sensors
+    }
+    utilization = sum(byte_rates.values()) * cost_per_byte
+    sensors_info = {}
+    for sensor_id, byte_rate in byte_rates.items():
+        others = sum(1 for i, rate in byte_rates.items()
+                     if rate > 0 and i != sensor_id)
+        fill = poll_bytes + byte_rate * others * poll_time
+        sensors_info[sensor_id] = {
+            'byte_rate': round(byte_rate, 1),
+            'headroom': round(1 - fill / MPU6050_FIFO_SIZE, 3)
+        }
+    return {
+        'latency': round(latency, 6),
+        'byte_time': round(byte_time, 7),
+        'byte_rate': round(sum(byte_rates.values()), 1),
+        'max_byte_rate': round(UTILIZATION_WARNING / cost_per_byte, 1),
+        'utilization': round(utilization, 3),
+        'sensors': sensors_info
+    }
+
+
+def plan_verdict(buses: Dict[int, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Judge bus plans: 'error' if some bus or FIFO is predicted to overflow,
+    'warning' if they are close to it, 'ok' otherwise.
+    """
+    verdict = 'ok'
+    messages = []
+    for bus, plan in buses.items():
+        if plan['utilization'] >= 1:
+            verdict = 'error'
+            messages.append('Bus {} is overloaded ({:.0%} utilization)'.format(
+                bus, plan['utilization']
+            ))
+        elif plan['utilization'] >= UTILIZATION_WARNING:
+            verdict = max(verdict, 'warning', key=PLAN_VERDICTS.index)
+            messages.append('Bus {} is at {:.0%} utilization'.format(
+                bus, plan['utilization']
+            ))
+        for sensor_id, info in plan['sensors'].items():
+            if info['headroom'] <= 0:
+                verdict = 'error'
+                messages.append(f'FIFO of "{sensor_id}" would overflow')
+            elif info['headroom'] < HEADROOM_WARNING:
+                verdict = max(verdict, 'warning', key=PLAN_VERDICTS.index)
+                messages.append('FIFO of "{}" has {:.0%} headroom'.format(
+                    sensor_id, info['headroom']
+                ))
+    return {'verdict': verdict, 'messages': messages}
@@ -0,0 +1,213 @@
+"""
+Opt-in I2C transaction profiler.
+ProfiledBus wraps SMBus handle of a bus and records every transaction
+of register helpers and FIFO reads to I2CProfiler: counts, data bytes,
+errors, bus time and latency histogram per bus, device and register.
+"""
+
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from smbus2 import SMBus
+from smbus2.smbus2 import I2C_M_RD
+
+from imu_manager.mpu6050 import i2c_interface
+
+
+# Upper bounds of latency histogram buckets in microseconds,
+# the last bucket counts everything slower
+HISTOGRAM_BOUNDS_US = [1 << i for i in range(4, 17)]
+REGISTER_NAMES = {}
+for _name, _value in vars(i2c_interface).items():
+    if _name.startswith('MPU6050_RA_'):
+        REGISTER_NAMES.setdefault(_value, _name[len('MPU6050_RA_'):])
+
+# Record fields, histogram counts follow them
+TRANSACTIONS, BYTES, ERRORS, TIME, HISTOGRAM = range(5)
+
+Key = Tuple[int, str, Optional[int]]
+Records = Dict[Key, List[float]]
+
+
+def _new_record() -> List[float]:
+    return [0, 0, 0, 0.0] + [0] * (len(HISTOGRAM_BOUNDS_US) + 1)
+
+
+def _add(record: List[float], other: List[float], sign: int = 1):
+    for i, value in enumerate(other):
+        record[i] += sign * value
+
+
+def _register_name(register: Optional[int]) -> str:
+    if register is None:
+        return 'none'
+    return '{} (0x{:02X})'.format(REGISTER_NAMES.get(register, 'UNKNOWN'), register)
+
+
+def _summary(record: List[float]) -> Dict[str, Any]:
+    return {
+        'transactions': int(record[TRANSACTIONS]),
+        'bytes': int(record[BYTES]),
+        'errors': int(record[ERRORS]),
+        'time': round(record[TIME], 6),
+        'histogram': [int(x) for x in record[HISTOGRAM:]]
+    }
+
+
+class I2CProfiler:
+    """
+    Transaction records keyed by (bus, device, register).
+    Workers of other buses may add records while they are read,
+    so records are iterated over copies of the dictionary items,
+    which are taken atomically. No lock is held, since the profiler
+    is pickled to worker processes.
+    """
+
+    def __init__(self):
+        self.records = {}
+
+    def record(self, bus: int, device: str, register: Optional[int],
+               n_bytes: int, duration: float, error: bool = False):
+        key = (bus, device, register)
+        record = self.records.get(key)
+        if record is None:
+            record = self.records[key] = _new_record()
+        record[TRANSACTIONS] += 1
+        record[BYTES] += n_bytes
+        record[ERRORS] += error
+        record[TIME] += duration
+        bucket = int(duration * 1e6).bit_length() - 4
+        record[HISTOGRAM + min(max(bucket, 0), len(HISTOGRAM_BOUNDS_US))] += 1
+
+    def reset(self):
+        self.records = {}
+
+    def snapshot(self) -> Records:
+        return {key: record.copy() for key, record in list(self.records.items())}
+
+    def since(self, snapshot: Records, bus: int = None) -> Records:
+        """Records made after snapshot, of one bus or all of them"""
+        records = {}
+        for key, record in list(self.records.items()):
+            if bus is not None and key[0] != bus:
+                continue
+            record = record.copy()
+            if key in snapshot:
+                _add(record, snapshot[key], -1)
+            if record[TRANSACTIONS]:
+                records[key] = record
+        return records
+
+    def merge(self, records: Records):
+        """Add records made elsewhere, e.g. in worker process"""
+        for key, record in records.items():
+            _add(self.records.setdefault(key, _new_record()), record)
+
+    def export(self, records: Records = None) -> Dict[str, Any]:
+        """
+        Records (all by default) as nested dictionary
+        bus -> device -> register with totals on every level.
+        Time is in seconds, histogram counts transactions with latency
+        up to histogram_bounds_us.
+        """
+        if records is None:
+            records = dict(list(self.records.items()))
+        tree = {}
+        for (bus, device, register), record in records.items():
+            tree.setdefault(bus, {}).setdefault(device, {})[register] = record
+        buses = {}
+        for bus in sorted(tree):
+            bus_total = _new_record()
+            devices = {}
+            for device in sorted(tree[bus]):
+                device_total = _new_record()
+                registers = {}
+                for register in sorted(tree[bus][device],
+                                       key=lambda x: -1 if x is None else x):
+                    record = tree[bus][device][register]
+                    _add(device_total, record)
+                    registers[_register_name(register)] = _summary(record)
+                _add(bus_total, device_total)
+                devices[device] = dict(_summary(device_total), registers=registers)
+            buses[bus] = dict(_summary(bus_total), devices=devices)
+        return {'histogram_bounds_us': HISTOGRAM_BOUNDS_US, 'buses': buses}
+
+
+class ProfiledBus:
+    """
+    SMBus wrapper recording transactions to profiler.
+    device_name maps I2C address to the name records are kept under.
+    Raw ioctl transfers would bypass the wrapper, so fd is hidden
+    and FIFO reads fall back to i2c_rdwr.
+    """
+
+    fd = None
+
+    def __init__(self, bus: SMBus, profiler: I2CProfiler, bus_id: int,
+                 device_name: Callable[[int], str] = str):
+        self.bus = bus
+        self.profiler = profiler
+        self.bus_id = bus_id
+        self.device_name = device_name
+
+    def __getattr__(self, name):
+        if name == 'bus':
+            raise AttributeError(name)
+        return getattr(self.bus, name)
+
+    def _call(self, i2c_addr: int, register: Optional[int], n_bytes: int,
+              method: Callable, *args):
+        start = time.perf_counter()
+        error = True
+        try:
+            result = method(*args)
+            error = False
+            return result
+        finally:
+            self.profiler.record(
+                self.bus_id, self.device_name(i2c_addr), register, n_bytes,
+                time.perf_counter() - start, error
+            )
+
+    def close(self):
+        self.bus.close()
+
+    def read_byte(self, i2c_addr: int, force: bool = None) -> int:
+        return self._call(i2c_addr, None, 1, self.bus.read_byte,
+                          i2c_addr, force)
+
+    def write_byte(self, i2c_addr: int, value: int, force: bool = None):
+        self._call(i2c_addr, None, 1, self.bus.write_byte,
+                   i2c_addr, value, force)
+
+    def read_byte_data(self, i2c_addr: int, register: int,
+                       force: bool = None) -> int:
+        return self._call(i2c_addr, register, 1, self.bus.read_byte_data,
+                          i2c_addr, register, force)
+
+    def write_byte_data(self, i2c_addr: int, register: int, value: int,
+                        force: bool = None):
+        self._call(i2c_addr, register, 1, self.bus.write_byte_data,
+                   i2c_addr, register, value, force)
+
+    def read_i2c_block_data(self, i2c_addr: int, register: int, length: int,
+                            force: bool = None) -> List[int]:
+        return self._call(i2c_addr, register, length,
+                          self.bus.read_i2c_block_data,
+                          i2c_addr, register, length, force)
+
+    def write_i2c_block_data(self, i2c_addr: int, register: int,
+                             data: List[int], force: bool = None):
+        self._call(i2c_addr, register, len(data),
+                   self.bus.write_i2c_block_data,
+                   i2c_addr, register, data, force)
+
+    def i2c_rdwr(self, *i2c_msgs):
+        """Register is taken from the first byte of leading write message"""
+        first = i2c_msgs[0]
+        register = None
+        n_bytes = sum(msg.len for msg in i2c_msgs)
+        if not first.flags & I2C_M_RD and first.len:
+            register = first.buf[0][0]
+            n_bytes -= 1
+        self._call(first.addr, register, n_bytes, self.bus.i2c_rdwr, *i2c_msgs)
@@ -0,0 +1,196 @@
+"""
+FIFO poll scheduling for data collection sessions.
+"""
+
+import time
+from typing import Hashable, List, Optional
+
+
+class PollScheduler:
+    """
+    Deadline based FIFO poll scheduler.
+    Predicts FIFO fill of every sensor from its byte rate
+    (sample_rate * package_length) and sleeps until the earliest moment
+    a worthwhile burst (target fill) is available, instead of polling
+    FIFO counts nonstop. Rates and target fills adapt to observed
+    fill levels.
+    Due sensors are served in order of projected time to overflow,
+    so the most urgent FIFOs are drained first whatever their rates
+    and package lengths are.
+    On an overloaded bus long reads of some FIFOs make others overflow
+    before they are polled, again and again. FIFOs which overflowed
+    are protected until they are read: bus time per read byte is
+    estimated from reads, so other reads can be cut short before
+    protected FIFOs overflow again (see read_limit).
+    Sensors can be split to groups (e.g. multiplexer channels) which are
+    expensive to switch between. Then sensors of a due group which are
+    half way to their target are read along, and groups are served one
+    after another starting with the last one, to switch rarely.
+    """
+
+    def __init__(self, byte_rates: List[float], capacity: int = 1024,
+                 target_fill: float = 0.25, high_water: float = 0.6,
+                 alpha: float = 0.2, min_sleep: float = 0.0002,
+                 groups: Optional[List[Hashable]] = None,
+                 group_fill: float = 0.5, clock=time.perf_counter):
+        self.capacity = capacity
+        self.high_water = high_water * capacity
+        self.alpha = alpha
+        self.min_sleep = min_sleep
+        self.clock = clock
+        self.nominal_rates = list(byte_rates)
+        self.rates = list(byte_rates)
+        self.targets = [target_fill * capacity] * len(byte_rates)
+        self.polls = [0] * len(byte_rates)
+        self.empty_polls = [0] * len(byte_rates)
+        self.fill_sums = [0] * len(byte_rates)
+        self.max_fills = [0] * len(byte_rates)
+        # Estimated bus time per read byte, 0 until the first read
+        self.byte_time = 0.0
+        # Sensors with FIFO reset after overflow and not read since
+        self._protected = set()
+        self.group_fill = group_fill
+        self.groups = None
+        self._group = None
+        if groups is not None:
+            # Groups are replaced by their indices to make them sortable
+            indices = {}
+            self.groups = [indices.setdefault(g, len(indices)) for g in groups]
+        self._poll_times = [0.0] * len(byte_rates)
+        self._leftovers = [0] * len(byte_rates)
+        self._deadlines = [float('inf')] * len(byte_rates)
+
+    def start(self, t: float = None):
+        """Start scheduling, all FIFOs are expected to be empty at time t"""
+        if t is None:
+            t = self.clock()
+        self._protected.clear()
+        for i in range(len(self.rates)):
+            self._poll_times[i] = t
+            self._leftovers[i] = 0
+            self._update_deadline(i)
+
+    def _update_deadline(self, i: int):
+        if self.rates[i] <= 0:
+            self._deadlines[i] = float('inf')
+            return
+        delay = (self.targets[i] - self._leftovers[i]) / self.rates[i]
+        self._deadlines[i] = self._poll_times[i] + max(delay, 0.0)
+
+    @property
+    def next_deadline(self) -> float:
+        return min(self._deadlines, default=float('inf'))
+
+    def wait(self, until: float = float('inf')) -> List[int]:
+        """
+        Sleep until the earliest deadline, but not longer than until.
+        Returns indices of sensors which should be polled now.
+        """
+        wake_time = min(self.next_deadline, until)
+        delay = wake_time - self.clock()
+        if delay > self.min_sleep:
+            time.sleep(delay)
+        now = self.clock() + self.min_sleep
+        due = [i for i, deadline in enumerate(self._deadlines)
+               if deadline <= now]
+        if not due:
+            return due
+        if self.groups is None:
+            due.sort(key=lambda i: self.time_to_overflow(i, now))
+            return due
+        due_groups = {self.groups[i] for i in due}
+        for i, group in enumerate(self.groups):
+            if group in due_groups and self._deadlines[i] > now \
+                    and self.predicted_fill(i, now) >= \
+                    self.group_fill * self.targets[i]:
+                due.append(i)
+        # Groups with urgent FIFOs go first, then the current one
+        time_left = {i: self.time_to_overflow(i, now) for i in due}
+        group_time_left = {}
+        urgent_groups = set()
+        for i in due:
+            group = self.groups[i]
+            group_time_left[group] = min(time_left[i],
+                                         group_time_left.get(group, float('inf')))
+            if self.is_urgent(i, now):
+                urgent_groups.add(group)
+
+        def priority(i):
+            group = self.groups[i]
+            if group in urgent_groups:
+                return (0, group_time_left[group], time_left[i])
+            return (1, group != self._group, group_time_left[group], time_left[i])
+
+        due.sort(key=priority)
+        return due
+
+    def predicted_fill(self, i: int, t: float) -> float:
+        """Predicted FIFO count of sensor i at time t"""
+        return self._leftovers[i] + self.rates[i] * (t - self._poll_times[i])
+
+    def restart(self, i: int, t: float):
+        """Register FIFO reset of sensor i at time t"""
+        self._protected.add(i)
+        self._poll_times[i] = t
+        self._leftovers[i] = 0
+        self._update_deadline(i)
+
+    def time_to_overflow(self, i: int, t: float) -> float:
+        """Projected time from t until FIFO of sensor i overflows"""
+        if self.rates[i] <= 0:
+            return float('inf')
+        return (self.capacity - self.predicted_fill(i, t)) / self.rates[i]
+
+    def read_limit(self, i: int, t: float) -> int:
+        """
+        Number of bytes of sensor i which can be read at t while every other
+        protected FIFO stays below overflow, with the time left split evenly
+        between this read and reads of the protected FIFOs
+        """
+        if not self.byte_time:
+            return self.capacity
+        protected = [j for j in self._protected if j != i]
+        if not protected:
+            return self.capacity
+        time_left = min(self.time_to_overflow(j, t) for j in protected)
+        shares = len(protected) + 1
+        return int(min(time_left / (shares * self.byte_time), self.capacity))
+
+    def is_urgent(self, i: int, t: float) -> bool:
+        """Whether FIFO of sensor i is projected over high water mark at t"""
+        return self.predicted_fill(i, t) >= self.high_water
+
+    def update(self, i: int, t: float, fifo_count: int, read_length: int,
+               read_time: float = 0.0):
+        """
+        Register poll of sensor i at time t.
+        fifo_count is observed FIFO count, read_length is number of read bytes
+        and read_time is the time the poll took.
+        """
+        self.polls[i] += 1
+        if read_length:
+            self._protected.discard(i)
+        if read_length and read_time > 0:
+            byte_time = read_time / read_length
+            if self.byte_time:
+                byte_time = self.byte_time + self.alpha * (byte_time - self.byte_time)
+            self.byte_time = byte_time
+        self.fill_sums[i] += fifo_count
+        self.max_fills[i] = max(self.max_fills[i], fifo_count)
+        if self.groups is not None:
+            self._group = self.groups[i]
+        if read_length == 0 and fifo_count < self.capacity:
+            self.empty_polls[i] += 1
+        dt = t - self._poll_times[i]
+        if dt > 0 and fifo_count < self.capacity:
+            # Saturated FIFO doesn't tell the real rate
+            observed_rate = (fifo_count - self._leftovers[i]) / dt
+            rate = self.rates[i] + self.alpha * (observed_rate - self.rates[i])
+            nominal = self.nominal_rates[i]
+            self.rates[i] = min(max(rate, 0.5 * nominal), 2 * nominal)
+        if fifo_count >= self.high_water:
+            # Poll came too late, aim for lower fill next time
+            self.targets[i] = max(self.targets[i] * 0.8, 0.1 * self.capacity)
+        self._poll_times[i] = t
+        self._leftovers[i] = fifo_count - read_length
+        self._update_deadline(i)
@@ -0,0 +1,113 @@
+"""
+TCA9548A I2C multiplexer support.
+Every channel of a multiplexer is a separate bus segment, so sensors with
+the same address can be connected to different channels of one bus.
+"""
+
+from typing import Iterable, List, Optional
+
+from smbus2 import SMBus
+
+
+TCA9548A_DEFAULT_ADDRESS = 0x70
+TCA9548A_CHANNELS = 8
+
+
+class MuxBus:
+    """
+    Physical I2C bus with TCA9548A multiplexers.
+    Remembers selected (mux address, channel), so channel is switched only
+    when a sensor of another channel is accessed. Selecting None
+    disconnects all channels, leaving only devices connected directly.
+    """
+
+    def __init__(self, bus: SMBus, mux_addresses: Iterable[int]):
+        self.bus = bus
+        self.mux_addresses = list(mux_addresses)
+        self.selected = None
+        self.switches = 0
+
+    def select(self, mux_address: Optional[int], channel: Optional[int]):
+        """Connect channel of mux to bus, disconnecting any other channel"""
+        if self.selected == (mux_address, channel):
+            return
+        if self.selected is None:
+            # State is unknown, all muxes have to be disconnected
+            for address in self.mux_addresses:
+                if address != mux_address:
+                    self.bus.write_byte(address, 0)
+        elif self.selected[0] is not None and self.selected[0] != mux_address:
+            self.bus.write_byte(self.selected[0], 0)
+        if mux_address is not None:
+            self.bus.write_byte(mux_address, 1 << channel)
+        self.selected = (mux_address, channel)
+        self.switches += 1
+
+    def invalidate(self):
+        """Forget selected channel, e.g. after it was switched by other process"""
+        self.selected = None
+
+
+class MuxChannel:
+    """
+    SMBus wrapper selecting its mux channel before every transaction.
+    mux_address None stands for devices connected to bus directly.
+    """
+
+    def __init__(self, mux_bus: MuxBus, mux_address: Optional[int] = None,
+                 channel: Optional[int] = None):
+        if mux_address is not None and not 0 <= channel < TCA9548A_CHANNELS:
+            raise ValueError(f'Invalid TCA9548A channel: {channel}')
+        self.mux_bus = mux_bus
+        self.mux_address = mux_address
+        self.channel = channel
+
+    def select(self):
+        self.mux_bus.select(self.mux_address, self.channel)
+
+    @property
+    def fd(self):
+        """
+        File descriptor for raw ioctl transfers.
+        They bypass this wrapper, so the channel is selected on access.
+        """
+        fd = getattr(self.mux_bus.bus, 'fd', None)
+        if fd is not None:
+            self.select()
+        return fd
+
+    def close(self):
+        pass
+
+    def read_byte(self, i2c_addr: int, force: bool = None) -> int:
+        self.select()
+        return self.mux_bus.bus.read_byte(i2c_addr, force)
+
+    def write_byte(self, i2c_addr: int, value: int, force: bool = None):
+        self.select()
+        self.mux_bus.bus.write_byte(i2c_addr, value, force)
+
+    def read_byte_data(self, i2c_addr: int, register: int,
+                       force: bool = None) -> int:
+        self.select()
+        return self.mux_bus.bus.read_byte_data(i2c_addr, register, force)
+
+    def write_byte_data(self, i2c_addr: int, register: int, value: int,
+                        force: bool = None):
+        self.select()
+        self.mux_bus.bus.write_byte_data(i2c_addr, register, value, force)
+
+    def read_i2c_block_data(self, i2c_addr: int, register: int, length: int,
+                            force: bool = None) -> List[int]:
+        self.select()
+        return self.mux_bus.bus.read_i2c_block_data(i2c_addr, register,
+                                                    length, force)
+
+    def write_i2c_block_data(self, i2c_addr: int, register: int,
+                             data: List[int], force: bool = None):
+        self.select()
+        self.mux_bus.bus.write_i2c_block_data(i2c_addr, register, data, force)
+
+    def i2c_rdwr(self, *i2c_msgs):
+        self.select()
+        self.mux_bus.bus.i2c_rdwr(*i2c_msgs)
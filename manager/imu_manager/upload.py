@@ -0,0 +1,310 @@
+"""
+Streaming upload of session parts.
+Files are packed to a tar stream, compressed with selected codec and
+sent to file server in checksummed chunks. Packing runs in its own thread,
+so compression overlaps with sending and no archive is written to disk.
+Interrupted uploads are resumed from the last acknowledged offset:
+the stream is packed again, which gives the same bytes, and only
+the part the server doesn't have yet is sent.
+"""
+
+import os
+import time
+import zlib
+import queue
+import hashlib
+import logging
+import tarfile
+import threading
+import contextlib
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import requests
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+# Archive extension of every codec, tells the user client how to unpack it
+CODECS = {
+    'none': '.tar',
+    'deflate': '.tar.gz',
+    'zstd': '.tar.zst',
+    'lz4': '.tar.lz4'
+}
+# Compressed data is passed from packer thread in chunks of this size
+CHUNK_SIZE = 1 << 16
+# Chunks packed ahead of sending, bounds memory if network is slow
+QUEUE_CHUNKS = 32
+# Bytes sent in one request, each of them is acknowledged by file server
+UPLOAD_CHUNK = 1 << 20
+# Failed uploads are resumed this many times, with delay doubled
+# after every failure
+UPLOAD_RETRIES = 10
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 30.0
+
+
+class _Resume(Exception):
+    """File server rejected a chunk, upload is resumed from its offset"""
+
+
+def available_codecs() -> List[str]:
+    """Codecs with installed compression libraries"""
+    codecs = ['none', 'deflate']
+    if zstandard is not None:
+        codecs.append('zstd')
+    if lz4 is not None:
+        codecs.append('lz4')
+    return codecs
+
+
+class _Identity:
+    def compress(self, data: bytes) -> bytes:
+        return bytes(data)
+
+    def flush(self) -> bytes:
+        return b''
+
+
+class _LZ4:
+    def __init__(self, level: int):
+        self.__compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self.__header = self.__compressor.begin()
+
+    def compress(self, data: bytes) -> bytes:
+        header, self.__header = self.__header, b''
+        return header + self.__compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self.__header + self.__compressor.flush()
+
+
+def compressor(codec: str, level: Optional[int] = None) -> Any:
+    """Streaming compressor object with compress and flush methods"""
+    if codec not in available_codecs():
+        raise ValueError(f'Codec is not available: {codec}')
+    if codec == 'none':
+        return _Identity()
+    if codec == 'deflate':
+        # Gzip container, so the stream is a regular .tar.gz
+        level = zlib.Z_DEFAULT_COMPRESSION if level is None else level
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+    return _LZ4(0 if level is None else level)
+
+
+class _ChunkWriter:
+    """File-like tar output compressing data to chunks of a queue"""
+
+    def __init__(self, codec: str, level: Optional[int],
+                 chunks: queue.Queue, cancel: threading.Event):
+        self.compressor = compressor(codec, level)
+        self.chunks = chunks
+        self.cancel = cancel
+        self.raw_bytes = 0
+        self.__buffer = bytearray()
+
+    def __put(self, chunk: bytes):
+        while not self.cancel.is_set():
+            try:
+                self.chunks.put(chunk, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise RuntimeError('Upload cancelled')
+
+    def write(self, data: bytes) -> int:
+        self.raw_bytes += len(data)
+        self.__buffer += self.compressor.compress(data)
+        if len(self.__buffer) >= CHUNK_SIZE:
+            self.__put(bytes(self.__buffer))
+            self.__buffer.clear()
+        return len(data)
+
+    def close(self):
+        self.__buffer += self.compressor.flush()
+        if self.__buffer:
+            self.__put(bytes(self.__buffer))
+            self.__buffer.clear()
+
+
+class StreamUpload:
+    """
+    Upload of files as one archive streamed to file server at url.
+    files are (path, name in archive) pairs. Transfer statistics
+    are in stats after upload().
+    """
+
+    def __init__(self, url: str, name: str, files: List[Tuple[str, str]],
+                 codec: str = 'deflate', level: Optional[int] = None,
+                 retries: int = UPLOAD_RETRIES):
+        if codec not in CODECS:
+            raise ValueError(f'Unknown codec: {codec}')
+        self.url = url
+        self.file_name = name + CODECS[codec]
+        self.files = files
+        self.codec = codec
+        self.level = level
+        self.retries = retries
+        self.stats = {}
+        self.__error = None
+        # Last offset acknowledged by server
+        self.__offset = 0
+
+    def __pack(self, writer: _ChunkWriter, chunks: queue.Queue):
+        try:
+            with tarfile.open(fileobj=writer, mode='w|') as archive:
+                for path, name in self.files:
+                    archive.add(path, arcname=name)
+            writer.close()
+        except Exception as e:
+            self.__error = e
+        finally:
+            chunks.put(None)
+
+    def __chunks(self) -> Iterator[bytes]:
+        chunks = queue.Queue(QUEUE_CHUNKS)
+        cancel = threading.Event()
+        writer = _ChunkWriter(self.codec, self.level, chunks, cancel)
+        packer = threading.Thread(target=self.__pack, name='UploadPacker',
+                                  args=(writer, chunks), daemon=True)
+        packer.start()
+        self.__error = None
+        packed = 0
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                packed += len(chunk)
+                yield chunk
+        finally:
+            # Request failed or finished, packer must not block on full queue
+            cancel.set()
+            while packer.is_alive():
+                try:
+                    chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.stats['raw_bytes'] = writer.raw_bytes
+            self.stats['packed_bytes'] = packed
+        if self.__error is not None:
+            raise self.__error
+
+    def __put(self, session: requests.Session, upload_id: str, offset: int,
+              body: bytearray, timeout: Optional[float]) -> int:
+        """Send chunk at offset, return offset acknowledged by server"""
+        self.stats['sent_bytes'] += len(body)
+        response = session.put(
+            url=f'{self.url}/uploads/{upload_id}',
+            params={'offset': offset},
+            data=bytes(body),
+            headers={
+                'Content-Type': 'application/octet-stream',
+                'X-Chunk-SHA256': hashlib.sha256(body).hexdigest()
+            },
+            timeout=timeout
+        )
+        if response.status_code in (400, 409):
+            # Chunk corrupted on the way, or previous one was received
+            # but its acknowledgement was lost
+            raise _Resume('Chunk at {} rejected: {}'.format(offset, response.text))
+        response.raise_for_status()
+        self.__offset = response.json()['offset']
+        return self.__offset
+
+    def __send(self, session: requests.Session, upload_id: str,
+               timeout: Optional[float]) -> str:
+        """
+        Send stream from the offset server has acknowledged,
+        return SHA-256 of the whole stream.
+        """
+        response = session.get(f'{self.url}/uploads/{upload_id}', timeout=timeout)
+        response.raise_for_status()
+        offset = self.__offset = response.json()['offset']
+        sha256 = hashlib.sha256()
+        position = 0
+        body = bytearray()
+        with contextlib.closing(self.__chunks()) as chunks:
+            for chunk in chunks:
+                sha256.update(chunk)
+                # Bytes before offset are on the server already
+                start = max(offset + len(body) - position, 0)
+                if start < len(chunk):
+                    body += chunk[start:]
+                position += len(chunk)
+                if len(body) >= UPLOAD_CHUNK:
+                    offset = self.__put(session, upload_id, offset, body, timeout)
+                    body.clear()
+        if body:
+            self.__put(session, upload_id, offset, body, timeout)
+        return sha256.hexdigest()
+
+    def upload(self, timeout: float = None) -> Dict[str, Any]:
+        """
+        Send archive, resuming it after network failures.
+        Gives up after retries failures in a row without any
+        acknowledged progress. timeout applies to every request.
+        Returns response of file server.
+        """
+        start = time.perf_counter()
+        self.stats = {'codec': self.codec, 'sent_bytes': 0, 'retries': 0}
+        delay = RETRY_DELAY
+        failures = 0
+        self.__offset = offset = 0
+        upload_id, sha256 = None, None
+        with requests.Session() as session:
+            while True:
+                try:
+                    if upload_id is None:
+                        response = session.post(f'{self.url}/uploads', timeout=timeout,
+                                                json={'filename': self.file_name})
+                        response.raise_for_status()
+                        upload_id = response.json()['upload_id']
+                    if sha256 is None:
+                        sha256 = self.__send(session, upload_id, timeout)
+                    response = session.post(
+                        f'{self.url}/uploads/{upload_id}/complete',
+                        json={'sha256': sha256}, timeout=timeout
+                    )
+                    if response.status_code == 422:
+                        # Dropped by server, start over
+                        upload_id, sha256 = None, None
+                        self.__offset = offset = 0
+                        raise _Resume('File checksum mismatch')
+                    response.raise_for_status()
+                    break
+                except (requests.ConnectionError, requests.Timeout, _Resume) as e:
+                    if self.__offset > offset:
+                        # Resumed upload got further, count failures anew
+                        offset = self.__offset
+                        failures, delay = 0, RETRY_DELAY
+                    if failures >= self.retries:
+                        raise
+                    failures += 1
+                    self.stats['retries'] += 1
+                    logging.warning('Upload of {} failed: {}, resuming in {:.0f} s'.format(
+                        self.file_name, e, delay
+                    ))
+                    time.sleep(delay)
+                    delay = min(delay * 2, MAX_RETRY_DELAY)
+        self.stats['time'] = round(time.perf_counter() - start, 3)
+        return response.json()
+
+
+def session_files(session_path: str) -> List[Tuple[str, str]]:
+    """All files of session directory with names relative to it"""
+    files = []
+    for root, _, names in os.walk(session_path):
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            files.append((path, os.path.relpath(path, session_path)))
+    return files
@@ -1,4 +1,5 @@
 import os
+import queue
 import shutil
 import threading
 import traceback
@@ -40,6 +41,28 @@ class TempDir:
                 os.remove(path)
 
 
+class BufferPool:
+    """
+    Pool of preallocated bytearrays.
+    Buffers are reused instead of being allocated in hot loops.
+    """
+
+    def __init__(self, buffer_size: int, n_buffers: int):
+        self.buffer_size = buffer_size
+        self.n_buffers = n_buffers
+        self.__free = queue.SimpleQueue()
+        for _ in range(n_buffers):
+            self.__free.put(bytearray(buffer_size))
+
+    def acquire(self, block: bool = True, timeout: float = None) -> bytearray:
+        """Take buffer from pool, waits until one is released if pool is empty"""
+        return self.__free.get(block, timeout)
+
+    def release(self, buffer: bytearray):
+        """Return buffer to pool"""
+        self.__free.put(buffer)
+
+
 class CommandThread(threading.Thread):
     """Thread for executing commands outside of main thread"""
 
@@ -0,0 +1,248 @@
+"""
+Session files written outside of acquisition loop.
+Bus worker copies FIFO data to ring buffers and a writer thread
+flushes them to storage in large blocks, so storage stalls
+don't delay FIFO reads. Data can also be encoded by the writer thread
+(see encoding module), out of the acquisition loop.
+"""
+
+import time
+import threading
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+
+# Writer thread flushes a ring once this much data is buffered in it
+# (at most half of the ring),
+WRITE_BLOCK = 1 << 16
+# or when it has been waiting this long
+WRITE_INTERVAL = 0.5
+# Full ring is rechecked this often while the reader stalls
+STALL_POLL = 0.005
+
+
+class RingBuffer:
+    """
+    Bounded byte ring with one writer and one reader thread.
+    Positions only grow and each is advanced by one side,
+    so no lock is needed.
+    """
+
+    def __init__(self, capacity: int):
+        if capacity <= 0:
+            raise ValueError(f'Invalid ring buffer capacity: {capacity}')
+        self.capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.head = 0
+        self.tail = 0
+        self.high_water = 0
+        # Flush threshold, small rings are flushed before they fill up
+        self.block = min(WRITE_BLOCK, max(capacity // 2, 1))
+        # Set by the writer while it waits for space
+        self.stalled = False
+        self.space = threading.Event()
+
+    def __len__(self) -> int:
+        return self.tail - self.head
+
+    def put(self, data) -> bool:
+        """Copy data to ring, False if there is no space for it"""
+        n = len(data)
+        used = self.tail - self.head
+        if used + n > self.capacity:
+            return False
+        start = self.tail % self.capacity
+        first = min(n, self.capacity - start)
+        self.view[start:start + first] = data[:first]
+        if first < n:
+            self.view[:n - first] = data[first:]
+        self.tail += n
+        self.high_water = max(self.high_water, used + n)
+        return True
+
+    def chunks(self, end: Optional[int] = None) -> List[memoryview]:
+        """Buffered data (up to position end) as at most two contiguous views"""
+        used = (self.tail if end is None else end) - self.head
+        start = self.head % self.capacity
+        first = min(used, self.capacity - start)
+        chunks = [self.view[start:start + first]]
+        if first < used:
+            chunks.append(self.view[:used - first])
+        return chunks
+
+    def consume(self, n: int):
+        """Free n bytes read from chunks"""
+        self.head += n
+        self.space.set()
+
+
+class SessionWriter(threading.Thread):
+    """
+    Thread writing ring buffers to their files.
+    write() is called by acquisition loop, it only copies data
+    and waits (a stall) only if the ring is full.
+    on_close is called by the thread once all files are written and closed.
+    Data of every stream is passed through compress and flush
+    methods of its encoder before it's written, if it has one.
+    rotate() switches all streams to new files, rings are kept.
+    """
+
+    def __init__(self, name: str, paths: List[str], capacities: List[int],
+                 on_close: Callable[[], None] = None,
+                 encoders: Optional[List[Any]] = None):
+        super().__init__(name=name, daemon=True)
+        self.paths = paths
+        self.rings = [RingBuffer(capacity) for capacity in capacities]
+        self.encoders = encoders or [None] * len(paths)
+        self.stalls = [0] * len(paths)
+        self.stall_time = [0.0] * len(paths)
+        self.error = None
+        self.on_close = on_close
+        self.__files = []
+        # Pending rotations: ring positions they start at, paths,
+        # on_close and encoders of new files
+        self.__rotations = deque()
+        self.__stop_event = threading.Event()
+        self.__wake_event = threading.Event()
+
+    def start(self):
+        # Opened in calling thread, so bad paths fail before acquisition
+        self.__files = [open(path, 'wb', buffering=0) for path in self.paths]
+        super().start()
+
+    def write(self, stream: int, data):
+        ring = self.rings[stream]
+        if ring.put(data):
+            if len(ring) >= ring.block:
+                self.__wake_event.set()
+            return
+        if len(data) > ring.capacity:
+            raise ValueError(f'Write of {len(data)} bytes exceeds ring buffer capacity')
+        self.stalls[stream] += 1
+        start = time.perf_counter()
+        ring.stalled = True
+        self.__wake_event.set()
+        try:
+            while True:
+                # Cleared before the retry, so space freed meanwhile isn't missed
+                ring.space.clear()
+                if ring.put(data):
+                    break
+                if not self.is_alive():
+                    raise RuntimeError(f'Session writer failed: {self.error}')
+                ring.space.wait(STALL_POLL)
+        finally:
+            ring.stalled = False
+        self.stall_time[stream] += time.perf_counter() - start
+
+    def rotate(self, paths: List[str], on_close: Callable[[], None] = None,
+               encoders: Optional[List[Any]] = None):
+        """
+        Start new files at the current end of every ring.
+        The thread finishes and closes the old files, calls their on_close
+        and opens the new ones, so the calling loop does no file I/O.
+        """
+        if not self.is_alive():
+            raise RuntimeError(f'Session writer failed: {self.error}')
+        ends = [ring.tail for ring in self.rings]
+        self.__rotations.append((ends, paths, on_close, encoders or [None] * len(paths)))
+        self.__wake_event.set()
+
+    @staticmethod
+    def __write_all(f, data):
+        written = 0
+        while written < len(data):
+            written += f.write(data[written:])
+
+    def __flush(self, stream: int, end: Optional[int] = None, final: bool = False):
+        ring, f, encoder = self.rings[stream], self.__files[stream], self.encoders[stream]
+        for chunk in ring.chunks(end):
+            self.__write_all(f, chunk if encoder is None else encoder.compress(chunk))
+            ring.consume(len(chunk))
+        if final and encoder is not None:
+            self.__write_all(f, encoder.flush())
+
+    def __close_files(self):
+        """Close current files and call their on_close"""
+        files, self.__files = self.__files, []
+        for f in files:
+            f.close()
+        if self.on_close is not None:
+            try:
+                self.on_close()
+            except Exception as e:
+                # Later files are still written, error is raised by close()
+                if self.error is None:
+                    self.error = e
+
+    def __rotate(self):
+        """Finish files of pending rotations and open the new ones"""
+        while self.__rotations:
+            ends, paths, on_close, encoders = self.__rotations.popleft()
+            for i, end in enumerate(ends):
+                self.__flush(i, end, final=True)
+            self.__close_files()
+            self.paths, self.on_close, self.encoders = paths, on_close, encoders
+            for path in paths:
+                self.__files.append(open(path, 'wb', buffering=0))
+
+    def run(self):
+        try:
+            last_flush = [time.perf_counter()] * len(self.rings)
+            while True:
+                # Read before rotations are checked, so data written
+                # after a rotation never reaches files it finishes
+                tails = [ring.tail for ring in self.rings]
+                if self.__rotations:
+                    self.__rotate()
+                    continue
+                if self.__stop_event.is_set():
+                    break
+                now = time.perf_counter()
+                for i, ring in enumerate(self.rings):
+                    used = tails[i] - ring.head
+                    # Stalled ring is flushed whatever it holds
+                    if used >= ring.block or ring.stalled \
+                            or (used and now - last_flush[i] >= WRITE_INTERVAL):
+                        self.__flush(i, tails[i])
+                        last_flush[i] = now
+                self.__wake_event.wait(WRITE_INTERVAL)
+                self.__wake_event.clear()
+            # Rotations queued right before stop
+            self.__rotate()
+            for i in range(len(self.rings)):
+                self.__flush(i, final=True)
+        except Exception as e:
+            self.error = e
+            for f in self.__files:
+                f.close()
+        else:
+            self.__close_files()
+
+    def stop(self):
+        """Let thread flush everything and close files, don't wait for it"""
+        self.__stop_event.set()
+        self.__wake_event.set()
+
+    def close(self):
+        """Flush everything, close files, raise error of writer thread"""
+        self.stop()
+        if self.is_alive():
+            self.join()
+        if self.error is not None:
+            raise self.error
+
+    def info(self) -> List[Dict[str, Any]]:
+        """Ring capacity, high-water mark and stalls of every stream over all files"""
+        return [
+            {
+                'capacity': ring.capacity,
+                'high_water': ring.high_water,
+                'high_water_fill': round(ring.high_water / ring.capacity, 3),
+                'stalls': stalls,
+                'stall_time': round(stall_time, 3)
+            }
+            for ring, stalls, stall_time
+            in zip(self.rings, self.stalls, self.stall_time)
+        ]
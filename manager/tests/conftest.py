@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from imu_manager.mpu6050 import i2c_interface as mpu
+from imu_manager.mpu6050.emulator import EmulatedBackend, EmulatedMPU6050
+
+
+class FakeClock:
+    """Clock of emulated sensors and schedulers, moved by tests"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def backend():
+    return EmulatedBackend(seed=1)
+
+
+def start_sampling(bus, address=mpu.MPU6050_DEFAULT_ADDRESS, rate=9):
+    """
+    Wake emulated sensor and fill FIFO with accel and gyro packages
+    at 1 kHz / (1 + rate)
+    """
+    bus.write_byte_data(address, mpu.MPU6050_RA_PWR_MGMT_1, 0)
+    bus.write_byte_data(address, mpu.MPU6050_RA_CONFIG, mpu.MPU6050_DLPF_BW_188)
+    bus.write_byte_data(address, mpu.MPU6050_RA_SMPLRT_DIV, rate)
+    bus.write_byte_data(address, mpu.MPU6050_RA_FIFO_EN, 0x78)
+    bus.write_byte_data(address, mpu.MPU6050_RA_USER_CTRL,
+                        1 << mpu.MPU6050_USERCTRL_FIFO_EN_BIT)
+
+
+@pytest.fixture
+def sampling_sensor(backend, clock):
+    """Emulated sensor on bus 0 sampling at 100 Hz, with its bus handle"""
+    sensor = backend.attach(0, mpu.MPU6050_DEFAULT_ADDRESS,
+                            EmulatedMPU6050(seed=1, clock=clock))
+    bus = backend(0)
+    start_sampling(bus)
+    return sensor, bus
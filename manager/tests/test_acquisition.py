@@ -0,0 +1,41 @@
+import pytest
+
+from imu_manager.manager import Manager
+from imu_manager.mpu6050.emulator import EmulatedBackend
+from imu_manager.utils import Singleton
+
+
+ADDRESS = 0x68
+MUX_ADDRESS = 0x70
+# 8 kHz of 12 byte packages, three such sensors need about five times
+# the bandwidth of the emulated bus
+CONFIGURATION = (1, 0, 0, 0, 0, True, True, True, True)
+
+
+@pytest.fixture
+def manager():
+    Singleton._instances.pop(Manager, None)
+    yield Manager
+    Singleton._instances.pop(Manager, None)
+
+
+@pytest.mark.parametrize('mux', [False, True])
+def test_overloaded_bus_serves_every_sensor(manager, tmp_path, mux):
+    backend = EmulatedBackend(latency=0.0001, byte_time=9 / 400000, seed=1)
+    if mux:
+        for channel in range(3):
+            backend.attach(0, ADDRESS, mux_address=MUX_ADDRESS, mux_channel=channel)
+        hub = manager('hub', [], [ADDRESS], backend,
+                      muxes=[(0, MUX_ADDRESS, [0, 1, 2])])
+    else:
+        for address in range(ADDRESS, ADDRESS + 3):
+            backend.attach(0, address)
+        hub = manager('hub', [0], list(range(ADDRESS, ADDRESS + 3)), backend)
+    assert len(hub.sensors) == 3
+    hub.configure_sensors(*CONFIGURATION)
+    info = hub.start_session(str(tmp_path / 'session'), 'session', 0.5)
+    n_packages = info['n_packages']
+    assert all(info['overflows'].values())
+    # Every sensor gets a share of the bus
+    for sensor_id, n in n_packages.items():
+        assert n > 0.1 * sum(n_packages.values()), n_packages
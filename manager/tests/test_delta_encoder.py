@@ -0,0 +1,59 @@
+import struct
+
+import pytest
+
+from imu_manager.encoding import (BLOCK_HEADER, CHANNEL_HEADER, DeltaEncoder,
+                                  encoder, pack_bits)
+
+
+def packages(readings):
+    """Big-endian FIFO packages of reading tuples"""
+    return b''.join(struct.pack(f'>{len(r)}h', *r) for r in readings)
+
+
+def test_pack_bits():
+    assert pack_bits([1, 0, 3], 2) == bytes([0b110001, 0])
+    assert pack_bits([5] * 9, 3) == bytes([0b01101101, 0b11011011, 0b10110110, 5, 0, 0])
+    assert pack_bits([0, 0], 0) == b''
+
+
+def test_blocks_are_framed():
+    encoder = DeltaEncoder(4, block=4)
+    data = packages([(i, 7) for i in range(6)])
+    block = encoder.compress(data)
+    assert BLOCK_HEADER.unpack_from(block) == (4,)
+    offset = BLOCK_HEADER.size
+    # Readings grow by one, the constant channel takes no bits
+    assert CHANNEL_HEADER.unpack_from(block, offset) == (0, 1, 0)
+    assert CHANNEL_HEADER.unpack_from(block, offset + CHANNEL_HEADER.size) == (7, 0, 0)
+    assert len(block) == BLOCK_HEADER.size + 2 * CHANNEL_HEADER.size
+    last = encoder.flush()
+    assert BLOCK_HEADER.unpack_from(last) == (2,)
+    assert CHANNEL_HEADER.unpack_from(last, BLOCK_HEADER.size) == (4, 1, 0)
+    assert encoder.flush() == b''
+
+
+def test_deltas_are_packed_above_smallest():
+    encoder = DeltaEncoder(2)
+    block = encoder.compress(packages([(-5,), (-3,), (-4,)])) + encoder.flush()
+    offset = BLOCK_HEADER.size
+    assert CHANNEL_HEADER.unpack_from(block, offset) == (-5, -1, 2)
+    # Deltas 2 and -1 are stored as 3 and 0
+    assert block[offset + CHANNEL_HEADER.size:] == bytes([0b0011, 0])
+
+
+def test_flush_within_package():
+    encoder = DeltaEncoder(4)
+    encoder.compress(b'\x00' * 6)
+    with pytest.raises(ValueError):
+        encoder.flush()
+
+
+def test_encoder_selection():
+    assert encoder('none', 12) is None
+    assert encoder('delta', 0) is None
+    assert isinstance(encoder('delta', 12), DeltaEncoder)
+    with pytest.raises(ValueError):
+        encoder('zstd', 12)
+    with pytest.raises(ValueError):
+        DeltaEncoder(3)
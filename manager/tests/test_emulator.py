@@ -0,0 +1,87 @@
+import errno
+import pickle
+
+import pytest
+
+from imu_manager.mpu6050 import i2c_interface as mpu
+from imu_manager.mpu6050.emulator import FIFO_SIZE
+
+
+ADDRESS = mpu.MPU6050_DEFAULT_ADDRESS
+MUX_ADDRESS = 0x70
+
+
+def test_fifo_fills_at_sample_rate(sampling_sensor, clock):
+    sensor, bus = sampling_sensor
+    assert sensor.sample_rate == 100
+    assert sensor.package_length == 12
+    clock.now += 0.105
+    assert sensor.fifo_count == 10 * 12
+    data = bus.read_i2c_block_data(ADDRESS, mpu.MPU6050_RA_FIFO_R_W, 24)
+    assert len(data) == 24
+    assert sensor.fifo_count == 8 * 12
+
+
+def test_fifo_overflow(sampling_sensor, clock):
+    sensor, bus = sampling_sensor
+    clock.now += 2.005
+    assert sensor.fifo_count == FIFO_SIZE
+    assert sensor.overflows == 1
+    assert sensor.lost_packages == pytest.approx(200 - FIFO_SIZE / 12)
+    status = bus.read_byte_data(ADDRESS, mpu.MPU6050_RA_INT_STATUS)
+    assert status & 1 << mpu.MPU6050_INTERRUPT_FIFO_OFLOW_BIT
+    # Interrupt status is cleared by reading it
+    assert bus.read_byte_data(ADDRESS, mpu.MPU6050_RA_INT_STATUS) == 0
+    bus.write_byte_data(ADDRESS, mpu.MPU6050_RA_USER_CTRL,
+                        1 << mpu.MPU6050_USERCTRL_FIFO_EN_BIT
+                        | 1 << mpu.MPU6050_USERCTRL_FIFO_RESET_BIT)
+    assert sensor.fifo_count == 0
+    # Reset bit clears itself
+    assert bus.read_byte_data(ADDRESS, mpu.MPU6050_RA_USER_CTRL) == \
+        1 << mpu.MPU6050_USERCTRL_FIFO_EN_BIT
+
+
+def test_power_on_reset(sampling_sensor, clock):
+    sensor, bus = sampling_sensor
+    clock.now += 0.105
+    sensor.power_on_reset()
+    assert sensor.fifo_count == 0
+    assert bus.read_byte_data(ADDRESS, mpu.MPU6050_RA_PWR_MGMT_1) == 0x40
+    clock.now += 0.105
+    # Sleeping sensor doesn't sample
+    assert sensor.fifo_count == 0
+
+
+def test_missing_device(backend):
+    with pytest.raises(OSError) as e:
+        backend(0).read_byte_data(ADDRESS, mpu.MPU6050_RA_WHO_AM_I)
+    assert e.value.errno == errno.ENXIO
+
+
+def test_mux_channels(backend):
+    first = backend.attach(1, ADDRESS, mux_address=MUX_ADDRESS, mux_channel=0)
+    second = backend.attach(1, ADDRESS, mux_address=MUX_ADDRESS, mux_channel=3)
+    bus = backend(1)
+    with pytest.raises(OSError):
+        # No channel is connected
+        bus.read_byte_data(ADDRESS, mpu.MPU6050_RA_WHO_AM_I)
+    bus.write_byte(MUX_ADDRESS, 1 << 3)
+    bus.write_byte_data(ADDRESS, mpu.MPU6050_RA_SMPLRT_DIV, 7)
+    bus.write_byte(MUX_ADDRESS, 1 << 0)
+    assert bus.read_byte_data(ADDRESS, mpu.MPU6050_RA_SMPLRT_DIV) == 0
+    assert first.sample_rate != second.sample_rate
+    bus.write_byte(MUX_ADDRESS, 1 << 0 | 1 << 3)
+    with pytest.raises(OSError) as e:
+        # Both sensors answer
+        bus.read_byte_data(ADDRESS, mpu.MPU6050_RA_WHO_AM_I)
+    assert e.value.errno == errno.EIO
+    assert backend.sensors() == [first, second]
+
+
+def test_pickled_backend_emulates_copies(sampling_sensor, backend):
+    sensor, bus = sampling_sensor
+    copy = pickle.loads(pickle.dumps(backend))
+    copy_bus = copy(0)
+    assert copy_bus.read_byte_data(ADDRESS, mpu.MPU6050_RA_FIFO_EN) == 0x78
+    copy_bus.write_byte_data(ADDRESS, mpu.MPU6050_RA_SMPLRT_DIV, 0)
+    assert bus.read_byte_data(ADDRESS, mpu.MPU6050_RA_SMPLRT_DIV) == 9
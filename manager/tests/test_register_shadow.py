@@ -0,0 +1,120 @@
+import pytest
+
+from imu_manager.mpu6050 import i2c_interface as mpu
+from imu_manager.mpu6050.i2c import RegisterShadow
+from imu_manager.mpu6050.i2c_interface import MPU6050_I2C
+
+
+ADDRESS = mpu.MPU6050_DEFAULT_ADDRESS
+CONFIGURATION = {
+    'clock_source': mpu.MPU6050_CLOCK_PLL_XGYRO,
+    'dlpf_mode': mpu.MPU6050_DLPF_BW_42,
+    'rate': 4,
+    'full_scale_accel_range': mpu.MPU6050_ACCEL_FS_4,
+    'full_scale_gyro_range': mpu.MPU6050_GYRO_FS_500,
+    'accel_fifo_enabled': True,
+    'x_gyro_fifo_enabled': True,
+    'y_gyro_fifo_enabled': False,
+    'z_gyro_fifo_enabled': True
+}
+
+
+@pytest.fixture
+def shadow(backend):
+    backend.attach(0, ADDRESS)
+    return RegisterShadow(backend(0), ADDRESS, MPU6050_I2C.SHADOW_BLOCKS,
+                          MPU6050_I2C.VOLATILE_REGISTERS,
+                          MPU6050_I2C.SELF_CLEARING_BITS)
+
+
+def open_sensor(backend, bus_id=0):
+    """MPU6050_I2C on emulated bus with its raw bus handle"""
+    handles = []
+
+    def bus_factory(bus):
+        handles.append(backend(bus))
+        return handles[-1]
+
+    return MPU6050_I2C(bus_id, ADDRESS, bus_factory), handles[0]
+
+
+def test_shadowed_reads_stay_off_bus(shadow):
+    shadow.fill()
+    bus = shadow.bus
+    transactions = bus.transactions
+    assert shadow.read_byte_data(ADDRESS, mpu.MPU6050_RA_PWR_MGMT_1) == 0x40
+    shadow.write_byte_data(ADDRESS, mpu.MPU6050_RA_SMPLRT_DIV, 7)
+    assert shadow.read_i2c_block_data(ADDRESS, mpu.MPU6050_RA_SMPLRT_DIV, 2) == [7, 0]
+    # Only the write went to the bus
+    assert bus.transactions == transactions + 1
+    # WHO_AM_I isn't shadowed
+    assert shadow.read_byte_data(ADDRESS, mpu.MPU6050_RA_WHO_AM_I) == ADDRESS
+    assert bus.transactions == transactions + 2
+
+
+def test_volatile_registers_pass_through(shadow):
+    shadow.fill()
+    bus = shadow.bus
+    transactions = bus.transactions
+    shadow.read_byte_data(ADDRESS, mpu.MPU6050_RA_I2C_MST_STATUS)
+    shadow.read_i2c_block_data(ADDRESS, mpu.MPU6050_RA_FIFO_COUNTH, 2)
+    assert bus.transactions == transactions + 2
+
+
+def test_self_clearing_bits_are_not_shadowed(shadow):
+    shadow.write_byte_data(ADDRESS, mpu.MPU6050_RA_USER_CTRL,
+                           1 << mpu.MPU6050_USERCTRL_FIFO_EN_BIT
+                           | 1 << mpu.MPU6050_USERCTRL_FIFO_RESET_BIT)
+    assert shadow.get(mpu.MPU6050_RA_USER_CTRL) == 1 << mpu.MPU6050_USERCTRL_FIFO_EN_BIT
+    assert shadow.verify(mpu.MPU6050_RA_USER_CTRL, 3) == []
+
+
+def test_verify_detects_reset(shadow, backend):
+    shadow.write_byte_data(ADDRESS, mpu.MPU6050_RA_PWR_MGMT_1, 0)
+    assert shadow.verify(mpu.MPU6050_RA_PWR_MGMT_1, 1) == []
+    backend.sensors()[0].power_on_reset()
+    assert shadow.verify(mpu.MPU6050_RA_PWR_MGMT_1, 1) == [mpu.MPU6050_RA_PWR_MGMT_1]
+
+
+def test_sensor_is_primed_on_init(backend):
+    backend.attach(0, ADDRESS)
+    sensor, bus = open_sensor(backend)
+    transactions = bus.transactions
+    assert sensor.get_rate() == 0
+    assert sensor.get_clock_source() == mpu.MPU6050_CLOCK_INTERNAL
+    assert bus.transactions == transactions
+
+
+def test_set_configuration_matches_setters(backend):
+    backend.attach(0, ADDRESS)
+    backend.attach(1, ADDRESS)
+    configured, configured_bus = open_sensor(backend)
+    transactions = configured_bus.transactions
+    configured.set_configuration(**CONFIGURATION)
+    configured_transactions = configured_bus.transactions - transactions
+
+    set_up, set_up_bus = open_sensor(backend, 1)
+    transactions = set_up_bus.transactions
+    for field, value in CONFIGURATION.items():
+        getattr(set_up, 'set_' + field)(value)
+    assert configured_transactions < set_up_bus.transactions - transactions
+
+    first, second = backend.sensors()
+    for start, length in MPU6050_I2C.SHADOW_BLOCKS:
+        assert first.read(start, length) == second.read(start, length)
+    assert configured.get_rate() == 4
+    assert configured.get_dlpf_mode() == mpu.MPU6050_DLPF_BW_42
+
+
+def test_write_registers_raises_on_mismatch(backend):
+    backend.attach(0, ADDRESS)
+    sensor, _ = open_sensor(backend)
+    with pytest.raises(OSError):
+        # Device reset restores defaults instead of the written image
+        sensor.write_registers({
+            mpu.MPU6050_RA_SMPLRT_DIV: 3,
+            mpu.MPU6050_RA_PWR_MGMT_1: 1 << mpu.MPU6050_PWR1_DEVICE_RESET_BIT | 1
+        })
+    # Shadow is read again from device
+    assert sensor.get_rate() == 0
+    assert sensor.get_sleep_enabled() == 1
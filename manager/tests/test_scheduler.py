@@ -0,0 +1,97 @@
+import pytest
+
+from imu_manager.scheduler import PollScheduler
+
+
+def test_deadline_from_byte_rate(clock):
+    scheduler = PollScheduler([1000.0, 4000.0], clock=clock)
+    scheduler.start(0.0)
+    # Target fill is a quarter of 1024 bytes
+    assert scheduler.next_deadline == pytest.approx(256 / 4000)
+    assert scheduler.wait(until=0.01) == []
+    clock.now = 0.07
+    assert scheduler.wait(until=clock.now) == [1]
+    assert scheduler.predicted_fill(1, clock.now) == pytest.approx(280)
+
+
+def test_due_sensors_by_time_to_overflow(clock):
+    scheduler = PollScheduler([1000.0, 4000.0, 2000.0], clock=clock)
+    scheduler.start(0.0)
+    clock.now = 0.3
+    assert scheduler.wait(until=clock.now) == [1, 2, 0]
+    assert scheduler.is_urgent(1, clock.now)
+    assert not scheduler.is_urgent(0, clock.now)
+    assert scheduler.time_to_overflow(0, clock.now) == pytest.approx(0.724)
+
+
+def test_update_adapts_rate_and_target(clock):
+    scheduler = PollScheduler([1000.0], alpha=0.5, clock=clock)
+    scheduler.start(0.0)
+    scheduler.update(0, 0.2, fifo_count=240, read_length=240)
+    # Observed 1200 B/s
+    assert scheduler.rates[0] == pytest.approx(1100)
+    assert scheduler.next_deadline == pytest.approx(0.2 + 256 / 1100)
+    scheduler.update(0, 0.9, fifo_count=720, read_length=720)
+    assert scheduler.targets[0] == pytest.approx(0.8 * 256)
+    assert scheduler.max_fills[0] == 720
+    # Rate is clamped to twice the nominal
+    scheduler.update(0, 0.91, fifo_count=1000, read_length=0)
+    assert scheduler.rates[0] == 2000
+    assert scheduler.empty_polls[0] == 1
+    assert scheduler.polls[0] == 3
+
+
+def test_saturated_fifo_keeps_rate(clock):
+    scheduler = PollScheduler([1000.0], clock=clock)
+    scheduler.start(0.0)
+    scheduler.update(0, 0.5, fifo_count=1024, read_length=1020)
+    assert scheduler.rates[0] == 1000
+    assert scheduler.empty_polls[0] == 0
+    scheduler.restart(0, 0.6)
+    assert scheduler.predicted_fill(0, 0.6) == 0
+
+
+def test_groups_are_read_along(clock):
+    scheduler = PollScheduler([1000.0, 1000.0, 900.0, 500.0],
+                              groups=[(1, 0), (1, 0), (1, 0), (1, 1)],
+                              clock=clock)
+    scheduler.start(0.0)
+    scheduler.update(0, 0.2, fifo_count=200, read_length=200)
+    clock.now = 0.257
+    # Sensor 2 is half way to its target and read along with sensor 1,
+    # sensor 0 was polled recently
+    assert scheduler.wait(until=clock.now) == [1, 2]
+
+
+def test_current_group_goes_first(clock):
+    scheduler = PollScheduler([1000.0, 1000.0], groups=['a', 'b'], clock=clock)
+    scheduler.start(0.0)
+    scheduler.update(0, 0.3, fifo_count=300, read_length=300)
+    scheduler.update(1, 0.31, fifo_count=310, read_length=310)
+    clock.now = 0.6
+    assert scheduler.wait(until=clock.now) == [1, 0]
+    # Urgent FIFOs go first whatever the current group is
+    clock.now = 0.95
+    assert scheduler.wait(until=clock.now) == [0, 1]
+
+
+def test_reads_are_limited_for_overflowed_fifos(clock):
+    scheduler = PollScheduler([96000.0, 96000.0, 96000.0], clock=clock)
+    scheduler.start(0.0)
+    # Bus speed isn't known before the first read
+    assert scheduler.read_limit(0, 0.0) == 1024
+    scheduler.update(0, 0.002, fifo_count=192, read_length=192, read_time=0.0048)
+    assert scheduler.byte_time == pytest.approx(0.000025)
+    # No FIFO has overflowed
+    assert scheduler.read_limit(0, 0.01) == 1024
+    scheduler.restart(1, 0.01)
+    # Sensor 1 overflows in 1024 / 96000 s, reads of sensor 0 take half of it
+    assert scheduler.read_limit(0, 0.01) == 213
+    assert scheduler.read_limit(1, 0.01) == 1024
+    # Two protected FIFOs are read after sensor 0, each gets a third of the time
+    scheduler.restart(2, 0.01)
+    assert scheduler.read_limit(0, 0.01) == 142
+    assert scheduler.read_limit(2, 0.01) == 213
+    scheduler.update(1, 0.012, fifo_count=192, read_length=192, read_time=0.0048)
+    scheduler.update(2, 0.012, fifo_count=192, read_length=192, read_time=0.0048)
+    assert scheduler.read_limit(0, 0.02) == 1024
@@ -0,0 +1,69 @@
+import zlib
+
+import pytest
+
+from imu_manager.writer import RingBuffer, SessionWriter
+
+
+def test_ring_buffer_wraps_around():
+    ring = RingBuffer(8)
+    assert ring.put(b'abcdef')
+    assert not ring.put(b'ghi')
+    assert bytes(ring.chunks()[0]) == b'abcdef'
+    ring.consume(4)
+    assert ring.put(b'ghij')
+    assert [bytes(c) for c in ring.chunks()] == [b'efgh', b'ij']
+    assert [bytes(c) for c in ring.chunks(ring.tail - 1)] == [b'efgh', b'i']
+    ring.consume(6)
+    assert len(ring) == 0
+    assert ring.high_water == 6
+    with pytest.raises(ValueError):
+        RingBuffer(0)
+
+
+def test_session_writer_rotates_files(tmp_path):
+    closed = []
+    first = [str(tmp_path / 'a.0'), str(tmp_path / 'b.0')]
+    second = [str(tmp_path / 'a.1'), str(tmp_path / 'b.1')]
+    writer = SessionWriter('writer', first, [16, 64],
+                           on_close=lambda: closed.append(0))
+    writer.start()
+    writer.write(0, b'0123')
+    writer.write(1, b'x' * 40)
+    writer.rotate(second, on_close=lambda: closed.append(1))
+    # Small ring stalls until the writer thread frees it
+    for i in range(10):
+        writer.write(0, b'%04d' % i)
+    writer.write(1, b'y' * 10)
+    writer.close()
+    assert closed == [0, 1]
+    assert (tmp_path / 'a.0').read_bytes() == b'0123'
+    assert (tmp_path / 'b.0').read_bytes() == b'x' * 40
+    assert (tmp_path / 'a.1').read_bytes() == b''.join(b'%04d' % i for i in range(10))
+    assert (tmp_path / 'b.1').read_bytes() == b'y' * 10
+    info = writer.info()
+    assert info[0]['high_water'] <= 16
+    assert info[1]['capacity'] == 64
+
+
+def test_session_writer_encodes_streams(tmp_path):
+    data = bytes(range(256)) * 64
+    path = tmp_path / 'data'
+    writer = SessionWriter('writer', [str(path)], [4096],
+                           encoders=[zlib.compressobj()])
+    writer.start()
+    for start in range(0, len(data), 1000):
+        writer.write(0, data[start:start + 1000])
+    writer.close()
+    assert zlib.decompress(path.read_bytes()) == data
+
+
+def test_session_writer_reports_on_close_error(tmp_path):
+    def on_close():
+        raise OSError('disk gone')
+
+    writer = SessionWriter('writer', [str(tmp_path / 'data')], [16], on_close)
+    writer.start()
+    writer.write(0, b'data')
+    with pytest.raises(OSError, match='disk gone'):
+        writer.close()
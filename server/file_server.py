@@ -5,12 +5,46 @@ Handles data from sensor managers and sends it to the user client.
 
 import shutil
 import os
+import re
+import json
+import uuid
+import hashlib
 
-from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import FileResponse
+from fastapi import Body, FastAPI, File, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse
 
 
+# Data and state of unfinished chunked uploads
+UPLOADS_DIR = "uploads"
+
 app = FastAPI()
+os.makedirs(UPLOADS_DIR, exist_ok=True)
+
+
+def _upload_paths(upload_id: str):
+    """Data and state file of a chunked upload"""
+    data_path = os.path.join(UPLOADS_DIR, f"{upload_id}.part")
+    state_path = os.path.join(UPLOADS_DIR, f"{upload_id}.json")
+    if not re.fullmatch(r"[0-9a-f]{32}", upload_id) \
+            or not os.path.isfile(state_path):
+        raise HTTPException(status_code=404, detail="Unknown upload")
+    return data_path, state_path
+
+
+def _upload_offset(data_path: str) -> int:
+    """Number of received bytes of unfinished upload"""
+    if not os.path.isfile(data_path):
+        raise HTTPException(status_code=409, detail="Upload is completed")
+    return os.path.getsize(data_path)
+
+
+def _file_sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
 
 
 @app.get("/ping")
@@ -25,6 +59,69 @@ async def upload_file(file: UploadFile = File(...)):
     return {"filename": file.filename, "url": f"/download/{file.filename}"}
 
 
+@app.post("/uploads")
+async def create_upload(info: dict = Body(...)):
+    """Start chunked upload of a file"""
+    upload_id = uuid.uuid4().hex
+    with open(os.path.join(UPLOADS_DIR, f"{upload_id}.json"), "w") as f:
+        json.dump({"filename": os.path.basename(info["filename"])}, f)
+    open(os.path.join(UPLOADS_DIR, f"{upload_id}.part"), "wb").close()
+    return {"upload_id": upload_id, "offset": 0}
+
+
+@app.get("/uploads/{upload_id}")
+async def upload_status(upload_id: str):
+    """Number of received bytes, uploads are resumed from there"""
+    data_path, _ = _upload_paths(upload_id)
+    return {"upload_id": upload_id, "offset": _upload_offset(data_path)}
+
+
+@app.put("/uploads/{upload_id}")
+async def upload_chunk(upload_id: str, offset: int, request: Request):
+    """
+    Append chunk at offset. Chunk is rejected if offset isn't the number
+    of received bytes (409) or X-Chunk-SHA256 header doesn't match (400).
+    """
+    data_path, _ = _upload_paths(upload_id)
+    chunk = await request.body()
+    # No awaits from here on, so chunks of retried requests can't interleave
+    size = _upload_offset(data_path)
+    if offset != size:
+        return JSONResponse(status_code=409, content={"offset": size})
+    if hashlib.sha256(chunk).hexdigest() != request.headers.get("x-chunk-sha256"):
+        return JSONResponse(status_code=400, content={
+            "offset": size, "detail": "Chunk checksum mismatch"
+        })
+    with open(data_path, "ab") as f:
+        f.write(chunk)
+    return {"offset": size + len(chunk)}
+
+
+@app.post("/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str, info: dict = Body(...)):
+    """
+    Check SHA-256 of the whole file and make it available for download.
+    Corrupted uploads are dropped (422). Completing again returns the same file.
+    """
+    data_path, state_path = _upload_paths(upload_id)
+    with open(state_path, "r") as f:
+        state = json.load(f)
+    if "completed" not in state:
+        if await run_in_threadpool(_file_sha256, data_path) != info["sha256"]:
+            os.remove(data_path)
+            os.remove(state_path)
+            raise HTTPException(status_code=422, detail="File checksum mismatch")
+        filename = state["filename"]
+        if os.path.exists(filename):
+            filename = f"{upload_id[:8]}_{filename}"
+        os.replace(data_path, filename)
+        state["completed"] = filename
+        with open(state_path, "w") as f:
+            json.dump(state, f)
+    filename = state["completed"]
+    return {"filename": filename, "url": f"/download/{filename}"}
+
+
 @app.get("/download/{filename}")
 async def download_file(filename: str):
     return FileResponse(filename)
@@ -0,0 +1,129 @@
+"""
+Fixtures of tests running sensor manager, user client and file server
+together. Sensors are emulated, file server runs behind a local HTTP
+server which can drop connections and corrupt chunks.
+"""
+
+import os
+import sys
+import asyncio
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+for path in ['manager', os.path.join('user_client', 'user_client'), 'server']:
+    sys.path.insert(0, os.path.join(ROOT, path))
+
+from imu_manager.manager import Manager
+from imu_manager.utils import Singleton
+
+
+@pytest.fixture
+def make_manager():
+    """Manager factory, every call creates a new instance of the singleton"""
+
+    def make(*args, **kwargs) -> Manager:
+        Singleton._instances.pop(Manager, None)
+        return Manager(*args, **kwargs)
+
+    yield make
+    Singleton._instances.pop(Manager, None)
+
+
+class FileServer:
+    """
+    File server app behind a threaded HTTP server.
+    Faults queued in put_faults and complete_faults are applied to
+    successive chunk and completion requests:
+    'before' drops the connection before the app gets the request,
+    'after' drops it once the app has handled it,
+    'corrupt' flips a byte of the request body.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.put_faults = deque()
+        self.complete_faults = deque()
+        self.requests = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def fault(self, method: str, path: str):
+        if method == 'PUT' and self.put_faults:
+            return self.put_faults.popleft()
+        if path.endswith('/complete') and self.complete_faults:
+            return self.complete_faults.popleft()
+        return None
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def handle_request(self):
+                path, _, query = self.path.partition('?')
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                fault = server.fault(self.command, path)
+                server.requests.append((self.command, path, fault))
+                if fault == 'before':
+                    self.close_connection = True
+                    return
+                if fault == 'corrupt':
+                    body = bytes([body[0] ^ 0xFF]) + body[1:]
+                scope = {
+                    'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+                    'method': self.command, 'scheme': 'http', 'path': path,
+                    'raw_path': path.encode(), 'query_string': query.encode(),
+                    'root_path': '', 'client': self.client_address,
+                    'server': self.server.server_address,
+                    'headers': [(k.lower().encode(), v.encode())
+                                for k, v in self.headers.items()]
+                }
+                messages = []
+
+                async def receive():
+                    return {'type': 'http.request', 'body': body, 'more_body': False}
+
+                async def send(message):
+                    messages.append(message)
+
+                asyncio.run(server.app(scope, receive, send))
+                if fault == 'after':
+                    self.close_connection = True
+                    return
+                start = messages[0]
+                data = b''.join(m.get('body', b'') for m in messages[1:])
+                self.send_response(start['status'])
+                for key, value in start['headers']:
+                    if key.lower() != b'content-length':
+                        self.send_header(key.decode(), value.decode())
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_PUT = do_POST = handle_request
+
+        return Handler
+
+
+@pytest.fixture
+def file_server(tmp_path, monkeypatch):
+    """File server storing files in its own working directory"""
+    pytest.importorskip('fastapi')
+    server_dir = tmp_path / 'server'
+    (server_dir / 'uploads').mkdir(parents=True)
+    monkeypatch.chdir(server_dir)
+    from file_server import app
+    server = FileServer(app)
+    server.thread.start()
+    yield server
+    server.server.shutdown()
+    server.server.server_close()
@@ -0,0 +1,145 @@
+import struct
+
+import numpy as np
+import pytest
+
+from imu_manager import container as hub_container
+from imu_manager import encoding as hub_encoding
+from imu_manager.acquisition import INDEX_STRUCT
+
+import container as client_container
+import encoding as client_encoding
+
+
+def test_format_constants():
+    """Hub and user client keep their own copies of the format"""
+    for name in ['MAGIC', 'VERSION', 'CONTAINER_DIR', 'CONTAINER_EXT', 'INDEX_SUFFIX',
+                 'ALIGNMENT', 'ID_LENGTH', 'FLAG_MERGED', 'FIFO_ACCEL',
+                 'FIFO_GYRO_X', 'FIFO_GYRO_Y', 'FIFO_GYRO_Z']:
+        assert getattr(hub_container, name) == getattr(client_container, name), name
+    for name in ['HEADER', 'DEVICE', 'SENSOR', 'GAP']:
+        hub_struct = getattr(hub_container, name)
+        client_struct = getattr(client_container, name)
+        assert hub_struct.format == client_struct.format, name
+    assert hub_encoding.ENCODINGS == client_encoding.ENCODINGS
+    for name in ['BLOCK_HEADER', 'CHANNEL_HEADER']:
+        assert getattr(hub_encoding, name).format == getattr(client_encoding, name).format
+    # Sensor records are unpacked into SENSOR_FIELDS after the ID
+    assert len(client_container.SENSOR_FIELDS) == len(hub_container.SENSOR.unpack(
+        bytes(hub_container.SENSOR.size))) - 1
+    # Gaps and index entries are read as arrays of records
+    gap = (1.5, 2.25, 7, 3)
+    assert client_container.GAP_DTYPE.itemsize == hub_container.GAP.size
+    assert np.frombuffer(hub_container.GAP.pack(*gap),
+                         dtype=client_container.GAP_DTYPE)[0].tolist() == gap
+    entry = (0.125, 42)
+    assert client_container.INDEX_DTYPE.itemsize == INDEX_STRUCT.size
+    assert np.frombuffer(INDEX_STRUCT.pack(*entry),
+                         dtype=client_container.INDEX_DTYPE)[0].tolist() == entry
+
+
+def sensor_info(accel, gyro_z, sample_rate):
+    return {
+        'package_length': 6 * accel + 2 * gyro_z,
+        'accel_fifo_enabled': accel,
+        'x_gyro_fifo_enabled': False,
+        'y_gyro_fifo_enabled': False,
+        'z_gyro_fifo_enabled': gyro_z,
+        'sample_rate': sample_rate,
+        'accel_factor': 16384.0,
+        'gyro_factor': 131.0
+    }
+
+
+@pytest.mark.parametrize('encoding', ['none', 'delta'])
+def test_hub_container_in_client(tmp_path, encoding):
+    """Session part written by the hub reads back the same in the user client"""
+    rng = np.random.default_rng(2)
+    sensors = {
+        'hub_B0A104': sensor_info(True, True, 1000),
+        'hub_B1A104M112C3': sensor_info(False, True, 500),
+        'hub_B1A105': sensor_info(False, False, 1000)
+    }
+    n_packages = {'hub_B0A104': 700, 'hub_B1A104M112C3': 300, 'hub_B1A105': 0}
+    overflows = {'hub_B0A104': [[0.1, 0.2, 100, 85]], 'hub_B1A104M112C3': [],
+                 'hub_B1A105': []}
+    readings, data_paths, index_paths = {}, {}, {}
+    for sensor_id, info in sensors.items():
+        channels = info['package_length'] // 2
+        values = rng.integers(-2 ** 15, 2 ** 15, size=(n_packages[sensor_id], channels))
+        readings[sensor_id] = values
+        data = values.astype('>i2').tobytes()
+        encoder = hub_encoding.encoder(encoding, info['package_length'])
+        if encoder is not None:
+            data = encoder.compress(data) + encoder.flush()
+        data_paths[sensor_id] = str(tmp_path / f'{sensor_id}.data')
+        index_paths[sensor_id] = data_paths[sensor_id] + hub_container.INDEX_SUFFIX
+        with open(data_paths[sensor_id], 'wb') as f:
+            f.write(data)
+        with open(index_paths[sensor_id], 'wb') as f:
+            for i in range(0, n_packages[sensor_id], 256):
+                f.write(INDEX_STRUCT.pack(i / info['sample_rate'], i))
+    session_info = {
+        'device_id': 'hub',
+        'encoding': encoding,
+        'time': {'start': 1700000000.25, 'duration': 0.7},
+        'sensors': sensors,
+        'n_packages': n_packages,
+        'overflows': overflows,
+        'segments': {'count': 2},
+        'mux_switches': {'1': {'switches': 12}}
+    }
+    session_path = str(tmp_path / 'session')
+    path = hub_container.write_session_part(session_path, session_info,
+                                            data_paths, index_paths)
+    assert path == client_container.container_path(session_path, 'hub')
+
+    with client_container.SessionContainer(path) as container:
+        assert not container.merged
+        assert container.segments == 2
+        assert container.duration == 0.7
+        assert container.devices == [('hub', 1700000000.25)]
+        assert container.info == {'device_id': 'hub', 'sensors': sensors,
+                                  'segments': {'count': 2},
+                                  'mux_switches': {'1': {'switches': 12}}}
+        assert list(container.sensors) == list(sensors)
+        for sensor_id, info in sensors.items():
+            sensor = container.sensors[sensor_id]
+            assert sensor['device'] == 0
+            assert sensor['encoding'] == client_encoding.ENCODINGS[encoding]
+            assert sensor['fifo'] == client_container.fifo_flags(info)
+            for key in ['package_length', 'sample_rate', 'accel_factor', 'gyro_factor']:
+                assert sensor[key] == info[key], key
+            assert sensor['n_packages'] == n_packages[sensor_id]
+            assert container.crop(sensor_id) == (-1, -1)
+            assert container.gaps(sensor_id).tolist() == \
+                [tuple(gap) for gap in overflows[sensor_id]]
+            with open(index_paths[sensor_id], 'rb') as f:
+                assert container.index(sensor_id).tolist() == \
+                    list(INDEX_STRUCT.iter_unpack(f.read()))
+            packages = container.packages(sensor_id)
+            if info['package_length']:
+                assert packages.tolist() == readings[sensor_id].tolist()
+            else:
+                assert packages.shape == (0, 0)
+            # Blocks stay aligned for memory mapping
+            for key in ['gaps_offset', 'index_offset', 'data_offset']:
+                assert sensor[key] % client_container.ALIGNMENT == 0
+
+
+def test_merged_flag_and_crop(tmp_path):
+    """Header flags and crops of the hub writer are read by the client"""
+    path = str(tmp_path / 'merged.imu')
+    hub_container.write_container(
+        path, [('hub_a', 10.0), ('hub_b', 10.5)],
+        [{'id': 'hub_b_B0A104', 'device': 1, 'package_length': 2,
+          'fifo': hub_container.FIFO_GYRO_Z, 'sample_rate': 100,
+          'accel_factor': 1.0, 'gyro_factor': 2.0, 'n_packages': 4, 'crop': [1, 3],
+          'gaps': [], 'index': [], 'data': [struct.pack('>4h', 1, 2, 3, 4)]}],
+        {}, 1.5, flags=hub_container.FLAG_MERGED)
+    with client_container.SessionContainer(path) as container:
+        assert container.merged
+        assert container.devices == [('hub_a', 10.0), ('hub_b', 10.5)]
+        assert container.crop('hub_b_B0A104') == (1, 3)
+        assert container.sensors['hub_b_B0A104']['device'] == 1
+        assert container.packages('hub_b_B0A104').ravel().tolist() == [1, 2, 3, 4]
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from imu_manager.encoding import DeltaEncoder
+
+from encoding import decode_delta
+
+
+def random_walk(n, channels, seed=1):
+    rng = np.random.default_rng(seed)
+    steps = rng.integers(-40, 40, size=(n, channels))
+    return np.clip(np.cumsum(steps, axis=0), -32768, 32767).astype('>i2')
+
+
+def encode(packages, block=256, chunk=1000):
+    """Packages encoded by the hub, fed to encoder in chunks like FIFO reads"""
+    encoder = DeltaEncoder(packages.shape[1] * 2, block)
+    data = packages.tobytes()
+    encoded = [encoder.compress(data[start:start + chunk])
+               for start in range(0, len(data), chunk)]
+    return b''.join(encoded) + encoder.flush()
+
+
+def test_encoded_packages_are_decoded():
+    packages = random_walk(1000, 6)
+    encoded = encode(packages)
+    assert len(encoded) < packages.nbytes / 2
+    decoded = decode_delta(encoded, 12)
+    assert decoded.dtype == np.dtype('>i2')
+    np.testing.assert_array_equal(decoded, packages)
+
+
+def test_encoded_files_concatenate():
+    first, second = random_walk(300, 3, seed=1), random_walk(40, 3, seed=2)
+    decoded = decode_delta(encode(first) + encode(second), 6)
+    np.testing.assert_array_equal(decoded, np.concatenate([first, second]))
+    assert decode_delta(b'', 6).shape == (0, 3)
+
+
+def test_truncated_data():
+    encoded = encode(random_walk(300, 3))
+    with pytest.raises(ValueError):
+        decode_delta(encoded[:-1], 6)
+
+
+def swings(n, channels):
+    """Readings jumping between int16 extremes, deltas take 17 bits"""
+    packages = np.full((n, channels), -32768, dtype='>i2')
+    packages[1::2] = 32767
+    return packages
+
+
+@pytest.mark.parametrize('n', [1, 2, 9, 255, 256, 257, 600])
+@pytest.mark.parametrize('channels', [1, 3, 6, 7])
+@pytest.mark.parametrize('readings', ['walk', 'zero', 'constant', 'swings', 'mixed'])
+def test_round_trip(n, channels, readings):
+    if readings == 'walk':
+        packages = random_walk(n, channels)
+    elif readings == 'zero':
+        packages = np.zeros((n, channels), dtype='>i2')
+    elif readings == 'constant':
+        packages = np.full((n, channels), -1234, dtype='>i2')
+    elif readings == 'swings':
+        packages = swings(n, channels)
+    else:
+        # Every kind of channel in one package
+        packages = random_walk(n, channels)
+        packages[:, 0] = 7
+        packages[:, -1] = swings(n, 1)[:, 0]
+    for chunk in [2 * channels, 1000, packages.nbytes or 1]:
+        decoded = decode_delta(encode(packages, chunk=chunk), 2 * channels)
+        np.testing.assert_array_equal(decoded, packages)
@@ -0,0 +1,74 @@
+import os
+import shutil
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from imu_manager.mpu6050.emulator import EmulatedBackend
+
+from container import SessionContainer, container_path
+from session_processor import Session
+
+
+ADDRESS = 0x68
+# 100 Hz of accel and gyro packages
+CONFIGURATION = (1, 1, 9, 0, 0, True, True, True, True)
+
+
+def test_merge_hubs(make_manager, tmp_path):
+    """Hubs starting at different times, one of them with segments"""
+    parts = {}
+    for device_id in ['hub_a', 'hub_b']:
+        backend = EmulatedBackend(seed=len(parts))
+        backend.attach(0, ADDRESS)
+        parts[device_id] = make_manager(device_id, [0], [ADDRESS], backend)
+        parts[device_id].configure_sensors(*CONFIGURATION)
+    infos = {}
+
+    def run(device_id, **kwargs):
+        infos[device_id] = parts[device_id].start_session(
+            str(tmp_path / device_id), 'session', 0.8, **kwargs
+        )
+
+    first = threading.Thread(target=run, args=('hub_a',))
+    first.start()
+    time.sleep(0.3)
+    run('hub_b', segment_duration=0.3)
+    first.join()
+
+    # User client unpacks parts of all hubs to one directory
+    session_path = str(tmp_path / 'session')
+    for device_id in parts:
+        shutil.copytree(tmp_path / device_id, session_path, dirs_exist_ok=True)
+    session = Session(session_path)
+    assert sorted(session.device_ids) == ['hub_a', 'hub_b']
+    session.merge()
+    session.decode()
+    assert sorted(os.listdir(session_path)) == [
+        'containers', 'hub_a_B0A104.csv', 'hub_b_B0A104.csv'
+    ]
+    assert os.listdir(os.path.join(session_path, 'containers')) == ['session.imu']
+
+    delta_t = infos['hub_b']['time']['start'] - infos['hub_a']['time']['start']
+    assert delta_t > 0.2
+    with SessionContainer(container_path(session_path, 'session')) as container:
+        assert container.merged
+        assert container.devices == [(device_id, infos[device_id]['time']['start'])
+                                     for device_id in ['hub_a', 'hub_b']]
+        assert set(container.info['devices']) == {'hub_a', 'hub_b'}
+        a_start, a_end = container.crop('hub_a_B0A104')
+        b_start, b_end = container.crop('hub_b_B0A104')
+        # Earlier hub is cropped to the start of the later one
+        assert a_start == int(delta_t * 100)
+        assert b_start == 0
+        assert a_end - a_start == b_end - b_start
+        # Segments of the later hub are stitched
+        assert len(container.packages('hub_b_B0A104')) \
+            == infos['hub_b']['n_packages']['hub_b_B0A104']
+    a = pd.read_csv(os.path.join(session_path, 'hub_a_B0A104.csv'))
+    b = pd.read_csv(os.path.join(session_path, 'hub_b_B0A104.csv'))
+    assert len(a) == len(b) == b_end
+    # Both start with the later hub, up to delays of sampling start
+    assert a['timestamp'][0] == pytest.approx(b['timestamp'][0], abs=0.1)
@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from imu_manager.mpu6050.emulator import EmulatedBackend
+
+from container import SessionContainer
+from session_processor import Session
+
+
+ADDRESS = 0x68
+MUX_ADDRESS = 0x70
+# Clock source, DLPF mode, sample rate divider, full scale ranges
+# and FIFO content: 8 kHz of 12 byte packages is more than
+# the emulated bus can read, so the FIFO overflows
+FAST = (1, 0, 0, 0, 0, True, True, True, True)
+# 4 kHz of two byte packages, which the bus keeps up with
+SLOW = (1, 0, 1, 0, 0, False, False, False, True)
+
+
+@pytest.fixture
+def backend():
+    backend = EmulatedBackend(latency=0.0001, byte_time=9 / 400000, seed=3)
+    backend.attach(0, ADDRESS)
+    backend.attach(1, ADDRESS, mux_address=MUX_ADDRESS, mux_channel=0)
+    backend.attach(1, ADDRESS, mux_address=MUX_ADDRESS, mux_channel=1)
+    return backend
+
+
+@pytest.mark.parametrize('workers, encoding', [('thread', 'delta'),
+                                               ('process', 'none')])
+def test_session(make_manager, backend, tmp_path, workers, encoding):
+    manager = make_manager('hub', [0], [ADDRESS], backend, workers,
+                           [(1, MUX_ADDRESS, [0, 1])], encoding=encoding)
+    fast = manager.bus_handles.sensor_id(0, ADDRESS)
+    slow = [manager.bus_handles.sensor_id(1, ADDRESS, MUX_ADDRESS, channel)
+            for channel in [0, 1]]
+    assert sorted(manager.sensors) == sorted([fast] + slow)
+    manager.configure_sensor(fast, *FAST)
+    for sensor_id in slow:
+        manager.configure_sensor(sensor_id, *SLOW)
+
+    segments = []
+    session_path = str(tmp_path / 'session')
+    info = manager.start_session(session_path, 'session', 1.0,
+                                 segment_duration=0.4,
+                                 on_segment=lambda segment, paths: segments.append(segment))
+    assert info['overflows'][fast]
+    for sensor_id in slow:
+        assert info['n_packages'][sensor_id] > 0.8 * 4000
+    assert info['mux_switches'][1]['switches'] > 0
+    assert info['segments']['count'] == 3
+    # Segments are kept for the user client, hub client sends and removes them
+    assert segments == [0, 1, 2]
+    assert len(os.listdir(os.path.join(session_path, 'raw_data'))) == 3 * 2 * 3
+
+    session = Session(session_path)
+    assert session.device_ids == ['hub']
+    session.merge()
+    session.decode()
+    session = Session(session_path)
+    assert session.merged and session.decoded
+    assert not os.path.exists(os.path.join(session_path, 'raw_data'))
+    with SessionContainer(session.merged_path) as container:
+        for sensor_id in [fast] + slow:
+            sensor = container.sensors[sensor_id]
+            assert sensor['encoding'] == (encoding == 'delta')
+            assert sensor['sample_rate'] == (8000 if sensor_id == fast else 4000)
+            assert sensor['n_packages'] == info['n_packages'][sensor_id]
+            crop_start, crop_end = container.crop(sensor_id)
+            df = pd.read_csv(os.path.join(session_path, f'{sensor_id}.csv'))
+            assert len(df) == crop_end - crop_start
+            assert not df['timestamp'].isna().any()
+            assert np.all(np.diff(df['timestamp']) > 0)
+            lost = sum(gap[3] for gap in session.overflows[sensor_id])
+            # Samples lost in overflows are empty rows with interpolated timestamps
+            assert df['gyro_z'].isna().sum() <= lost
+            if sensor_id == fast:
+                assert lost > 0
+                assert df['gyro_z'].isna().sum() > 0
+                assert list(df.columns) == ['timestamp', 'accel_x', 'accel_y', 'accel_z',
+                                            'gyro_x', 'gyro_y', 'gyro_z']
+            else:
+                assert list(df.columns) == ['timestamp', 'gyro_z']
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from container import FIFO_ACCEL, FIFO_GYRO_Z, FLAG_MERGED, GAP_DTYPE, INDEX_DTYPE, \
+    SessionContainer, container_path, fifo_columns, update_info, write_container
+
+
+def sensor(id_, device, packages, **fields):
+    index = np.array([(0.5, 2), (1.0, len(packages))], dtype=INDEX_DTYPE)
+    return dict({
+        'id': id_, 'device': device, 'package_length': packages.shape[1] * 2,
+        'fifo': FIFO_ACCEL | FIFO_GYRO_Z, 'sample_rate': 100.0,
+        'accel_factor': 1 / 16384, 'gyro_factor': 1 / 131,
+        'n_packages': len(packages), 'crop': None, 'gaps': [],
+        'index': [index.tobytes()], 'data': [packages.tobytes()]
+    }, **fields)
+
+
+def test_container_round_trip(tmp_path):
+    packages = np.arange(40, dtype='>i2').reshape(10, 4)
+    path = container_path(str(tmp_path), 'session')
+    # Data of a sensor can come in several sources, e.g. segment files
+    segment = tmp_path / 'segment'
+    segment.write_bytes(packages[3:].tobytes())
+    sensors = [
+        sensor('hub_a_B0A104', 0, packages[:3], crop=(1, 3),
+               gaps=[(0.1, 0.2, 2, 5)]),
+        sensor('hub_b_B1A104', 1, packages, data=[packages[:3].tobytes(), str(segment)])
+    ]
+    write_container(path, [('hub_a', 10.0), ('hub_b', 10.25)], sensors,
+                    {'name': 'session'}, 0.5, segments=2, flags=FLAG_MERGED)
+
+    with SessionContainer(path) as container:
+        assert container.merged
+        assert container.segments == 2
+        assert container.duration == 0.5
+        assert container.devices == [('hub_a', 10.0), ('hub_b', 10.25)]
+        assert container.info == {'name': 'session'}
+        assert list(container.sensors) == ['hub_a_B0A104', 'hub_b_B1A104']
+        first = container.sensors['hub_a_B0A104']
+        assert first['n_packages'] == 3
+        assert first['encoding'] == 0
+        assert fifo_columns(first['fifo']) == ['accel_x', 'accel_y', 'accel_z', 'gyro_z']
+        assert container.crop('hub_a_B0A104') == (1, 3)
+        assert container.crop('hub_b_B1A104') == (-1, -1)
+        gaps = container.gaps('hub_a_B0A104')
+        assert gaps.dtype == GAP_DTYPE
+        assert gaps.tolist() == [(0.1, 0.2, 2, 5)]
+        assert len(container.gaps('hub_b_B1A104')) == 0
+        assert container.index('hub_b_B1A104')['count'].tolist() == [2, 10]
+        np.testing.assert_array_equal(container.packages('hub_a_B0A104'), packages[:3])
+        np.testing.assert_array_equal(container.packages('hub_b_B1A104'), packages)
+        assert bytes(container.data('hub_b_B1A104')) == packages.tobytes()
+
+    update_info(path, {'name': 'session', 'timing': {'hub_a_B0A104': {}}})
+    with SessionContainer(path) as container:
+        assert container.info['timing'] == {'hub_a_B0A104': {}}
+        np.testing.assert_array_equal(container.packages('hub_b_B1A104'), packages)
+
+
+def test_invalid_containers(tmp_path):
+    path = tmp_path / 'part.imu'
+    path.write_bytes(b'')
+    with pytest.raises(ValueError):
+        SessionContainer(str(path))
+    path.write_bytes(b'NOTIMU\x00\x00' + bytes(64))
+    with pytest.raises(ValueError):
+        SessionContainer(str(path))
+    with pytest.raises(ValueError):
+        write_container(str(path), [('hub' * 30, 0.0)], [], {}, 0.0)
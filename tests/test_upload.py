@@ -0,0 +1,60 @@
+import os
+import random
+import tarfile
+
+import pytest
+import requests
+
+from imu_manager import upload
+
+
+@pytest.fixture
+def session_dir(tmp_path):
+    """Session part with files spanning several upload chunks"""
+    path = tmp_path / 'session'
+    (path / 'raw_data').mkdir(parents=True)
+    rng = random.Random(1)
+    for name in ['containers.imu', os.path.join('raw_data', 'sensor.0000')]:
+        (path / name).write_bytes(rng.randbytes(100000) + bytes(100000))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(upload, 'RETRY_DELAY', 0.01)
+    monkeypatch.setattr(upload, 'MAX_RETRY_DELAY', 0.02)
+    monkeypatch.setattr(upload, 'UPLOAD_CHUNK', 1 << 15)
+
+
+def uploaded_files(path):
+    with tarfile.open(path, 'r|*') as archive:
+        return {member.name: archive.extractfile(member).read() for member in archive}
+
+
+@pytest.mark.parametrize('codec', ['none', 'deflate'])
+def test_upload_resumes(file_server, session_dir, codec):
+    file_server.put_faults.extend([None, 'before', None, 'after', 'corrupt'])
+    file_server.complete_faults.append('after')
+    files = upload.session_files(str(session_dir))
+    stream = upload.StreamUpload(file_server.url, 'part', files, codec=codec)
+    response = stream.upload(timeout=5)
+    assert response['filename'] == 'part' + upload.CODECS[codec]
+    assert uploaded_files(response['filename']) == {
+        name: open(path, 'rb').read() for path, name in files
+    }
+    assert stream.stats['retries'] == 4
+    # Only the two requests which didn't reach the server were sent again,
+    # a request is at most a packed chunk over UPLOAD_CHUNK
+    chunk = upload.UPLOAD_CHUNK + upload.CHUNK_SIZE
+    assert stream.stats['sent_bytes'] <= stream.stats['packed_bytes'] + 2 * chunk
+    # Completed upload leaves no data behind
+    assert not [name for name in os.listdir('uploads') if name.endswith('.part')]
+
+
+def test_upload_gives_up(file_server, session_dir):
+    file_server.put_faults.extend(['before'] * 3)
+    stream = upload.StreamUpload(file_server.url, 'part',
+                                 upload.session_files(str(session_dir)), retries=2)
+    with pytest.raises(requests.ConnectionError):
+        stream.upload(timeout=5)
+    assert stream.stats['retries'] == 2
@@ -0,0 +1,244 @@
+"""
+Self-describing binary session container, see container module of
+the sensor manager for the layout. Containers are memory-mapped,
+blocks of sensors are read as numpy arrays without copying.
+"""
+
+import os
+import json
+import mmap
+import shutil
+import struct
+import numpy as np
+from typing import Any, Dict, List, Sequence, Tuple, Union
+
+from encoding import ENCODINGS, decode_delta
+
+
+# Same as in manager/imu_manager/container.py, where the layout is described
+MAGIC = b'IMUSESS\x00'
+VERSION = 1
+CONTAINER_DIR = 'containers'
+CONTAINER_EXT = '.imu'
+# Name of merged session container
+MERGED_NAME = 'session'
+INDEX_SUFFIX = '.idx'
+ALIGNMENT = 8
+ID_LENGTH = 64
+HEADER = struct.Struct('<8sHHHHIdQQ4x')
+DEVICE = struct.Struct(f'<{ID_LENGTH}sd')
+SENSOR = struct.Struct(f'<{ID_LENGTH}sHHBB2xdddQqqQQQQQQ')
+GAP = struct.Struct('<ddqq')
+FLAG_MERGED = 1
+FIFO_ACCEL = 1
+FIFO_GYRO_X = 2
+FIFO_GYRO_Y = 4
+FIFO_GYRO_Z = 8
+# Records of GAP and of INDEX_FORMAT of manager/imu_manager/acquisition.py
+GAP_DTYPE = np.dtype([('start', '<f8'), ('end', '<f8'), ('index', '<i8'), ('missing', '<i8')])
+INDEX_DTYPE = np.dtype([('time', '<f8'), ('count', '<u4')])
+SENSOR_FIELDS = [
+    'device', 'package_length', 'fifo', 'encoding', 'sample_rate', 'accel_factor',
+    'gyro_factor', 'n_packages', 'crop_start', 'crop_end', 'gaps_offset',
+    'n_gaps', 'index_offset', 'n_index', 'data_offset', 'data_size'
+]
+
+Sources = Sequence[Union[str, bytes, memoryview]]
+
+
+def container_path(session_dir: str, name: str) -> str:
+    return os.path.join(session_dir, CONTAINER_DIR, name + CONTAINER_EXT)
+
+
+def fifo_flags(sensor_info: Dict[str, Any]) -> int:
+    """FIFO content flags of sensor info"""
+    return (FIFO_ACCEL * bool(sensor_info['accel_fifo_enabled'])
+            | FIFO_GYRO_X * bool(sensor_info['x_gyro_fifo_enabled'])
+            | FIFO_GYRO_Y * bool(sensor_info['y_gyro_fifo_enabled'])
+            | FIFO_GYRO_Z * bool(sensor_info['z_gyro_fifo_enabled']))
+
+
+def fifo_columns(flags: int) -> List[str]:
+    """Columns of readings in FIFO packages"""
+    columns = []
+    if flags & FIFO_ACCEL:
+        columns += ['accel_x', 'accel_y', 'accel_z']
+    for flag, axis in [(FIFO_GYRO_X, 'x'), (FIFO_GYRO_Y, 'y'), (FIFO_GYRO_Z, 'z')]:
+        if flags & flag:
+            columns.append(f'gyro_{axis}')
+    return columns
+
+
+class SessionContainer:
+    """Memory-mapped session container"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.__file = open(path, 'rb')
+        try:
+            self.__mmap = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.__file.close()
+            raise ValueError(f'Empty session container: {path}')
+        try:
+            (magic, version, n_devices, n_sensors, self.flags, self.segments,
+             self.duration, self.__info_offset, self.__info_size) = \
+                HEADER.unpack_from(self.__mmap, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f'Not a session container: {path}')
+            offset = HEADER.size
+            self.devices = []
+            for _ in range(n_devices):
+                device_id, start = DEVICE.unpack_from(self.__mmap, offset)
+                self.devices.append((device_id.rstrip(b'\x00').decode(), start))
+                offset += DEVICE.size
+            self.sensors = {}
+            for _ in range(n_sensors):
+                sensor_id, *fields = SENSOR.unpack_from(self.__mmap, offset)
+                self.sensors[sensor_id.rstrip(b'\x00').decode()] = \
+                    dict(zip(SENSOR_FIELDS, fields))
+                offset += SENSOR.size
+        except Exception:
+            self.close()
+            raise
+        self.__info = None
+
+    def __enter__(self) -> 'SessionContainer':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        try:
+            self.__mmap.close()
+        except BufferError:
+            # Arrays of the container are still used, mapping is released with them
+            pass
+        self.__file.close()
+
+    @property
+    def merged(self) -> bool:
+        return bool(self.flags & FLAG_MERGED)
+
+    @property
+    def info(self) -> Dict[str, Any]:
+        """Session info which isn't needed to decode data, parsed on demand"""
+        if self.__info is None:
+            start = self.__info_offset
+            self.__info = json.loads(bytes(self.__mmap[start:start + self.__info_size]))
+        return self.__info
+
+    def crop(self, sensor_id: str) -> Tuple[int, int]:
+        sensor = self.sensors[sensor_id]
+        return sensor['crop_start'], sensor['crop_end']
+
+    def gaps(self, sensor_id: str) -> np.ndarray:
+        """Overflow gaps, see GAP_DTYPE"""
+        sensor = self.sensors[sensor_id]
+        return np.frombuffer(self.__mmap, dtype=GAP_DTYPE, count=sensor['n_gaps'],
+                             offset=sensor['gaps_offset'])
+
+    def index(self, sensor_id: str) -> np.ndarray:
+        """Timestamp index entries, see INDEX_DTYPE"""
+        sensor = self.sensors[sensor_id]
+        return np.frombuffer(self.__mmap, dtype=INDEX_DTYPE, count=sensor['n_index'],
+                             offset=sensor['index_offset'])
+
+    def data(self, sensor_id: str) -> memoryview:
+        """Raw FIFO packages"""
+        sensor = self.sensors[sensor_id]
+        start = sensor['data_offset']
+        return memoryview(self.__mmap)[start:start + sensor['data_size']]
+
+    def packages(self, sensor_id: str) -> np.ndarray:
+        """FIFO packages as rows of raw readings, decoded if needed"""
+        sensor = self.sensors[sensor_id]
+        length = sensor['package_length']
+        if length == 0:
+            return np.zeros((0, 0), dtype='>i2')
+        if sensor['encoding'] == ENCODINGS['delta']:
+            return decode_delta(self.data(sensor_id), length)
+        if sensor['encoding'] != ENCODINGS['none']:
+            raise ValueError(f'Unknown encoding of sensor {sensor_id}: {sensor["encoding"]}')
+        n = sensor['data_size'] // length
+        return np.frombuffer(self.__mmap, dtype='>i2', count=n * length // 2,
+                             offset=sensor['data_offset']).reshape(n, length // 2)
+
+
+def _align(f):
+    padding = -f.tell() % ALIGNMENT
+    if padding:
+        f.write(bytes(padding))
+
+
+def _encode_id(id_: str) -> bytes:
+    encoded = id_.encode()
+    if len(encoded) > ID_LENGTH:
+        raise ValueError(f'ID is longer than {ID_LENGTH} bytes: {id_}')
+    return encoded
+
+
+def _write_block(f, sources: Sources) -> Tuple[int, int]:
+    _align(f)
+    offset = f.tell()
+    for source in sources:
+        if isinstance(source, str):
+            with open(source, 'rb') as source_file:
+                shutil.copyfileobj(source_file, f, 1 << 20)
+        else:
+            f.write(source)
+    return offset, f.tell() - offset
+
+
+def write_container(path: str, devices: List[Tuple[str, float]],
+                    sensors: List[Dict[str, Any]], info: Dict[str, Any],
+                    duration: float, segments: int = 0, flags: int = 0):
+    """
+    Write container to path, replacing it only once it is complete.
+    sensors are dicts with id, device (number in devices), package_length,
+    fifo, encoding (0 by default), sample_rate, accel_factor, gyro_factor,
+    n_packages, crop, gaps and index and data sources (file paths or
+    bytes-like objects).
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.part'
+    with open(tmp_path, 'wb') as f:
+        f.seek(HEADER.size + DEVICE.size * len(devices) + SENSOR.size * len(sensors))
+        records = []
+        for sensor in sensors:
+            gaps_offset, _ = _write_block(f, [GAP.pack(*gap) for gap in sensor['gaps']])
+            index_offset, index_size = _write_block(f, sensor['index'])
+            data_offset, data_size = _write_block(f, sensor['data'])
+            crop = sensor['crop'] or (-1, -1)
+            records.append(SENSOR.pack(
+                _encode_id(sensor['id']), sensor['device'],
+                sensor['package_length'], sensor['fifo'], sensor.get('encoding', 0),
+                sensor['sample_rate'], sensor['accel_factor'], sensor['gyro_factor'],
+                sensor['n_packages'], crop[0], crop[1],
+                gaps_offset, len(sensor['gaps']),
+                index_offset, index_size // INDEX_DTYPE.itemsize,
+                data_offset, data_size
+            ))
+        info_offset, info_size = _write_block(f, [json.dumps(info).encode()])
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, len(devices), len(sensors), flags,
+                            segments, duration, info_offset, info_size))
+        for device_id, start in devices:
+            f.write(DEVICE.pack(_encode_id(device_id), start))
+        for record in records:
+            f.write(record)
+    os.replace(tmp_path, path)
+
+
+def update_info(path: str, info: Dict[str, Any]):
+    """Replace info block, which is the last one in the container"""
+    with open(path, 'r+b') as f:
+        header = list(HEADER.unpack(f.read(HEADER.size)))
+        f.seek(header[-2])
+        encoded = json.dumps(info).encode()
+        f.write(encoded)
+        f.truncate()
+        header[-1] = len(encoded)
+        f.seek(0)
+        f.write(HEADER.pack(*header))
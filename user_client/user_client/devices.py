@@ -5,7 +5,7 @@ and sensors.
 
 
 from dataclasses import dataclass
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
 
 @dataclass
@@ -15,6 +15,9 @@ class Sensor:
     id: str
     bus: int
     address: int
+    mux_address: Optional[int] = None
+    mux_channel: Optional[int] = None
+    calibration_progress: Optional[int] = None
 
     def __str__(self) -> str:
         return self.id
@@ -39,6 +42,7 @@ class Device:
     buses: List[int]
     addresses: List[int]
     sensors: List[Sensor]
+    session_plan: Optional[Dict[str, Any]] = None
 
     def __str__(self) -> str:
         return self.id
@@ -78,5 +82,23 @@ class Devices:
             sensor = Sensor(**sensor_data)
             device.sensors.append(sensor)
         if device in self.__devices:
+            old_device = self.__devices[self.__devices.index(device)]
+            device.session_plan = old_device.session_plan
             self.__devices.remove(device)
         self.__devices.append(device)
+
+    def update_session_plan(self, device_id: str, plan: Dict[str, Any]):
+        """Store throughput plan of configured sensors of a device."""
+        for device in self.__devices:
+            if device.id == device_id:
+                device.session_plan = plan
+
+    def update_calibration_progress(self, device_id: str, sensor_id: str,
+                                    progress: int):
+        """Store calibration progress (in percent) of a sensor."""
+        for device in self.__devices:
+            if device.id != device_id:
+                continue
+            for sensor in device.sensors:
+                if sensor.id == sensor_id:
+                    sensor.calibration_progress = progress
@@ -0,0 +1,64 @@
+"""
+Decoding of FIFO packages encoded by sensor hubs, see encoding module
+of the sensor manager for the format. Blocks are parsed one by one,
+but deltas of all blocks and channels with the same bit width are
+unpacked together with numpy.
+"""
+
+import struct
+import numpy as np
+
+
+# Same as in manager/imu_manager/encoding.py
+ENCODINGS = {'none': 0, 'delta': 1}
+BLOCK_HEADER = struct.Struct('<I')
+CHANNEL_HEADER = struct.Struct('<hiB')
+
+
+def decode_delta(data, package_length: int) -> np.ndarray:
+    """Delta-encoded packages as rows of raw readings"""
+    channels = package_length // 2
+    header = struct.Struct('<' + BLOCK_HEADER.format[1:]
+                           + CHANNEL_HEADER.format[1:] * channels)
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    # Packed deltas grouped by (width, count): byte offsets, first rows,
+    # channels and smallest deltas
+    groups = {}
+    starts, firsts = [], []
+    offset, rows = 0, 0
+    while offset < len(buffer):
+        n, *fields = header.unpack_from(data, offset)
+        offset += header.size
+        starts.append(rows)
+        firsts.append(fields[0::3])
+        for channel in range(channels):
+            low, width = fields[3 * channel + 1], fields[3 * channel + 2]
+            if n > 1:
+                group = groups.setdefault((width, n - 1), ([], [], [], []))
+                for values, value in zip(group, (offset, rows + 1, channel, low)):
+                    values.append(value)
+            offset += (n + 6) // 8 * width
+        rows += n
+    if offset != len(buffer):
+        raise ValueError('Encoded data ends within a block')
+    # Block starts are left 0, readings are cumulative sums from them
+    deltas = np.zeros((rows, channels), dtype=np.int64)
+    for (width, count), (offsets, first_rows, group_channels, lows) in groups.items():
+        values = np.zeros((len(offsets), count), dtype=np.int64)
+        if width:
+            size = (count + 7) // 8 * width
+            packed = buffer[np.array(offsets)[:, None] + np.arange(size)]
+            bits = np.unpackbits(packed, axis=1, bitorder='little')
+            bits = bits[:, :count * width].reshape(len(offsets), count, width)
+            for bit in range(width):
+                values |= bits[:, :, bit].astype(np.int64) << bit
+        values += np.array(lows)[:, None]
+        deltas[np.array(first_rows)[:, None] + np.arange(count),
+               np.array(group_channels)[:, None]] = values
+    if not rows:
+        return np.zeros((0, channels), dtype='>i2')
+    sums = np.cumsum(deltas, axis=0)
+    starts = np.array(starts)
+    lengths = np.diff(np.append(starts, rows))
+    readings = sums - np.repeat(sums[starts] - np.array(firsts), lengths, axis=0)
+    return readings.astype('>i2')
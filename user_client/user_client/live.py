@@ -0,0 +1,80 @@
+"""
+Live preview of a running session.
+Hubs stream every n-th raw FIFO package of their sensors, which are
+decoded here into rolling windows of readings.
+"""
+
+import threading
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+
+from container import fifo_columns, fifo_flags
+
+
+# Seconds of readings kept per sensor
+LIVE_WINDOW = 10
+
+
+class LiveData:
+    """Rolling windows of decoded live readings of all sensors"""
+
+    def __init__(self, window: float = LIVE_WINDOW):
+        self.window = window
+        self.session_name = None
+        self.__sensors = {}
+        self.__lock = threading.Lock()
+
+    def start(self, device_id: str, session_name: str,
+              decimation: int, sensors: Dict[str, Dict[str, Any]]):
+        """Reset windows of device sensors for a new live session."""
+        with self.__lock:
+            if session_name != self.session_name:
+                self.session_name = session_name
+                self.__sensors = {}
+            for sensor_id, info in sensors.items():
+                columns = fifo_columns(fifo_flags(info))
+                factors = np.array([
+                    info['accel_factor'] if column.startswith('accel')
+                    else info['gyro_factor'] for column in columns
+                ])
+                rate = info['sample_rate'] / decimation
+                self.__sensors[sensor_id] = {
+                    'device_id': device_id,
+                    'columns': columns,
+                    'factors': factors,
+                    'package_length': info['package_length'],
+                    'size': max(int(self.window * rate), 1),
+                    'readings': np.empty((0, len(columns)))
+                }
+
+    @property
+    def sensor_ids(self) -> List[str]:
+        with self.__lock:
+            return list(self.__sensors)
+
+    def append(self, sensor_id: str, payload: bytes):
+        """Decode batch of raw packages and add it to sensor window."""
+        with self.__lock:
+            sensor = self.__sensors.get(sensor_id)
+            if sensor is None or not sensor['columns']:
+                return
+            n = len(payload) // sensor['package_length']
+            packages = np.frombuffer(
+                payload, dtype='>i2', count=n * sensor['package_length'] // 2
+            ).reshape(n, -1)
+            readings = packages[:, :len(sensor['columns'])] * sensor['factors']
+            readings = np.concatenate([sensor['readings'], readings])
+            sensor['readings'] = readings[-sensor['size']:]
+
+    def frame(self, sensor_id: str) -> pd.DataFrame:
+        """Readings in window of a sensor"""
+        with self.__lock:
+            sensor = self.__sensors[sensor_id]
+            return pd.DataFrame(sensor['readings'], columns=sensor['columns'])
+
+    def statistics(self, sensor_id: str) -> pd.DataFrame:
+        """Mean and variance of readings in window of a sensor per axis"""
+        df = self.frame(sensor_id)
+        return pd.DataFrame({'mean': df.mean(), 'variance': df.var()}).T
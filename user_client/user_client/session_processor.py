@@ -1,11 +1,28 @@
-import struct
+import shutil
 import yaml
 import os
+import numpy as np
 import pandas as pd
 from datetime import datetime
+from typing import Optional, Tuple
+
+from container import CONTAINER_DIR, CONTAINER_EXT, MERGED_NAME, INDEX_SUFFIX, \
+    FLAG_MERGED, SessionContainer, container_path, fifo_columns, fifo_flags, \
+    update_info, write_container
+
+
+# Keys of session info of older sensor managers kept in container tables
+LEGACY_KEYS = ['time', 'files', 'index', 'n_packages', 'overflows', 'crops', 'devices']
 
 
 class Session:
+    """
+    Session directory with session containers of sensor hubs, which are
+    merged to one session container and decoded to CSV files.
+    Sessions of older sensor managers (YAML metadata and raw files)
+    are packed to containers before merging or decoding.
+    """
+
     def __init__(self, session_dir: str):
         self.name = os.path.basename(session_dir)
         self.duration = None
@@ -14,141 +31,301 @@ class Session:
         self.time = None
         self.overflows = None
         self.session_dir = session_dir
+        self.container_dir = os.path.join(session_dir, CONTAINER_DIR)
         self.metadata_dir = os.path.join(session_dir, 'metadata')
-        self.session_info_path = os.path.join(self.metadata_dir, 'session_info.yml')
+        self.merged_path = container_path(session_dir, MERGED_NAME)
         self.merged = False
         self.decoded = False
         self.device_ids = []
         self.sensor_ids = []
         if os.path.isdir(session_dir):
-            if not os.path.isdir(self.metadata_dir):
-                raise FileNotFoundError(f'No metadata directory found in {session_dir}')
-            if os.path.isfile(self.session_info_path):
+            if not os.path.isdir(self.container_dir) and not os.path.isdir(self.metadata_dir):
+                raise FileNotFoundError(f'No session parts found in {session_dir}')
+            if os.path.isfile(self.merged_path):
                 self.merged = True
-                self.decoded = True
-                with open(self.session_info_path, 'r') as f:
-                    info = yaml.safe_load(f)
-                self.duration = info['time']['duration']
-                self.timestamp = min(info['time']['start'].values())
-                self.overflows = info['overflows']
-                for file_name in info['files'].values():
-                    decoded_df_path = os.path.join(session_dir, f'{file_name}.csv')
-                    if not os.path.isfile(decoded_df_path):
-                        self.decoded = False
-                for device_id, sensor_ids in info['devices'].items():
-                    self.device_ids.append(device_id)
-                    self.sensor_ids.extend(sensor_ids)
+                with SessionContainer(self.merged_path) as container:
+                    self.__load(container)
+                    self.overflows = {
+                        sensor_id: container.gaps(sensor_id).tolist()
+                        for sensor_id in container.sensors
+                    }
+                self.decoded = all(
+                    os.path.isfile(os.path.join(session_dir, f'{sensor_id}.csv'))
+                    for sensor_id in self.sensor_ids
+                )
             else:
-                for fname in os.listdir(self.metadata_dir):
-                    with open(os.path.join(self.metadata_dir, fname), 'r') as f:
-                        metadata = yaml.safe_load(f)
-                        self.device_ids.append(metadata['device_id'])
-                        self.sensor_ids.extend(metadata['sensors'].keys())
-                        if not self.duration:
-                            self.duration = metadata['time']['duration']
-                        timestamp = metadata['time']['start']
-                        if not self.timestamp or self.timestamp > timestamp:
-                            self.timestamp = timestamp
+                for path in self.part_paths():
+                    with SessionContainer(path) as container:
+                        self.__load(container)
+                if os.path.isdir(self.metadata_dir):
+                    self.__load_legacy()
         if self.timestamp:
             dt = datetime.utcfromtimestamp(self.timestamp)
             self.date = dt.strftime('%Y-%m-%d')
             self.time = dt.strftime('%H:%M:%S')
 
-    def merge(self):
-        session_parts = []
-        for file_name in os.listdir(self.metadata_dir):
-            if '_session_info.yml' in file_name:
-                file_path = os.path.join(self.metadata_dir, file_name)
-                with open(file_path, 'r') as f:
-                    session_parts.append(yaml.safe_load(f))
-                os.remove(file_path)
-        session_info = {}
-        session_info['name'] = session_parts[0]['name']
-        session_info['devices'] = dict(zip(
-            [part['device_id'] for part in session_parts],
-            [list(part['sensors'].keys()) for part in session_parts]
-        ))
-        session_info['time'] = {
-            'start': dict(zip(
-                [part['device_id'] for part in session_parts],
-                [part['time']['start'] for part in session_parts]
-            )),
-            'duration': session_parts[0]['time']['duration']
+    def __load(self, container: SessionContainer):
+        """Devices, sensors and time of container, info isn't parsed"""
+        for device_id, start in container.devices:
+            self.device_ids.append(device_id)
+            if not self.timestamp or self.timestamp > start:
+                self.timestamp = start
+        self.sensor_ids.extend(container.sensors)
+        if not self.duration:
+            self.duration = container.duration
+
+    def __load_legacy(self):
+        session_info_path = os.path.join(self.metadata_dir, 'session_info.yml')
+        if os.path.isfile(session_info_path):
+            self.merged = True
+            self.decoded = True
+            with open(session_info_path, 'r') as f:
+                info = yaml.safe_load(f)
+            self.duration = info['time']['duration']
+            self.timestamp = min(info['time']['start'].values())
+            self.overflows = info['overflows']
+            for file_name in info['files'].values():
+                decoded_df_path = os.path.join(self.session_dir, f'{file_name}.csv')
+                if not os.path.isfile(decoded_df_path):
+                    self.decoded = False
+            for device_id, sensor_ids in info['devices'].items():
+                self.device_ids.append(device_id)
+                self.sensor_ids.extend(sensor_ids)
+            return
+        for fname in os.listdir(self.metadata_dir):
+            with open(os.path.join(self.metadata_dir, fname), 'r') as f:
+                metadata = yaml.safe_load(f)
+                self.device_ids.append(metadata['device_id'])
+                self.sensor_ids.extend(metadata['sensors'].keys())
+                if not self.duration:
+                    self.duration = metadata['time']['duration']
+                timestamp = metadata['time']['start']
+                if not self.timestamp or self.timestamp > timestamp:
+                    self.timestamp = timestamp
+
+    def part_paths(self) -> list:
+        """Session containers of sensor hubs"""
+        if not os.path.isdir(self.container_dir):
+            return []
+        return [
+            os.path.join(self.container_dir, file_name)
+            for file_name in sorted(os.listdir(self.container_dir))
+            if file_name.endswith(CONTAINER_EXT)
+            and file_name != MERGED_NAME + CONTAINER_EXT
+        ]
+
+    @staticmethod
+    def fit_timestamps(index: np.ndarray, n: int, gaps: list,
+                       sample_rate: float) -> tuple:
+        """
+        Timestamps of n recorded samples (seconds from device session start)
+        fitted to timestamp index entries (read time, cumulative package count).
+        Sampling restarts after every overflow gap, so each segment between
+        gaps gets its own linear fit. Sample k of a segment is produced at
+        a + b * (k + 0.5): a read at time t sees samples finished between
+        t - b and t. Returns timestamps and timing statistics.
+        """
+        timestamps = np.full(n, np.nan)
+        bounds = [0] + [index_ for index_, _ in gaps] + [n]
+        periods, residuals = [], []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if end <= start:
+                continue
+            entries = index[(index['count'] > start) & (index['count'] <= end)]
+            x = entries['count'].astype(np.float64) - start
+            y = entries['time']
+            if len(entries) > 1 and np.ptp(x) > 0:
+                b, a = np.polyfit(x, y, 1)
+                periods.append(b)
+            elif len(entries) == 1:
+                b = 1 / sample_rate
+                a = y[0] - b * x[0]
+            else:
+                continue
+            timestamps[start:end] = a + b * (np.arange(end - start) + 0.5)
+            residuals.append(y - (a + b * x))
+        residuals = np.concatenate(residuals) if residuals else np.zeros(0)
+        timing = {
+            'sample_rate': float(1 / np.mean(periods)) if periods else sample_rate,
+            'reads': int(len(index)),
+            'jitter_std': float(np.std(residuals)) if len(residuals) else 0.0,
+            'jitter_max': float(np.max(np.abs(residuals))) if len(residuals) else 0.0
         }
-        session_info['sensors'] = {}
-        session_info['overflows'] = {}
-        session_info['files'] = {}
-        session_info['n_packages'] = {}
-        for part in session_parts:
-            session_info['sensors'].update(part['sensors'])
-            session_info['overflows'].update(part['overflows'])
-            session_info['files'].update(part['files'])
-            session_info['n_packages'].update(part['n_packages'])        
-        session_info['crops'] = {}
-        start_time_max = max([part['time']['start'] for part in session_parts])
-        for device_id, sensor_ids in session_info['devices'].items():
-            delta_t = start_time_max - session_info['time']['start'][device_id]
-            for sensor_id in sensor_ids:
-                n = session_info['n_packages'][sensor_id]
-                delta_n = int(delta_t * session_info['sensors'][sensor_id]['sample_rate'])
-                session_info['crops'][sensor_id] = [delta_n, n]
-        n_min = min([crop[1] - crop[0] for crop in session_info['crops'].values()])
-        for sensor_id in session_info['sensors']:
-            crop = session_info['crops'][sensor_id]
-            crop[1] -= (crop[1] - crop[0]) - n_min
-            session_info['crops'][sensor_id] = crop
-        with open(self.session_info_path, 'w') as f:
-            yaml.dump(session_info, f, sort_keys=False)
+        return timestamps, timing
+
+    def __convert_legacy(self):
+        """Pack session info and raw files of older sensor managers to containers"""
+        if not os.path.isdir(self.metadata_dir):
+            return
+        raw_data_dir = os.path.join(self.session_dir, 'raw_data')
+        for file_name in os.listdir(self.metadata_dir):
+            with open(os.path.join(self.metadata_dir, file_name), 'r') as f:
+                info = yaml.safe_load(f)
+            merged = 'devices' in info
+            if merged:
+                devices = [(device_id, info['time']['start'][device_id])
+                           for device_id in info['devices']]
+            else:
+                devices = [(info['device_id'], info['time']['start'])]
+            segments = info.get('segments', {}).get('count', 0)
+            index_files = info.get('index', {}).get('files', {})
+            sensors = []
+            for sensor_id, sensor_info in info['sensors'].items():
+                device = 0
+                if merged:
+                    device = [sensor_id in info['devices'][device_id]
+                              for device_id, _ in devices].index(True)
+                data, index = [], []
+                # Segments are stitched by merge
+                if not segments:
+                    data.append(os.path.join(raw_data_dir, info['files'][sensor_id]))
+                    if sensor_id in index_files:
+                        index.append(os.path.join(raw_data_dir, index_files[sensor_id]))
+                sensors.append({
+                    'id': sensor_id,
+                    'device': device,
+                    'package_length': sensor_info['package_length'],
+                    'fifo': fifo_flags(sensor_info),
+                    'sample_rate': sensor_info['sample_rate'],
+                    'accel_factor': sensor_info['accel_factor'],
+                    'gyro_factor': sensor_info['gyro_factor'],
+                    'n_packages': info['n_packages'][sensor_id],
+                    'crop': info['crops'][sensor_id] if merged else None,
+                    # Sessions recorded before gaps were tracked list only overflow times
+                    'gaps': [gap for gap in info['overflows'][sensor_id]
+                             if isinstance(gap, list)],
+                    'index': index,
+                    'data': data
+                })
+            write_container(
+                container_path(self.session_dir, MERGED_NAME if merged else devices[0][0]),
+                devices, sensors,
+                {key: value for key, value in info.items() if key not in LEGACY_KEYS},
+                info['time']['duration'], segments, FLAG_MERGED if merged else 0
+            )
+            for sensor in sensors:
+                for path in sensor['data'] + sensor['index']:
+                    os.remove(path)
+        shutil.rmtree(self.metadata_dir)
+
+    def merge(self):
+        """
+        Merge session containers of sensor hubs to one, with crops aligning
+        sensors of all hubs to the same timeline. Segments of segmented
+        session parts are stitched, package counts, index and gaps
+        run through segments, so nothing else needs to change.
+        """
+        self.__convert_legacy()
+        raw_data_dir = os.path.join(self.session_dir, 'raw_data')
+        part_paths = self.part_paths()
+        parts = [SessionContainer(path) for path in part_paths]
+        segment_paths = []
+        try:
+            devices = [part.devices[0] for part in parts]
+            start_time_max = max(start for _, start in devices)
+            info = {'name': parts[0].info['name'], 'sensors': {}, 'devices': {}}
+            sensors = []
+            for device, part in enumerate(parts):
+                device_id, start = part.devices[0]
+                part_info = dict(part.info)
+                info['sensors'].update(part_info.pop('sensors'))
+                info['devices'][device_id] = part_info
+                delta_t = start_time_max - start
+                for sensor_id, sensor in part.sensors.items():
+                    if part.segments:
+                        data, index = [], []
+                        for segment in range(part.segments):
+                            for sources, file_name in [(data, sensor_id),
+                                                       (index, sensor_id + INDEX_SUFFIX)]:
+                                path = os.path.join(
+                                    raw_data_dir, part_info['segments']['format'].format(
+                                        file=file_name, segment=segment
+                                    )
+                                )
+                                # Buses stopped before the last segment don't have it
+                                if os.path.isfile(path):
+                                    sources.append(path)
+                                    segment_paths.append(path)
+                    else:
+                        data, index = [part.data(sensor_id)], [part.index(sensor_id)]
+                    gaps = part.gaps(sensor_id).tolist()
+                    # Timeline includes samples lost in overflows
+                    n = sensor['n_packages'] + sum(gap[3] for gap in gaps)
+                    sensors.append({
+                        'id': sensor_id,
+                        'device': device,
+                        'package_length': sensor['package_length'],
+                        'fifo': sensor['fifo'],
+                        'encoding': sensor['encoding'],
+                        'sample_rate': sensor['sample_rate'],
+                        'accel_factor': sensor['accel_factor'],
+                        'gyro_factor': sensor['gyro_factor'],
+                        'n_packages': sensor['n_packages'],
+                        'crop': [int(delta_t * sensor['sample_rate']), n],
+                        'gaps': gaps,
+                        'index': index,
+                        'data': data
+                    })
+            n_min = min([sensor['crop'][1] - sensor['crop'][0] for sensor in sensors])
+            for sensor in sensors:
+                crop = sensor['crop']
+                crop[1] -= (crop[1] - crop[0]) - n_min
+            write_container(self.merged_path, devices, sensors, info,
+                            parts[0].duration, flags=FLAG_MERGED)
+        finally:
+            for part in parts:
+                part.close()
+        for path in part_paths + segment_paths:
+            os.remove(path)
+        if os.path.isdir(raw_data_dir) and not os.listdir(raw_data_dir):
+            os.rmdir(raw_data_dir)
         self.merged = True
 
+    def decode_sensor(self, container: SessionContainer,
+                      sensor_id: str) -> Tuple[pd.DataFrame, Optional[dict]]:
+        """Readings of a sensor and its timing statistics if it has index"""
+        sensor = container.sensors[sensor_id]
+        columns = fifo_columns(sensor['fifo'])
+        factors = np.array([
+            sensor['accel_factor'] if column.startswith('accel')
+            else sensor['gyro_factor'] for column in columns
+        ])
+        packages = container.packages(sensor_id)
+        df = pd.DataFrame(packages[:, :len(columns)] * factors, columns=columns)
+        gaps = [(int(gap['index']), int(gap['missing'])) for gap in container.gaps(sensor_id)]
+        start = container.devices[sensor['device']][1]
+        sample_rate = sensor['sample_rate']
+        timing = None
+        if sensor['n_index']:
+            timestamps, timing = self.fit_timestamps(
+                container.index(sensor_id), len(df), gaps, sample_rate
+            )
+        else:
+            # No index in older sessions, nominal sample rate is used
+            timestamps = np.arange(len(df)) / sample_rate
+        df.insert(0, 'timestamp', start + timestamps)
+        if gaps:
+            # Samples lost in overflows are left empty to keep the timeline
+            positions = np.arange(len(df))
+            for index, missing in gaps:
+                positions[index:] += missing
+            df.index = positions
+            df = df.reindex(range(len(df) + sum(m for _, m in gaps)))
+            df['timestamp'] = df['timestamp'].interpolate(limit_area='inside')
+        crop = container.crop(sensor_id)
+        return df.iloc[crop[0]:crop[1]], timing
+
     def decode(self):
-        with open(self.session_info_path, 'r') as f:
-            session_info = yaml.safe_load(f)
-        source_file_paths, target_file_paths = [], []
-        for fname in session_info['files'].values():
-            source_file_paths.append(os.path.join(self.session_dir, 'raw_data', fname))
-            target_file_paths.append(os.path.join(self.session_dir, f'{fname}.csv'))
-        for i, sensor_id in enumerate(session_info['sensors']):
-            package_length = session_info['sensors'][sensor_id]['package_length']
-            accel_factor = session_info['sensors'][sensor_id]['accel_factor']
-            gyro_factor = session_info['sensors'][sensor_id]['gyro_factor']
-            accel_fifo_enabled = session_info['sensors'][sensor_id]['accel_fifo_enabled']
-            x_gyro_fifo_enabled = session_info['sensors'][sensor_id]['x_gyro_fifo_enabled']
-            y_gyro_fifo_enabled = session_info['sensors'][sensor_id]['y_gyro_fifo_enabled']
-            z_gyro_fifo_enabled = session_info['sensors'][sensor_id]['z_gyro_fifo_enabled']
-            crop = session_info['crops'][sensor_id]
-            df = []
-            with open(source_file_paths[i], 'rb') as f:
-                data = list(f.read())
-                for j in range(crop[0], crop[1]):
-                    package = data[j * package_length: (j + 1) * package_length]
-                    package_format = '>' + 'h' * (package_length // 2)
-                    package = struct.unpack(package_format, memoryview(bytearray(package)))
-                    readings = []
-                    p = 0
-                    if accel_fifo_enabled:
-                        readings.append(package[0] * accel_factor)
-                        readings.append(package[1] * accel_factor)
-                        readings.append(package[2] * accel_factor)
-                        p = 3
-                    if x_gyro_fifo_enabled:
-                        readings.append(package[p] * gyro_factor)
-                        p += 1
-                    if y_gyro_fifo_enabled:
-                        readings.append(package[p] * gyro_factor)
-                        p += 1
-                    if z_gyro_fifo_enabled:
-                        readings.append(package[p] * gyro_factor)
-                    df.append(readings)
-            columns = []
-            if accel_fifo_enabled:
-                columns += ['accel_x', 'accel_y', 'accel_z']
-            if x_gyro_fifo_enabled:
-                columns.append('gyro_x')
-            if y_gyro_fifo_enabled:
-                columns.append('gyro_y')
-            if z_gyro_fifo_enabled:
-                columns.append('gyro_z')
-            df = pd.DataFrame(df, columns=columns)
-            df.to_csv(target_file_paths[i], index=False)
+        self.__convert_legacy()
+        timing = {}
+        with SessionContainer(self.merged_path) as container:
+            info = container.info
+            for sensor_id in container.sensors:
+                df, sensor_timing = self.decode_sensor(container, sensor_id)
+                df.to_csv(os.path.join(self.session_dir, f'{sensor_id}.csv'), index=False)
+                if sensor_timing is not None:
+                    timing[sensor_id] = sensor_timing
+        if timing:
+            info['timing'] = timing
+            update_info(self.merged_path, info)
         self.decoded = True
@@ -7,6 +7,7 @@ import threading
 import requests
 import socket
 import re
+import functools
 from typing import Any
 from PIL import Image
 import zipfile
@@ -18,11 +19,13 @@ from paho.mqtt.client import Client as MQTTClient
 
 from config import Config
 from constants import DLPF_ENUM, CLOCK_ENUM, GYRO_RANGE_ENUM, ACCEL_RANGE_ENUM
-from utils import TempDir, natural_keys, zipdir
+from utils import TempDir, natural_keys, zipdir, extract_archive
 from streamlit_utils import rerun
 from streamlit_utils.message_logger import MessageType, Logger
 from session_processor import Session
+from container import CONTAINER_DIR
 from devices import Devices
+from live import LiveData
 
 
 # TODO: Inpage help
@@ -60,12 +63,16 @@ def init_resources():
     cfg = Config(config_path)
     logger = Logger()
     devices = Devices()
+    live_data = LiveData()
     sessions_monitor = rerun.create_directory_monitor(cfg.path.sessions)
     sessions_monitor.start()
-    return cfg, logger, devices, sessions_monitor
+    return cfg, logger, devices, live_data, sessions_monitor
 
 
-cfg, logger, devices, sessions_monitor = init_resources()
+cfg, logger, devices, live_data, sessions_monitor = init_resources()
+live_topic = getattr(cfg.server.mqtt.topic, 'live', '/general/live')
+# Live preview of sessions without duration is redrawn this often
+LIVE_REFRESH = 0.2
 
 
 class Client:
@@ -79,6 +86,7 @@ class Client:
         self.__client.on_message = self.__on_message
         self.__client.connect(self.ip, self.port)
         self.__client.subscribe(cfg.server.mqtt.topic.info)
+        self.__client.subscribe(f'{live_topic}/#')
         self.__client_thread = None
         self.__is_running = False
 
@@ -99,6 +107,11 @@ class Client:
 
     def __on_message(self, client: MQTTClient,
                      userdata: Any, mqtt_msg: MQTTMessage):
+        # Live packages are polled by the page, no rerun for every batch
+        if mqtt_msg.topic.startswith(f'{live_topic}/'):
+            sensor_id = mqtt_msg.topic[len(live_topic) + 1:]
+            live_data.append(sensor_id, mqtt_msg.payload)
+            return
         payload = yaml.safe_load(mqtt_msg.payload.decode())
         device_id = payload['device_id']
         msg_type = payload['type']
@@ -111,6 +124,12 @@ class Client:
                 devices.update(data)
             elif data_type == 'session_part':
                 self.download_session_part(**data)
+            elif data_type == 'calibration_progress':
+                devices.update_calibration_progress(**data)
+            elif data_type == 'session_plan':
+                devices.update_session_plan(**data)
+            elif data_type == 'live_session':
+                live_data.start(**data)
         rerun.force_rerun()
 
     def run(self):
@@ -160,8 +179,7 @@ class Client:
         file_path = os.path.join(session_dir, file_name)
         with open(file_path, 'wb') as f:
             shutil.copyfileobj(response.raw, f)
-        with zipfile.ZipFile(file_path, 'r') as zip_ref:
-            zip_ref.extractall(session_dir)
+        extract_archive(file_path, session_dir)
         os.remove(file_path)
         response = requests.delete(
             url=f"http://{self.ip}:{file_port}/delete/{file_name}"
@@ -279,8 +297,10 @@ def st_manage_sessions():
     sessions = []
     for fname in os.listdir(cfg.path.sessions):
         session_dir = os.path.join(cfg.path.sessions, fname)
+        container_dir = os.path.join(session_dir, CONTAINER_DIR)
+        # Sessions of older sensor managers have metadata directory instead
         metadata_dir = os.path.join(session_dir, 'metadata')
-        if os.path.isdir(session_dir) and os.path.isdir(metadata_dir):
+        if os.path.isdir(container_dir) or os.path.isdir(metadata_dir):
             sessions.append(Session(session_dir))
     sessions.sort(key=lambda x: natural_keys(x.name))
     name2session = {session.name: session for session in sessions}
@@ -469,16 +489,54 @@ def st_manage_sessions():
                     st.experimental_rerun()
 
 
+def st_update_live_preview(chart, statistics, session_name, sensor_id):
+    """Draw live packages of the sensor to placeholders."""
+    if live_data.session_name == session_name \
+            and sensor_id in live_data.sensor_ids:
+        chart.line_chart(live_data.frame(sensor_id))
+        statistics.dataframe(live_data.statistics(sensor_id))
+    else:
+        # Every poll draws something, so reruns can stop the polling script
+        chart.caption('Waiting for live data')
+
+
 def st_new_session():
-    """Streamlit UI for starting a new session."""
+    """
+    Streamlit UI for starting a new session.
+    Returns a function refreshing live preview of a running
+    session without duration, if there is one.
+    """
+    running_session = st.session_state.get('running_session')
+    if running_session:
+        st.info(f'Session "{running_session}" is running')
+        live_sensor_id = st.session_state.get('live_sensor_id')
+        live_preview = None
+        if live_sensor_id:
+            live_preview = functools.partial(
+                st_update_live_preview, st.empty(), st.empty(),
+                running_session, live_sensor_id
+            )
+            live_preview()
+        if st.button('Stop session', type='primary', use_container_width=True):
+            client.send_command('stop_session', {})
+            st.session_state.running_session = None
+            st.experimental_rerun()
+        return live_preview
     session_name = st.text_input('Session name')
     name_is_valid = re.match(r'^[\w-]+$', session_name)
+    continuous = st.checkbox('Record until stopped', False)
     cols = st.columns(2)
     with cols[0]:
-        duration = st.number_input(
-            'Duration', value=1, min_value=0,
-            max_value=cfg.max_session_duration
-        )
+        if continuous:
+            # Finished segments are uploaded while recording goes on
+            segment_duration = st.number_input(
+                'Segment length', value=60, min_value=1
+            )
+        else:
+            duration = st.number_input(
+                'Duration', value=1, min_value=0,
+                max_value=cfg.max_session_duration
+            )
     with cols[1]:
         name_conflict_option = st.selectbox(
             'If session with this name already exists',
@@ -505,10 +563,24 @@ def st_new_session():
                     session_name,
                     int(time.time())
                 )
+    force = st.checkbox('Start even if overflows are predicted', False)
+    live = st.checkbox('Live preview', False)
+    cols = st.columns(2)
+    with cols[0]:
+        live_decimation = st.number_input(
+            'Stream every n-th sample', value=10, min_value=1,
+            disabled=not live
+        )
+    with cols[1]:
+        live_sensor_id = st.selectbox(
+            'Previewed sensor',
+            [sensor.id for device in devices for sensor in device.sensors],
+            disabled=not live
+        )
     submitted = st.button(
         'Start session', type='primary',
         use_container_width=True,
-        disabled=(not name_is_valid or duration <= 0)
+        disabled=(not name_is_valid or (not continuous and duration <= 0))
     )
     st.caption('Session will be saved in {}'.format(
         os.path.join(cfg.path.sessions, session_name)
@@ -525,15 +597,29 @@ def st_new_session():
         command = 'start_session'
         args = {
             'session_name': session_name,
-            'duration': duration
+            'duration': None if continuous else duration,
+            'force': force,
+            'live_decimation': live_decimation if live else 0
         }
+        if continuous:
+            args['segment_duration'] = segment_duration
         client.send_command(command, args)
+        if continuous:
+            st.session_state.running_session = session_name
+            st.session_state.live_sensor_id = live_sensor_id if live else None
+            st.experimental_rerun()
         progress_text = 'Session is running'
         progress_bar = st.progress(0, progress_text)
+        if live:
+            live_chart = st.empty()
+            live_statistics = st.empty()
         sleep_time = 0.2
         for i in range(int(duration / sleep_time)):
             percent = (i + 1) * sleep_time / duration
             progress_bar.progress(percent, progress_text)
+            if live:
+                st_update_live_preview(live_chart, live_statistics,
+                                       session_name, live_sensor_id)
             time.sleep(sleep_time)
 
 
@@ -607,15 +693,46 @@ def st_calibrate_sensors():
         "Buffer size",
         min_value=1, max_value=500, value=150
     )
+    mode = st.selectbox("Mode", ['sequential', 'batched', 'closed_form'])
+    only_drifted = st.checkbox("Only drifted sensors", False)
+    threshold = st.number_input(
+        "Drift threshold (offset units)",
+        min_value=0.0, value=2.0, disabled=not only_drifted
+    )
+    for device in devices:
+        for sensor in device.sensors:
+            if sensor.calibration_progress is not None:
+                st.progress(sensor.calibration_progress / 100,
+                            text=f'{device.id}: {sensor.id}')
     command = 'calibrate_sensors'
     args = {
         'max_iters': max_iters,
         'rough_iters': rough_iters,
-        'buffer_size': buffer_size
+        'buffer_size': buffer_size,
+        'mode': mode
     }
+    if only_drifted:
+        command = 'check_calibration'
+        args['threshold'] = threshold
     return command, args
 
 
+def sample_rate_budget(package_length: int):
+    """
+    Highest sample rate all sensors could be configured to,
+    according to the latest session plans of devices.
+    Returns None if it is unknown.
+    """
+    budgets = []
+    for device in devices:
+        if device.session_plan is None or package_length == 0:
+            continue
+        for bus_plan in device.session_plan['buses'].values():
+            byte_rate = bus_plan['max_byte_rate'] / len(bus_plan['sensors'])
+            budgets.append(byte_rate / package_length)
+    return min(budgets, default=None)
+
+
 def st_configure_sensors():
     """Streamlit UI for sensor configuration."""
     rate_col1, rate_col2 = st.columns(2)
@@ -631,7 +748,10 @@ def st_configure_sensors():
             options=DLPF_ENUM.keys(), index=6
         )
         gyro_rate = 8000 if dlpf == '256' else 1000
-        st.metric("Sample rate", gyro_rate / (rate + 1))
+        sample_rate = gyro_rate / (rate + 1)
+        metric_col1, metric_col2 = st.columns(2)
+        metric_col1.metric("Sample rate", sample_rate)
+        budget_placeholder = metric_col2.empty()
     st.write('---')
     conf_col1, conf_col2 = st.columns(2)
     with conf_col1:
@@ -642,6 +762,20 @@ def st_configure_sensors():
         x_gyro_fifo_enabled = st.checkbox("X gyro fifo enabled", True)
         y_gyro_fifo_enabled = st.checkbox("Y gyro fifo enabled", True)
         z_gyro_fifo_enabled = st.checkbox("Z gyro fifo enabled", True)
+    package_length = 6 * accel_fifo_enabled + 2 * (
+        x_gyro_fifo_enabled + y_gyro_fifo_enabled + z_gyro_fifo_enabled
+    )
+    budget = sample_rate_budget(package_length)
+    if budget is None:
+        budget_placeholder.metric("Budget", '-')
+    else:
+        budget_placeholder.metric(
+            "Budget", round(budget),
+            delta=f'{budget - sample_rate:+.0f} Hz'
+        )
+    # Plans are measured on the bus, so only on request and before sessions
+    if st.button('Measure budget', use_container_width=True):
+        client.send_command('plan_session', {})
     command = 'configure_sensors'
     args = {
         'clock_source': CLOCK_ENUM[clock_type],
@@ -705,7 +839,7 @@ if client and client.is_connected:
     st.header('Sessions')
     session_tabs = st.tabs(['New session', 'Manage sessions'])
     with session_tabs[0]:
-        st_new_session()
+        live_preview = st_new_session()
     with session_tabs[1]:
         st_manage_sessions()
 
@@ -733,3 +867,9 @@ if client and client.is_connected:
             'Reset sensors',
             st_reset_sensors
         )
+
+    if live_preview is not None:
+        # Polled once the rest of the page is drawn, any rerun stops it
+        while st.session_state.get('running_session'):
+            time.sleep(LIVE_REFRESH)
+            live_preview()
@@ -1,9 +1,19 @@
 import os
 import zipfile
+import tarfile
 import shutil
 from typing import List, Union
 import re
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
 
 def atoi(text: str) -> Union[int, str]:
     return int(text) if text.isdigit() else text
@@ -33,6 +43,34 @@ def zipdir(path: str, ziph: zipfile.ZipFile):
             )
 
 
+def extract_archive(path: str, target_dir: str):
+    """
+    Extract session part archive: zip, or tar compressed
+    with codec given by extension (.tar, .tar.gz, .tar.zst, .tar.lz4).
+    """
+    if path.endswith('.zip'):
+        with zipfile.ZipFile(path, 'r') as zip_ref:
+            zip_ref.extractall(target_dir)
+        return
+    with open(path, 'rb') as f:
+        if path.endswith('.tar.zst'):
+            if zstandard is None:
+                raise RuntimeError('zstandard is required to extract ' + path)
+            stream = zstandard.ZstdDecompressor().stream_reader(f)
+        elif path.endswith('.tar.lz4'):
+            if lz4 is None:
+                raise RuntimeError('lz4 is required to extract ' + path)
+            stream = lz4.frame.LZ4FrameFile(f)
+        else:
+            stream = f
+        with tarfile.open(fileobj=stream, mode='r|*') as tar:
+            # Only regular files and directories inside target_dir
+            if hasattr(tarfile, 'data_filter'):
+                tar.extractall(target_dir, filter='data')
+            else:
+                tar.extractall(target_dir)
+
+
 class TempDir:
     """
     Context manager for temporary files and directories.